@@ -0,0 +1,297 @@
+"""Compare the alerts of a model run with the ones of the previous run.
+
+The severity of a pixel is the number of accumulation periods for which
+it is in alert. The severity of the latest model run of each domain and
+model run hour is kept in CACHEDIR, in the sparse representation, so
+that the next model run is compared with it and only the changes are
+published:
+    - raised: pixels in alert that were not
+    - cleared: pixels no longer in alert
+    - upgraded: pixels in alert with a higher severity
+    - downgraded: pixels still in alert with a lower severity
+The changed pixels are also grouped in clusters of adjacent pixels.
+"""
+import datetime
+import json
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from alerts import alerts_to_coo, coo_to_alerts
+
+CHANGE_KINDS = ('raised', 'cleared', 'upgraded', 'downgraded')
+
+
+def severity_grid(barrays):
+    """Get the severity of the alerts of several accumulation periods
+
+    :param barrays: iterable
+        of 2d arrays, non-zero where alerts are
+    :return: numpy.ndarray
+        a 2d uint8 array with the number of periods in alert
+    """
+    severity = None
+    for barray in barrays:
+        if severity is None:
+            severity = np.zeros(barray.shape, np.uint8)
+        severity += barray != 0
+    return severity
+
+
+class AlertState:
+    """The severity of the alerts of a model run, kept for the next comparison
+
+    The severity is held in the sparse (COO) representation, see
+    alerts.alerts_to_coo, as most of the pixels are not in alert.
+
+    Attributes:
+        domain: str
+            the WRF domain
+        model_run_dt: datetime.datetime
+            the date and time of the model run
+        indices: numpy.ndarray
+            the sorted flat indices of the pixels in alert
+        values: numpy.ndarray
+            the number of accumulation periods in alert for those pixels
+        shape: tuple
+            the number of rows and columns of the grid
+        geotransform: tuple
+            the affine geotransform coefficients of the grid
+    """
+    def __init__(self, domain, model_run_dt, indices, values, shape, geotransform):
+        """
+        :param domain: str
+            the WRF domain
+        :param model_run_dt: datetime.datetime
+            the date and time of the model run
+        :param indices: numpy.ndarray
+            the sorted flat indices of the pixels in alert
+        :param values: numpy.ndarray
+            the number of accumulation periods in alert for those pixels
+        :param shape: tuple
+            the number of rows and columns of the grid
+        :param geotransform: tuple
+            the affine geotransform coefficients of the grid
+        """
+        self.domain = domain
+        self.model_run_dt = model_run_dt
+        self.indices = indices
+        self.values = values
+        self.shape = tuple(shape)
+        self.geotransform = tuple(geotransform)
+
+    @classmethod
+    def from_grid(cls, domain, model_run_dt, severity, geotransform):
+        """Alternate constructor based on the dense severity grid
+
+        :param domain: str
+            the WRF domain
+        :param model_run_dt: datetime.datetime
+            the date and time of the model run
+        :param severity: numpy.ndarray
+            the number of accumulation periods in alert for each pixel
+        :param geotransform: tuple
+            the affine geotransform coefficients of the grid
+        :return: AlertState
+        """
+        return cls(domain, model_run_dt, *alerts_to_coo(severity), severity.shape, geotransform)
+
+    @property
+    def severity(self):
+        """Get the dense severity grid
+
+        :return: numpy.ndarray
+        """
+        return coo_to_alerts(self.indices, self.values, self.shape)
+
+    @staticmethod
+    def abspath_for(cache_dir, domain, run_hour):
+        """Get the absolute path of the state of a domain and model run hour
+
+        :param cache_dir: str
+            the folder of the cached data
+        :param domain: str
+            the WRF domain
+        :param run_hour: int
+            the hour of the model run
+        :return: str
+        """
+        return os.path.join(cache_dir, 'alert_state_{}_{:02d}.npz'.format(domain, run_hour))
+
+    @classmethod
+    def load(cls, abspath):
+        """Alternate constructor reading a state from disk
+
+        :param abspath: str
+            the absolute path of the state
+        :return: AlertState
+            or None if the state is missing
+        """
+        if not os.path.exists(abspath):
+            return None
+        with np.load(abspath) as npz:
+            return cls(str(npz['domain']), datetime.datetime.fromisoformat(str(npz['model_run'])),
+                       npz['indices'], npz['values'], npz['shape'].tolist(), npz['geotransform'].tolist())
+
+    def save(self, abspath):
+        """Write the state to disk, replacing the previous one at once
+
+        :param abspath: str
+            the absolute path of the state
+        :return: None
+        """
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        # numpy appends the .npz extension to the temporary name
+        np.savez(abspath + '.tmp', domain=self.domain, model_run=self.model_run_dt.isoformat(),
+                 indices=self.indices, values=self.values, shape=np.array(self.shape),
+                 geotransform=np.array(self.geotransform))
+        os.replace(abspath + '.tmp.npz', abspath)
+
+
+class AlertChanges:
+    """The changes of the alerts between two model runs
+
+    The changes are computed on the sparse representations of the two
+    model runs, i.e. only the pixels in alert in any of them are compared.
+
+    Attributes:
+        current: AlertState
+            the alerts of the model run
+        previous: AlertState
+            the alerts of the previous model run, or None if not available,
+            in which case all the pixels in alert are raised
+        changes: dict
+            by kind of change, the flat indices of the changed pixels
+            with their previous and current severity
+    """
+    def __init__(self, current, previous=None):
+        """
+        :param current: AlertState
+            the alerts of the model run
+        :param previous: AlertState
+            the alerts of the previous model run, ignored if on another grid
+        """
+        if previous is not None and (previous.shape != current.shape or
+                                     not np.allclose(previous.geotransform, current.geotransform)):
+            print('The previous alerts are on another grid, all the alerts are published')
+            previous = None
+        self.current = current
+        self.previous = previous
+        if previous is None:
+            previous = AlertState(current.domain, None, current.indices[:0], current.values[:0], current.shape,
+                                  current.geotransform)
+        old_in_new = np.isin(previous.indices, current.indices, assume_unique=True)
+        new_in_old = np.isin(current.indices, previous.indices, assume_unique=True)
+        # both index arrays are sorted, so the common pixels are aligned
+        old, new = previous.values[old_in_new], current.values[new_in_old]
+        common = current.indices[new_in_old]
+        upgraded, downgraded = new > old, new < old
+        self.changes = {
+            'raised': (current.indices[~new_in_old], np.zeros((~new_in_old).sum(), np.uint8),
+                       current.values[~new_in_old]),
+            'cleared': (previous.indices[~old_in_new], previous.values[~old_in_new],
+                        np.zeros((~old_in_new).sum(), np.uint8)),
+            'upgraded': (common[upgraded], old[upgraded], new[upgraded]),
+            'downgraded': (common[downgraded], old[downgraded], new[downgraded])}
+
+    def __len__(self):
+        """Get the number of changed pixels
+
+        :return: int
+        """
+        return sum(len(indices) for indices, _, _ in self.changes.values())
+
+    def clusters(self, kind):
+        """Group the changed pixels of a kind in clusters of adjacent pixels
+
+        :param kind: str
+            one of CHANGE_KINDS
+        :return: list
+            a dict for each cluster with its number of pixels, its bounding
+            box in rows and columns, its centroid in lon/lat and its highest
+            severity (the previous one for the cleared pixels)
+        """
+        indices, old, new = self.changes[kind]
+        if not len(indices):
+            return []
+        shape = self.current.shape
+        labels, count = ndimage.label(coo_to_alerts(indices, 1, shape, bool), structure=np.ones((3, 3)))
+        pixel_labels = labels.ravel()[indices] - 1
+        rows, cols = np.unravel_index(indices, shape)
+        pixels = np.bincount(pixel_labels, minlength=count)
+        mean_rows = np.bincount(pixel_labels, rows, count) / pixels
+        mean_cols = np.bincount(pixel_labels, cols, count) / pixels
+        severity = np.zeros(count, np.uint8)
+        np.maximum.at(severity, pixel_labels, old if kind == 'cleared' else new)
+        gt = self.current.geotransform
+        clusters = []
+        for label, (row_slice, col_slice) in enumerate(ndimage.find_objects(labels)):
+            clusters.append({'pixels': int(pixels[label]),
+                             'rows': [row_slice.start, row_slice.stop - 1],
+                             'cols': [col_slice.start, col_slice.stop - 1],
+                             'lon': round(gt[0] + (mean_cols[label] + 0.5) * gt[1], 5),
+                             'lat': round(gt[3] + (mean_rows[label] + 0.5) * gt[5], 5),
+                             'severity': int(severity[label])})
+        return clusters
+
+    def to_dict(self):
+        """Get the changes as a JSON serializable document
+
+        :return: dict
+        """
+        document = {'domain': self.current.domain,
+                    'model_run': self.current.model_run_dt.isoformat(),
+                    'previous_model_run': None if self.previous is None else self.previous.model_run_dt.isoformat(),
+                    'geotransform': list(self.current.geotransform),
+                    'shape': list(self.current.shape)}
+        for kind in CHANGE_KINDS:
+            indices, old, new = self.changes[kind]
+            rows, cols = np.unravel_index(indices, self.current.shape)
+            document[kind] = {'rows': rows.tolist(), 'cols': cols.tolist(),
+                              'previous_severity': old.tolist(), 'severity': new.tolist(),
+                              'clusters': self.clusters(kind)}
+        return document
+
+    def to_json(self, out_abspath):
+        """Write the changes to a JSON file
+
+        :param out_abspath: str
+            the absolute path of the output file
+        :return: int
+            0 if successful
+        """
+        if not os.path.isabs(out_abspath):
+            raise ValueError("The path provided is not absolute: " + out_abspath)
+        print('Writing alert changes file --> ', out_abspath)
+        with open(out_abspath, 'w') as jf:
+            json.dump(self.to_dict(), jf)
+        print('\t', len(self), ' changed pixels written!')
+        return 0
+
+
+def publish_alert_changes(settings, current, run_hour, out_abspath):
+    """Compare the alerts of a model run with the previous one and write the changes
+
+    The previous model run is the one in the JSON file containing the
+    latest model run, which must not have been updated yet. The state of
+    the model run then replaces the previous one in CACHEDIR.
+
+    :param settings: settings.Settings
+    :param current: AlertState
+        the alerts of the model run
+    :param run_hour: int
+        the hour of the model run
+    :param out_abspath: str
+        the absolute path of the output file
+    :return: AlertChanges
+    """
+    state_abspath = AlertState.abspath_for(settings.CACHEDIR, current.domain, run_hour)
+    previous = AlertState.load(state_abspath)
+    if previous is not None and previous.model_run_dt != settings.read_ref_time(current.domain, run_hour):
+        print('The alerts of the previous model run are not available, all the alerts are published')
+        previous = None
+    changes = AlertChanges(current, previous)
+    changes.to_json(out_abspath)
+    current.save(state_abspath)
+    return changes
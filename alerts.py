@@ -1,17 +1,23 @@
 """This module is needed for generating alerts.
 
-Define a function for reading raster (geotiff) with one band from disk.
+Define two functions for reading raster (geotiff) with one band from disk,
+as it is or resampled onto a given grid, and the converters between the
+dense grid of the alerts and its compact representations: bit-packed for
+binary alerts, sparse (COO) for alerts with a value such as the severity
+or the lead time.
 Also define three classes:
     - an AlertExtractor for generating the alerts
     - a Threshold class for reading and managing threshold values
     - an Alerts class for managing and saving alerts values
 """
 import os
-import configparser
+import hashlib
 
 import numpy as np
 from osgeo import gdal, osr
 
+from regrid import RegridIndex, write_cache_file
+from settings import get_settings
 from time_serie import PrecipTimeSerie
 
 
@@ -28,6 +34,124 @@ def tif2array(tif_abspath):
     return array
 
 
+def tif2grid(tif_abspath, geotransform, shape, fill=0, indices=None):
+    """Read a geotiff file into an array resampled onto the given grid
+
+    The nearest-neighbour index between the two grids is computed
+    once and cached on disk, see regrid.RegridIndex. Only the window
+    of the raster covering the output grid is read.
+
+    :param tif_abspath: str
+        the absolute path of the input file on disk
+    :param geotransform: tuple
+        the affine geotransform coefficients of the output grid
+    :param shape: tuple
+        the number of rows and columns of the output grid
+    :param fill: scalar
+        the value of the pixels out of the raster extent,
+        None for the highest value of the raster type
+    :param indices: numpy.ndarray
+        if provided, the flat indices of the only pixels of the output
+        grid to be returned, see land_index
+    :return: numpy.ndarray
+        containing band 1 values, a 1d array if indices are provided
+    """
+    ds = gdal.Open(tif_abspath, gdal.GA_ReadOnly)
+    index = RegridIndex.cached(get_settings().CACHEDIR, ds.GetGeoTransform(), (ds.RasterYSize, ds.RasterXSize),
+                               geotransform, shape)
+    (row_off, col_off, nrows, ncols), index = index.cropped()
+    array = ds.GetRasterBand(1).ReadAsArray(col_off, row_off, ncols, nrows)
+    if fill is None:
+        fill = np.iinfo(array.dtype).max if np.issubdtype(array.dtype, np.integer) else np.inf
+    if indices is not None:
+        return index.take(array, indices, fill)
+    return index.apply(array, fill)
+
+
+def land_index(mask_abspath, geotransform, shape):
+    """Get the flat indices of the land pixels of a grid
+
+    The sea/land mask is resampled onto the grid once and the indices of
+    its land pixels are cached on disk, so that alerts are computed on
+    the land pixels only and scattered back onto the grid when written.
+    The land pixels are the ones where the mask is 1, as the alerts were
+    multiplied by the mask: the NoData and other values are not land.
+
+    :param mask_abspath: str
+        the absolute path of the sea/land mask on disk
+    :param geotransform: tuple
+        the affine geotransform coefficients of the grid
+    :param shape: tuple
+        the number of rows and columns of the grid
+    :return: numpy.ndarray
+        the sorted flat indices of the land pixels
+    """
+    cache_dir = get_settings().CACHEDIR
+    key = repr((mask_abspath, os.path.getmtime(mask_abspath), [round(float(c), 9) for c in geotransform],
+                tuple(shape), 'mask == 1'))
+    abspath = os.path.join(cache_dir, 'land_' + hashlib.sha1(key.encode()).hexdigest() + '.npy')
+    if os.path.exists(abspath):
+        return np.load(abspath)
+    indices = np.flatnonzero(tif2grid(mask_abspath, geotransform, shape) == 1).astype(np.uint32)
+    write_cache_file(abspath, lambda f: np.save(f, indices))
+    return indices
+
+
+def pack_alerts(barray):
+    """Pack a grid of binary alerts into bits
+
+    :param barray: numpy.ndarray
+        a 2d array, non-zero where alerts are
+    :return: numpy.ndarray
+        a 1d uint8 array with 8 pixels per byte
+    """
+    return np.packbits(barray.ravel() != 0)
+
+
+def unpack_alerts(packed, shape):
+    """Unpack a grid of binary alerts packed into bits
+
+    :param packed: numpy.ndarray
+        the 1d uint8 array returned by pack_alerts
+    :param shape: tuple
+        the number of rows and columns of the grid
+    :return: numpy.ndarray
+        a 2d uint8 array containing ones where alerts are
+    """
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape)
+
+
+def alerts_to_coo(barray):
+    """Get the sparse (COO) representation of a grid of alerts
+
+    :param barray: numpy.ndarray
+        a 2d array, non-zero where alerts are
+    :return: tuple
+        the sorted flat indices (uint32) of the pixels in alert and their values
+    """
+    flat = barray.ravel()
+    indices = np.flatnonzero(flat).astype(np.uint32)
+    return indices, flat[indices]
+
+
+def coo_to_alerts(indices, values, shape, dtype=np.uint8):
+    """Get the dense grid of alerts from its sparse (COO) representation
+
+    :param indices: numpy.ndarray
+        the flat indices of the pixels in alert
+    :param values: numpy.ndarray or scalar
+        the values of the pixels in alert
+    :param shape: tuple
+        the number of rows and columns of the grid
+    :param dtype: numpy.dtype
+        the type of the grid
+    :return: numpy.ndarray
+    """
+    barray = np.zeros(shape, dtype)
+    barray.ravel()[indices] = values
+    return barray
+
+
 class AlertExtractor:
     """A class needed for extracting alerts from a time serie,
     on the basis of alert values.
@@ -54,6 +178,8 @@ class AlertExtractor:
         if not isinstance(threshold, Threshold):
             raise ValueError('The threshold object is not of type Threshold!')
         self.threshold = threshold
+        self._land = None
+        self._land_steps = None
 
     @classmethod
     def from_serie(cls, serie_obj):
@@ -62,15 +188,42 @@ class AlertExtractor:
         :param serie_obj: PrecipTimeSerie
         :return: AlertExtractor
         """
-        threshold_obj = Threshold(int(serie_obj.duration.total_seconds() // 3600))
+        threshold_obj = Threshold(int(serie_obj.duration.total_seconds() // 3600), serie_obj.domain,
+                                  serie_obj.geotransform, serie_obj.shape)
         return cls(serie_obj, threshold_obj)
 
+    @property
+    def land(self):
+        """Get the flat indices of the land pixels of the serie grid, see land_index
+
+        :return: numpy.ndarray
+        """
+        if self._land is None:
+            mask_abspath = get_settings().mask_abspath(self.serie.domain)
+            self._land = land_index(mask_abspath, self.serie.geotransform, self.serie.shape)
+        return self._land
+
+    @property
+    def land_steps(self):
+        """Get the threshold values of the land pixels, in quantization steps
+
+        :return: numpy.ndarray
+        """
+        if self._land_steps is None:
+            self._land_steps = self.serie.quantizer.to_steps(self.threshold.land_values(self.land))
+        return self._land_steps
+
     def get_alerts(self):
         """Generate and return an instance of Alert
 
+        The quantized accumulation is compared with the threshold values
+        expressed in quantization steps, NoData pixels never raise alerts.
+        Only the land pixels are compared, sea pixels never raise alerts.
+
         :return: Alert
         """
-        return Alerts(self.serie.accumul > self.threshold.grid, self.serie.geotransform, self.serie.EPSG_CODE)
+        _, barray = self.serie.accumul_alerts(self.land, self.land_steps)
+        return Alerts.from_masked(barray, self.serie.geotransform, self.serie.EPSG_CODE, self.serie.domain)
 
     def save_alerts(self, absfname):
         """Generate an instance of Alert and save its values to tiff
@@ -81,6 +234,36 @@ class AlertExtractor:
         alerts_obj = self.get_alerts()
         alerts_obj.save2tiff(absfname)
 
+    def get_lead_times(self):
+        """Generate and return an instance of Alert with the lead times
+
+        For each pixel the value is the forecast hour (since the model
+        run, capped to 255) at which the accumulated precipitation first
+        exceeds the threshold, 0 where it never does. The first crossing
+        is found with a single vectorized pass over the cumulative serie.
+
+        :return: Alert
+        """
+        land = self.land
+        serie = self.serie.serie.reshape(len(self.serie), -1)[:, land]
+        quantizer = self.serie.quantizer
+        exceeded = (serie > self.land_steps) & (serie != quantizer.nodata)
+        hours = np.array([min((measure.end_dt - measure.model_run_dt).total_seconds() // 3600, 255)
+                          for measure in self.serie.measures], np.uint8)
+        lead_times = hours[exceeded.argmax(axis=0)]
+        lead_times[~exceeded.any(axis=0)] = 0
+        return Alerts.from_land(lead_times, land, self.serie.shape, self.serie.geotransform, self.serie.EPSG_CODE,
+                                self.serie.domain)
+
+    def save_lead_times(self, absfname):
+        """Generate an instance of Alert with the lead times and save its values to tiff
+
+        :param absfname: str
+            the absolute path of the output file on disk
+        """
+        lead_times_obj = self.get_lead_times()
+        lead_times_obj.save2tiff(absfname)
+
 
 class Threshold:
     """A class for reading and managing threshold values
@@ -89,60 +272,96 @@ class Threshold:
         hours: int
             the duration of the accumulated precipitation
             to which the threshold values refer
-        dirname: str
-            the absolute path to the parent directory containing the
+        domain: str
+            the WRF domain to which the threshold values refer
         tif_name: str
             the filename of the threshold raster on disk
         tif_abspath: str
             the absolute path of the threshold raster on disk
+        geotransform: tuple
+            the affine geotransform coefficients of the grid onto which
+            the threshold values are resampled, or None
+        shape: tuple
+            the number of rows and columns of that grid, or None
     """
-    def __init__(self, hours):
+    def __init__(self, hours, domain=None, geotransform=None, shape=None):
         """
         :param hours: int
             the duration to which these threshold values refer
+        :param domain: str
+            the WRF domain to which these threshold values refer
+            (default is the first configured one)
+        :param geotransform: tuple
+            if provided, the affine geotransform coefficients of the grid
+            onto which the threshold values are resampled
+        :param shape: tuple
+            if provided, the number of rows and columns of that grid
         :raise: ValueError
             if hours is not an int
         """
         if not isinstance(hours, int):
             raise ValueError('Duration must be expressed in hours, integer value is expected')
         self.hours = hours
+        self.geotransform = geotransform
+        self.shape = shape
         self._grid = None
-        project_root = os.path.dirname(__file__)
-        config_abspath = os.path.join(project_root, 'config.ini')
-        config = configparser.ConfigParser()
-        config.read(config_abspath)
-        self.tif_name = config['Grid Thresholds'][str(hours) + 'h']
-        self.tif_abspath = os.path.join(project_root, 'tool_data', self.tif_name)
-        del config
+        settings = get_settings()
+        self.domain = settings.DOMAINS[0] if domain is None else domain
+        self.tif_name = settings.grid_thresholds_for(self.domain)[hours]
+        self.tif_abspath = settings.threshold_abspath(hours, self.domain)
 
     @property
     def grid(self):
         """Get the precipitation threshold-values in a grid
 
+        If a target grid is given, the threshold raster is resampled onto
+        it and pixels out of the raster extent never raise alerts,
+        otherwise the raster is expected to be the flipped WRF grid.
+
         :return: numpy.ndarray
         """
         if self._grid is None:
-            self._grid = np.flipud(tif2array(self.tif_abspath))
+            if self.geotransform is None:
+                self._grid = np.flipud(tif2array(self.tif_abspath))
+            else:
+                self._grid = tif2grid(self.tif_abspath, self.geotransform, self.shape, fill=None)
         return self._grid
 
+    def land_values(self, land):
+        """Get the precipitation threshold-values of the land pixels only
+
+        Unless the whole grid has already been read, only the threshold
+        values of the land pixels are resampled.
+
+        :param land: numpy.ndarray
+            the flat indices of the land pixels, see land_index
+        :return: numpy.ndarray
+        """
+        if self._grid is not None or self.geotransform is None:
+            return self.grid.ravel()[land]
+        return tif2grid(self.tif_abspath, self.geotransform, self.shape, fill=None, indices=land)
+
 
 class Alerts:
     """A class to manage alerts data
 
         Attributes:
         barray: numpy.ndarray
-            containing ones where alerts are
+            containing ones where alerts are, or the lead times
+            of the alerts (see AlertExtractor.get_lead_times)
         geotransform: tuple
             containing the affine geotransform coefficients according to
             https://gdal.org/user/raster_data_model.html#affine-geotransform
         EPSG_CODE: int
             the code of the spatial reference
+        domain: str
+            the WRF domain of the alerts
         mask_fname: str
             the filename for the sea/ocean mask
         mask_abspath: str
             the absolute path of the sea/ocean mask on disk
     """
-    def __init__(self, barray, geotransform, epsg_code):
+    def __init__(self, barray, geotransform, epsg_code, domain=None):
         """
         :param barray: numpy.ndarray
             containing ones where alerts are
@@ -151,28 +370,30 @@ class Alerts:
             https://gdal.org/user/raster_data_model.html#affine-geotransform
         :param epsg_code: int
             the code of the spatial reference
+        :param domain: str
+            the WRF domain of the alerts (default is the first configured one)
         """
         self.barray = barray
         self.geotransform = geotransform
         self.epsg_code = epsg_code
         self._mask = None
         self._masked_barray = None
-        project_root = os.path.dirname(__file__)
-        config_abspath = os.path.join(project_root, 'config.ini')
-        config = configparser.ConfigParser()
-        config.read(config_abspath)
-        self.mask_fname = config['Filename formats']['mask']
-        self.mask_abspath = os.path.join(project_root, 'tool_data', self.mask_fname)
-        del config
+        settings = get_settings()
+        self.domain = settings.DOMAINS[0] if domain is None else domain
+        self.mask_abspath = settings.mask_abspath(self.domain)
+        self.mask_fname = os.path.basename(self.mask_abspath)
 
     @property
     def mask(self):
         """Get the sea/ocean mask into an array
 
+        The mask raster is resampled onto the grid of the alerts,
+        pixels out of the raster extent are masked.
+
         :return: numpy.ndarray
         """
         if self._mask is None:
-            self._mask = np.flipud(tif2array(self.mask_abspath))
+            self._mask = tif2grid(self.mask_abspath, self.geotransform, self.barray.shape)
         return self._mask
 
     @property
@@ -185,6 +406,99 @@ class Alerts:
             self._masked_barray = self.barray * self.mask
         return self._masked_barray
 
+    @classmethod
+    def from_packed(cls, packed, shape, geotransform, epsg_code, domain=None):
+        """Alternate constructor based on alerts packed into bits
+
+        :param packed: numpy.ndarray
+            the 1d uint8 array returned by pack_alerts
+        :param shape: tuple
+            the number of rows and columns of the grid
+        :param geotransform: tuple
+            containing the affine geotransform coefficients
+        :param epsg_code: int
+            the code of the spatial reference
+        :param domain: str
+            the WRF domain of the alerts (default is the first configured one)
+        :return: Alerts
+        """
+        return cls(unpack_alerts(packed, shape), geotransform, epsg_code, domain)
+
+    @classmethod
+    def from_coo(cls, indices, values, shape, geotransform, epsg_code, domain=None):
+        """Alternate constructor based on the sparse (COO) representation of alerts
+
+        :param indices: numpy.ndarray
+            the flat indices of the pixels in alert
+        :param values: numpy.ndarray
+            the values of the pixels in alert
+        :param shape: tuple
+            the number of rows and columns of the grid
+        :param geotransform: tuple
+            containing the affine geotransform coefficients
+        :param epsg_code: int
+            the code of the spatial reference
+        :param domain: str
+            the WRF domain of the alerts (default is the first configured one)
+        :return: Alerts
+        """
+        return cls(coo_to_alerts(indices, values, shape), geotransform, epsg_code, domain)
+
+    @classmethod
+    def from_land(cls, values, land, shape, geotransform, epsg_code, domain=None):
+        """Alternate constructor based on the alerts of the land pixels only
+
+        The values are scattered onto the grid, which is already masked.
+
+        :param values: numpy.ndarray
+            the alerts of the land pixels
+        :param land: numpy.ndarray
+            the flat indices of the land pixels, see land_index
+        :param shape: tuple
+            the number of rows and columns of the grid
+        :param geotransform: tuple
+            containing the affine geotransform coefficients
+        :param epsg_code: int
+            the code of the spatial reference
+        :param domain: str
+            the WRF domain of the alerts (default is the first configured one)
+        :return: Alerts
+        """
+        return cls.from_masked(coo_to_alerts(land, values, shape), geotransform, epsg_code, domain)
+
+    @classmethod
+    def from_masked(cls, masked_barray, geotransform, epsg_code, domain=None):
+        """Alternate constructor based on alerts already masked
+
+        :param masked_barray: numpy.ndarray
+            containing ones where alerts are, zero on the sea pixels
+        :param geotransform: tuple
+            containing the affine geotransform coefficients
+        :param epsg_code: int
+            the code of the spatial reference
+        :param domain: str
+            the WRF domain of the alerts (default is the first configured one)
+        :return: Alerts
+        """
+        alerts_obj = cls(masked_barray, geotransform, epsg_code, domain)
+        alerts_obj._masked_barray = masked_barray
+        return alerts_obj
+
+    def packed(self):
+        """Get the masked alerts packed into bits, see pack_alerts.
+
+        :return: numpy.ndarray
+        """
+        return pack_alerts(self.masked_barray)
+
+    def to_coo(self):
+        """Get the sparse (COO) representation of the masked alerts, see alerts_to_coo.
+
+        :return: tuple
+            the flat indices of the pixels in alert and their values
+        """
+        return alerts_to_coo(self.masked_barray)
+
     def save2tiff(self, out_abspath):
         """Write alert values to tiff.
 
@@ -0,0 +1,364 @@
+"""Streaming climatology of the accumulations, for recalibrating the thresholds.
+
+Years of archived model runs do not fit in memory, so the accumulations
+are reduced one grid at a time into per-pixel statistics updated online:
+    - the running mean and variance (Welford's algorithm)
+    - the number of accumulations exceeding each candidate amount
+    - a histogram with fixed bin edges, from which approximate
+      quantiles are interpolated
+The accumulation of a model run over a period is its cumulative
+precipitation at the end of the period, read from its run archive
+(see run_archive.RunArchive).
+
+The statistics of disjoint sets of model runs can be merged, so that
+the model runs are split among worker processes, and the state of the
+reduction is saved with the model runs it covers, so that the next
+reductions add only the new model runs to it. The quantiles are
+written as candidate threshold rasters, in the format of the rasters of
+the Grid Thresholds section of config.ini.
+"""
+import concurrent.futures
+import datetime
+import os
+
+import numpy as np
+from osgeo import gdal, osr
+
+from run_archive import RunArchive
+from settings import get_settings
+
+# the edges in mm of the bins of the histograms, the last bin is open-ended
+HISTOGRAM_EDGES = np.concatenate([np.arange(0, 20, 1), np.arange(20, 100, 5), np.arange(100, 300, 10),
+                                  np.arange(300, 501, 50)]).astype(np.float32)
+
+
+class ClimatologyState:
+    """The per-pixel statistics of a set of accumulations, updated one grid at a time
+
+    Attributes:
+        shape: tuple
+            the number of rows and columns of the grid
+        edges: numpy.ndarray
+            the edges in mm of the bins of the histograms
+        amounts: numpy.ndarray
+            the candidate amounts in mm whose exceedances are counted
+        count: numpy.ndarray
+            the number of valid accumulations of each pixel
+        mean: numpy.ndarray
+            the mean of the accumulations of each pixel
+        m2: numpy.ndarray
+            the sum of the squared differences from the mean of each pixel
+        exceedances: numpy.ndarray
+            for each amount, the number of accumulations exceeding it
+        histogram: numpy.ndarray
+            for each bin, the number of accumulations falling in it
+        runs: set
+            the dates and times of the model runs reduced
+    """
+    def __init__(self, shape, edges=HISTOGRAM_EDGES, amounts=()):
+        """
+        :param shape: tuple
+            the number of rows and columns of the grid
+        :param edges: numpy.ndarray
+            the increasing edges in mm of the bins of the histograms
+        :param amounts: iterable
+            the candidate amounts in mm whose exceedances are counted
+        """
+        self.shape = tuple(shape)
+        self.edges = np.asarray(edges, np.float32)
+        self.amounts = np.asarray(amounts, np.float32)
+        self.count = np.zeros(self.shape, np.uint32)
+        self.mean = np.zeros(self.shape, np.float64)
+        self.m2 = np.zeros(self.shape, np.float64)
+        self.exceedances = np.zeros((len(self.amounts),) + self.shape, np.uint32)
+        self.histogram = np.zeros((len(self.edges),) + self.shape, np.uint32)
+        self.runs = set()
+
+    def update(self, values, valid, model_run_dt=None):
+        """Add an accumulation to the statistics
+
+        :param values: numpy.ndarray
+            the accumulation in mm
+        :param valid: numpy.ndarray
+            a boolean array that is False where values are NoData
+        :param model_run_dt: datetime.datetime
+            if provided, the model run of the accumulation, added to the runs
+        :return: None
+        """
+        if model_run_dt is not None:
+            self.runs.add(model_run_dt)
+        values = np.where(valid, values, 0).astype(np.float64)
+        self.count += valid
+        delta = values - self.mean
+        self.mean += np.where(valid, delta / np.maximum(self.count, 1), 0)
+        self.m2 += np.where(valid, delta * (values - self.mean), 0)
+        for exceedances, amount in zip(self.exceedances, self.amounts):
+            exceedances += valid & (values > amount)
+        # each pixel falls in one bin only, so that the flat indices are unique
+        bins = np.clip(np.searchsorted(self.edges, values, side='right') - 1, 0, len(self.edges) - 1)
+        flat = bins.ravel() * self.count.size + np.arange(self.count.size)
+        self.histogram.reshape(-1)[flat[valid.ravel()]] += 1
+
+    def merge(self, other):
+        """Add the statistics of a disjoint set of accumulations (Chan's algorithm)
+
+        :param other: ClimatologyState
+            with the same grid, bins and amounts
+        :return: ClimatologyState
+            this state, updated in place
+        :raise: ValueError
+            if the states are not compatible, or share some model runs
+        """
+        if (other.shape != self.shape or not np.array_equal(other.edges, self.edges)
+                or not np.array_equal(other.amounts, self.amounts)):
+            raise ValueError('The climatology states have different grids, bins or amounts')
+        if self.runs & other.runs:
+            raise ValueError('The climatology states share ' + str(len(self.runs & other.runs)) + ' model runs')
+        count = self.count.astype(np.float64) + other.count
+        delta = other.mean - self.mean
+        weight = np.divide(other.count, count, out=np.zeros(self.shape), where=count > 0)
+        self.m2 += other.m2 + delta ** 2 * self.count * weight
+        self.mean += delta * weight
+        self.count += other.count
+        self.exceedances += other.exceedances
+        self.histogram += other.histogram
+        self.runs |= other.runs
+        return self
+
+    @property
+    def variance(self):
+        """Get the sample variance of the accumulations of each pixel
+
+        :return: numpy.ndarray
+            NaN where less than two accumulations are valid
+        """
+        return np.divide(self.m2, self.count - 1.0, out=np.full(self.shape, np.nan), where=self.count > 1)
+
+    def quantile(self, q):
+        """Get the approximate quantile of the accumulations of each pixel
+
+        The quantile is interpolated linearly within its bin of the
+        histogram, the open-ended last bin gives its lower edge.
+
+        :param q: float
+            the probability of the quantile, between 0 and 1
+        :return: numpy.ndarray
+            of float32 type, NaN where no accumulation is valid
+        """
+        cumulative = np.cumsum(self.histogram, axis=0, dtype=np.float64)
+        target = q * self.count
+        bins = np.argmax(cumulative >= target, axis=0)
+        below = np.take_along_axis(cumulative, bins[None], 0)[0] - np.take_along_axis(self.histogram, bins[None], 0)[0]
+        in_bin = np.take_along_axis(self.histogram, bins[None], 0)[0]
+        widths = np.append(np.diff(self.edges), 0)[bins]
+        fraction = np.divide(target - below, in_bin, out=np.zeros(self.shape), where=in_bin > 0)
+        quantile = (self.edges[bins] + np.clip(fraction, 0, 1) * widths).astype(np.float32)
+        quantile[self.count == 0] = np.nan
+        return quantile
+
+    def save(self, abspath):
+        """Write the state to disk, so that it can be merged with later ones
+
+        :param abspath: str
+            the absolute path of the .npz file
+        :return: None
+        """
+        # numpy appends the .npz extension to the temporary name
+        np.savez_compressed(abspath + '.tmp', shape=np.array(self.shape), edges=self.edges, amounts=self.amounts,
+                            count=self.count, mean=self.mean, m2=self.m2, exceedances=self.exceedances,
+                            histogram=self.histogram, runs=np.array(sorted(run.isoformat() for run in self.runs)))
+        os.replace(abspath + '.tmp.npz', abspath)
+
+    @classmethod
+    def load(cls, abspath):
+        """Alternate constructor reading a state from disk
+
+        :param abspath: str
+            the absolute path of the .npz file
+        :return: ClimatologyState
+        """
+        with np.load(abspath) as npz:
+            state = cls(npz['shape'].tolist(), npz['edges'], npz['amounts'])
+            for name in ('count', 'mean', 'm2', 'exceedances', 'histogram'):
+                setattr(state, name, npz[name])
+            state.runs = {datetime.datetime.fromisoformat(run) for run in npz['runs'].tolist()}
+        return state
+
+
+def _reduce_runs(archive_abspaths, duration_hours, shape, amounts, reduced):
+    """Reduce the accumulations of some model runs, to be run in a worker process
+
+    :param archive_abspaths: list
+        the absolute paths of the run archives
+    :param duration_hours: list
+        the durations of the accumulations, in hours
+    :param shape: tuple
+        the number of rows and columns of the grid
+    :param amounts: list
+        the candidate amounts in mm whose exceedances are counted
+    :param reduced: dict
+        the model runs already reduced, by duration
+    :return: dict
+        the ClimatologyState of each duration
+    """
+    states = {hours: ClimatologyState(shape, amounts=amounts) for hours in duration_hours}
+    rain = np.empty(shape, np.float32)
+    for abspath in archive_abspaths:
+        archive = RunArchive(abspath)
+        measures = {measure.end_dt: measure for measure in archive.measures}
+        for hours, state in states.items():
+            # the cumulative precipitation since the model run
+            measure = measures.get(archive.model_run_dt + datetime.timedelta(hours=hours))
+            if measure is None or archive.model_run_dt in reduced.get(hours, ()):
+                continue
+            rain, valid = measure.read_rain(rain)
+            state.update(rain, valid, archive.model_run_dt)
+    return states
+
+
+def reduce_archives(datadir, domain, duration_hours, amounts, first_date=None, last_date=None, workers=None,
+                    reduced=None):
+    """Reduce the accumulations of the archived model runs of a domain
+
+    :param datadir: str
+        the folder containing the runs subfolder with the run archives
+    :param domain: str
+        the WRF domain
+    :param duration_hours: list
+        the durations of the accumulations, in hours
+    :param amounts: list
+        the candidate amounts in mm whose exceedances are counted
+    :param first_date: datetime.date
+        if provided, the date of the first model run
+    :param last_date: datetime.date
+        if provided, the date of the last model run
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :param reduced: dict
+        if provided, the model runs already reduced by duration, which are skipped
+    :return: tuple
+        containing the ClimatologyState of each duration and the
+        geotransform of the grid
+    :raise: ValueError
+        if there are no run archives in the folder
+    """
+    archives = [archive for run, archive in sorted(RunArchive.from_dir(datadir, domain).items())
+                if (first_date is None or run.date() >= first_date) and (last_date is None or run.date() <= last_date)]
+    if not archives:
+        raise ValueError('There are no run archives of the domain ' + domain + ' in ' + datadir)
+    first = archives[0].measures[0]
+    shape = (len(first.lats), len(first.lons))
+    reduced = {} if reduced is None else reduced
+    archives = [archive for archive in archives
+                if any(archive.model_run_dt not in reduced.get(hours, ()) for hours in duration_hours)]
+    states = {hours: ClimatologyState(shape, amounts=amounts) for hours in duration_hours}
+    workers = workers or os.cpu_count()
+    # the model runs not covering a period yet are read again, as their later hours may have been appended
+    print('Reducing ', len(archives), ' model runs of ', domain, ' not reduced for every period, with ', workers,
+          ' workers')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_reduce_runs, [archive.abspath for archive in archives[i::workers]],
+                                   duration_hours, shape, amounts, reduced)
+                   for i in range(min(workers, len(archives)))]
+        for future in concurrent.futures.as_completed(futures):
+            for hours, state in future.result().items():
+                states[hours].merge(state)
+    return states, first.geotransform
+
+
+def write_threshold_tiff(out_abspath, grid, geotransform, epsg_code=4326):
+    """Write a candidate threshold raster
+
+    The grid is flipped north-up, as the threshold rasters of the procedure.
+
+    :param out_abspath: str
+        the absolute path of the output file
+    :param grid: numpy.ndarray
+        the threshold values on the WRF grid, NaN for NoData
+    :param geotransform: tuple
+        the affine geotransform coefficients of the WRF grid
+    :param epsg_code: int
+        the code of the spatial reference
+    :return: int
+        0 if successful
+    """
+    if not os.path.isabs(out_abspath):
+        raise ValueError("The path provided is not absolute: " + out_abspath)
+    gdal.AllRegister()
+    driver = gdal.GetDriverByName('Gtiff')
+    outDataset_options = ['COMPRESS=LZW']
+    print('Writing candidate threshold file --> ', out_abspath)
+    outDataset = driver.Create(out_abspath, grid.shape[1], grid.shape[0], 1, gdal.GDT_Float32, outDataset_options)
+    gt = geotransform
+    outDataset.SetGeoTransform((gt[0], gt[1], gt[2], gt[3] + grid.shape[0] * gt[5], gt[4], -gt[5]))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg_code)
+    outDataset.SetProjection(srs.ExportToWkt())
+    outband = outDataset.GetRasterBand(1)
+    # NaN thresholds never raise alerts
+    outband.SetNoDataValue(float('nan'))
+    outband.WriteArray(np.flipud(grid))
+    outband.GetStatistics(0, 1)
+    del outband
+    del outDataset
+    print('\tcandidate threshold file written!')
+    return 0
+
+
+def build_climatology(domain=None, datadir=None, out_dir=None, first_date=None, last_date=None, workers=None):
+    """Reduce the archived model runs of a domain and write candidate thresholds
+
+    For each accumulation period with a grid threshold, the state of the
+    reduction is saved and a candidate threshold raster is written for
+    each configured quantile. The saved states are merged with the
+    reduction of the model runs they do not cover yet, so that the
+    climatology is extended as new model runs are archived.
+
+    :param domain: str
+        the WRF domain (default is the first configured one)
+    :param datadir: str
+        the folder containing the runs subfolder with the run archives
+        (default is DATADIR)
+    :param out_dir: str
+        the folder where outputs are written (default is the configured one)
+    :param first_date: datetime.date
+        if provided, the date of the first model run
+    :param last_date: datetime.date
+        if provided, the date of the last model run
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :return: dict
+        the ClimatologyState of each duration
+    :raise: ValueError
+        if a saved state has other grid, bins or amounts
+    """
+    settings = get_settings()
+    domain = settings.DOMAINS[0] if domain is None else domain
+    datadir = settings.DATADIR if datadir is None else datadir
+    out_dir = settings.climatology['output_dir'] if out_dir is None else out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    duration_hours = sorted(settings.grid_thresholds_for(domain))
+    state_abspaths = {hours: os.path.join(out_dir, 'climatology_{}_{}h.npz'.format(domain, hours))
+                      for hours in duration_hours}
+    saved = {hours: ClimatologyState.load(abspath) for hours, abspath in state_abspaths.items()
+             if os.path.exists(abspath)}
+    amounts = np.asarray(settings.climatology['amounts'], np.float32)
+    for hours, state in saved.items():
+        if not np.array_equal(state.amounts, amounts):
+            raise ValueError('The amounts of ' + state_abspaths[hours] + ' are not the configured ones, '
+                             'remove it to start a new climatology')
+    states, geotransform = reduce_archives(datadir, domain, duration_hours, amounts, first_date, last_date, workers,
+                                           {hours: state.runs for hours, state in saved.items()})
+    for hours in duration_hours:
+        if hours in saved:
+            states[hours] = saved[hours].merge(states[hours])
+        state = states[hours]
+        if not state.count.any():
+            print('No archived model run covers ', hours, ' hours, no candidate thresholds written')
+            continue
+        print('\t', len(state.runs), ' model runs reduced for ', hours, ' hours')
+        state.save(state_abspaths[hours])
+        for q in settings.climatology['quantiles']:
+            fname = 'candidate_threshold_{}_{}h_q{:g}.tif'.format(domain, hours, q * 100)
+            write_threshold_tiff(os.path.join(out_dir, fname), state.quantile(q), geotransform)
+    return states
@@ -0,0 +1,249 @@
+"""Exceedance probability of the thresholds from a lagged ensemble of model runs.
+
+Consecutive model runs overlap, e.g. the model run of yesterday still
+covers today and tomorrow. The last model runs of a domain (the members
+of the lagged ensemble) are aligned by valid time: the accumulation of a
+member over an accumulation period of the latest model run is the
+difference between its cumulative precipitation at the end and at the
+start of the period. The probability of a land pixel is the percentage
+of the members whose accumulation exceeds the threshold.
+
+The quantized cumulative precipitation of each member is cached in
+CACHEDIR by valid time. While a model run is the latest one, its
+cumulative precipitation is cached also at the valid times needed by
+the next model runs, so that each new model run adds the cost of reading
+one member only, and the members evicted from DATADIR are still used.
+"""
+import contextlib
+import datetime
+import glob
+import os
+
+import numpy as np
+
+from alerts import Alerts, Threshold, land_index
+from regrid import write_cache_file
+from settings import get_settings
+from time_serie import PrecipTimeSerie
+
+CACHE_PREFIX = 'ensemble_'
+
+
+def scheduled_runs(model_run_dt, run_hours, count, later=False):
+    """Get the model runs scheduled around a model run
+
+    :param model_run_dt: datetime.datetime
+        the date and time of the model run
+    :param run_hours: list
+        the hours of the model runs, e.g. [0, 12]
+    :param count: int
+        the number of model runs, including the given one
+    :param later: bool
+        whether to get the following model runs instead of the previous ones
+    :return: list
+        of datetime.datetime objects, starting from the given model run
+    """
+    runs = [model_run_dt]
+    day = model_run_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    while len(runs) < count:
+        for hour in sorted(run_hours, reverse=not later):
+            run = day + datetime.timedelta(hours=hour)
+            if len(runs) < count and (run > runs[-1] if later else run < runs[-1]):
+                runs.append(run)
+        day += datetime.timedelta(days=1 if later else -1)
+    return runs
+
+
+class LaggedEnsemble:
+    """The last model runs of a domain, aligned by valid time
+
+    Attributes:
+        datadir: str
+            the local folder containing the WRF files
+        cache_dir: str
+            the folder where the cumulative precipitation of the members is cached
+        domain: str
+            the WRF domain
+        model_run_dt: datetime.datetime
+            the date and time of the latest model run
+        members: list
+            the dates and times of the model runs of the ensemble, latest first
+        run_hours: list
+            the hours of the model runs
+        geotransform: tuple
+            the affine geotransform coefficients of the grid
+        shape: tuple
+            the number of rows and columns of the grid
+        EPSG_CODE: int
+            the code of the spatial reference
+        quantizer: Quantizer
+            the compact representation of the precipitation values
+    """
+    def __init__(self, serie, size, datadir=None, cache_dir=None):
+        """
+        :param serie: PrecipTimeSerie
+            a serie of the latest model run, defining the domain and the grid
+        :param size: int
+            the number of members, including the latest model run
+        :param datadir: str
+            the local folder containing the WRF files
+            (default is the one in the configuration file)
+        :param cache_dir: str
+            the folder of the cached cumulative precipitation
+            (default is the one in the configuration file)
+        :raise: ValueError
+            if size is lower than 1
+        """
+        if size < 1:
+            raise ValueError('The ensemble must have at least one member')
+        settings = get_settings()
+        self.datadir = settings.DATADIR if datadir is None else datadir
+        self.cache_dir = settings.CACHEDIR if cache_dir is None else cache_dir
+        self.domain = serie.domain
+        self.model_run_dt = serie.measures[0].model_run_dt
+        self.run_hours = settings.RUN_HOURS
+        self.members = scheduled_runs(self.model_run_dt, self.run_hours, size)
+        self.geotransform = serie.geotransform
+        self.shape = serie.shape
+        self.EPSG_CODE = serie.EPSG_CODE
+        self.quantizer = serie.quantizer
+        self._land = None
+
+    @classmethod
+    def from_serie(cls, serie_obj):
+        """Alternate constructor based on a serie instance only
+
+        The number of members is the one in the configuration file.
+
+        :param serie_obj: PrecipTimeSerie
+        :return: LaggedEnsemble
+        """
+        return cls(serie_obj, get_settings().ensemble['members'])
+
+    @property
+    def land(self):
+        """Get the flat indices of the land pixels of the grid, see alerts.land_index
+
+        :return: numpy.ndarray
+        """
+        if self._land is None:
+            self._land = land_index(get_settings().mask_abspath(self.domain), self.geotransform, self.shape)
+        return self._land
+
+    def cache_abspath(self, member_dt, valid_dt):
+        """Get the absolute path of the cumulative precipitation of a member
+
+        :param member_dt: datetime.datetime
+            the date and time of the model run
+        :param valid_dt: datetime.datetime
+            the end of the accumulation from the start of the model run
+        :return: str
+        """
+        lead = int((valid_dt - member_dt).total_seconds() // 3600)
+        fname = '{}{}_{}_{:03d}.npy'.format(CACHE_PREFIX, self.domain, member_dt.strftime('%Y-%m-%d_%H'), lead)
+        return os.path.join(self.cache_dir, fname)
+
+    def cumulative(self, member_dt, valid_dt):
+        """Get the quantized cumulative precipitation of a member at a valid time
+
+        The value is read from the cache, or from the WRF files of the
+        model run and then cached.
+
+        :param member_dt: datetime.datetime
+            the date and time of the model run
+        :param valid_dt: datetime.datetime
+            the end of the accumulation from the start of the model run
+        :return: numpy.ndarray
+            or None if the model run does not cover the valid time
+        """
+        if valid_dt <= member_dt:
+            return np.full(self.shape, self.quantizer.encode(np.zeros(1, np.float32))[0])
+        abspath = self.cache_abspath(member_dt, valid_dt)
+        try:
+            cumulative = np.load(abspath)
+        except FileNotFoundError:
+            # not cached, or pruned by another process in the meantime
+            cumulative = None
+        if cumulative is not None and cumulative.shape == tuple(self.shape):
+            return cumulative
+        try:
+            tsobj = PrecipTimeSerie.earliest_from_dir(self.datadir, member_dt, valid_dt - member_dt, self.domain)
+        except Exception as exc:
+            print('Model run ', self.domain, member_dt.isoformat(), ' not available until ', valid_dt.isoformat(),
+                  ': ', exc)
+            return None
+        if tuple(tsobj.shape) != tuple(self.shape):
+            print('Model run ', self.domain, member_dt.isoformat(), ' is on another grid, skipped')
+            return None
+        cumulative = tsobj.accumul
+        write_cache_file(abspath, lambda f: np.save(f, cumulative))
+        return cumulative
+
+    def get_probability(self, hours):
+        """Get the exceedance probability of the threshold of an accumulation period
+
+        The period starts with the latest model run. Only the land pixels
+        are computed, NoData values are excluded from the members, and
+        the pixels without valid members have zero probability.
+
+        :param hours: int
+            the duration of the accumulation period
+        :return: Alerts
+            with the percentage of the members exceeding the threshold
+        """
+        land = self.land
+        # the offset of the quantization cancels out in the differences
+        steps = Threshold(hours, self.domain, self.geotransform, self.shape).land_values(land) / self.quantizer.scale
+        start_dt, stop_dt = self.model_run_dt, self.model_run_dt + datetime.timedelta(hours=hours)
+        exceeding = np.zeros(len(land), np.uint16)
+        valid = np.zeros(len(land), np.uint16)
+        for member_dt in self.members:
+            first = self.cumulative(member_dt, start_dt)
+            last = None if first is None else self.cumulative(member_dt, stop_dt)
+            if last is None:
+                continue
+            first, last = first.ravel()[land], last.ravel()[land]
+            member_valid = (first != self.quantizer.nodata) & (last != self.quantizer.nodata)
+            exceeding += member_valid & (last.astype(np.int64) - first > steps)
+            valid += member_valid
+        probability = np.zeros(len(land), np.uint8)
+        np.rint(100.0 * exceeding / np.maximum(valid, 1), out=probability, casting='unsafe')
+        return Alerts.from_land(probability, land, self.shape, self.geotransform, self.EPSG_CODE, self.domain)
+
+    def precache(self, duration_hours):
+        """Cache the cumulative precipitation of the latest model run needed by the next ones
+
+        :param duration_hours: iterable
+            the durations of the accumulation periods, in hours
+        :return: None
+        """
+        stop_dt = PrecipTimeSerie.earliest_from_dir(self.datadir, self.model_run_dt, domain=self.domain).stop_dt
+        for run_dt in scheduled_runs(self.model_run_dt, self.run_hours, len(self.members), later=True)[1:]:
+            for hours in (0, *duration_hours):
+                valid_dt = run_dt + datetime.timedelta(hours=hours)
+                if valid_dt <= stop_dt:
+                    self.cumulative(self.model_run_dt, valid_dt)
+
+    def prune(self):
+        """Remove the cached cumulative precipitation of the model runs older than the members
+
+        The members of the ensembles of the other model run hours are kept
+        as well, as those model runs may be processed at the same time or
+        out of order, e.g. by process_all.
+
+        :return: list
+            the absolute paths of the removed files
+        """
+        oldest = scheduled_runs(self.model_run_dt, self.run_hours, len(self.members) + len(self.run_hours) - 1)[-1]
+        removed = []
+        for abspath in glob.glob(os.path.join(self.cache_dir, CACHE_PREFIX + self.domain + '_*.npy')):
+            try:
+                member_dt = datetime.datetime.strptime(os.path.basename(abspath).split('_', 2)[2][:13],
+                                                       '%Y-%m-%d_%H')
+            except ValueError:
+                continue
+            if member_dt < oldest:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(abspath)
+                    removed.append(abspath)
+        return removed
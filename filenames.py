@@ -0,0 +1,117 @@
+"""This module parses the filenames of the WRF data.
+
+Only the standard library is imported here, so that the local data
+can be catalogued without reading the netCDF files.
+"""
+import re
+import datetime
+import collections
+
+# the filename of a WRF file is made of this prefix, the domain,
+# the model run date and hour, and the forecast hour, e.g.
+# sft_rftm_rg_wrfita_aux_d02_2020-04-01_00_05
+WRF_PREFIX = 'sft_rftm_rg_wrfita_aux_'
+_WRF_FNAME_RE = re.compile(r'^' + WRF_PREFIX + r'(?P<domain>d\d{2})_(?P<run>\d{4}-\d{2}-\d{2}_\d{2})_(?P<lead>\w+)$')
+# the consolidated files of the model runs are stored in a subfolder
+# of DATADIR, see run_archive.RunArchive
+RUN_ARCHIVE_SUBDIR = 'runs'
+RUN_ARCHIVE_PREFIX = 'wrfita_run_'
+RUN_ARCHIVE_FORMAT = RUN_ARCHIVE_PREFIX + '{domain}_%Y-%m-%d_%H.nc'
+_RUN_ARCHIVE_FNAME_RE = re.compile(r'^' + RUN_ARCHIVE_PREFIX +
+                                   r'(?P<domain>d\d{2})_(?P<run>\d{4}-\d{2}-\d{2}_\d{2})\.nc$')
+
+WrfFilename = collections.namedtuple('WrfFilename', ['domain', 'model_run_dt', 'lead'])
+WrfFilename.__doc__ = """The fields of the filename of a WRF file
+
+    domain: str
+        the WRF domain, e.g. d02
+    model_run_dt: datetime.datetime
+        the date and hour of the model run
+    lead: str
+        the forecast hour
+"""
+
+
+def parse_wrf_fname(basename):
+    """Parse the filename of a WRF file into its fields
+
+    :param basename: str
+        the filename of the WRF file
+    :return: WrfFilename
+        or None if the filename does not belong to a WRF file
+    """
+    match = _WRF_FNAME_RE.match(basename)
+    if match is None:
+        return None
+    model_run_dt = datetime.datetime.strptime(match.group('run'), '%Y-%m-%d_%H')
+    return WrfFilename(match.group('domain'), model_run_dt, match.group('lead'))
+
+
+def parse_model_run_dt(basename):
+    """Get the model run date and time from the filename of a WRF file
+
+    :param basename: str
+        the filename of the WRF file
+    :return: datetime.datetime
+        or None if the filename does not belong to a WRF file
+    """
+    fields = parse_wrf_fname(basename)
+    return None if fields is None else fields.model_run_dt
+
+
+def wrf_glob(domain):
+    """Get the glob pattern of the WRF files of a domain
+
+    :param domain: str
+        the WRF domain, e.g. d02
+    :return: str
+    """
+    return WRF_PREFIX + domain + '_*'
+
+
+def run_archive_fname(domain, model_run_dt):
+    """Get the filename of the run archive of a model run
+
+    :param domain: str
+        the WRF domain, e.g. d02
+    :param model_run_dt: datetime.datetime
+    :return: str
+    """
+    return model_run_dt.strftime(RUN_ARCHIVE_FORMAT.format(domain=domain))
+
+
+def run_archive_glob(domain):
+    """Get the glob pattern of the run archives of a domain
+
+    :param domain: str
+        the WRF domain, e.g. d02
+    :return: str
+    """
+    return RUN_ARCHIVE_PREFIX + domain + '_*'
+
+
+def parse_archive_fname(basename):
+    """Parse the filename of a run archive into its domain and model run
+
+    :param basename: str
+        the filename of the run archive
+    :return: tuple
+        containing the domain and the model run datetime,
+        or None if the filename does not belong to a run archive
+    """
+    match = _RUN_ARCHIVE_FNAME_RE.match(basename)
+    if match is None:
+        return None
+    return match.group('domain'), datetime.datetime.strptime(match.group('run'), '%Y-%m-%d_%H')
+
+
+def parse_archive_model_run_dt(basename):
+    """Get the model run date and time from the filename of a run archive
+
+    :param basename: str
+        the filename of the run archive
+    :return: datetime.datetime
+        or None if the filename does not belong to a run archive
+    """
+    fields = parse_archive_fname(basename)
+    return None if fields is None else fields[1]
@@ -0,0 +1,129 @@
+"""Fused kernels for the hottest part of the procedure.
+
+Getting from the RAINC and RAINNC variables of the last hour to the
+quantized accumulation and to the alerts would otherwise create a chain
+of full-grid temporaries (the sum, the intermediate float values, the
+validity masks, the comparison with the thresholds). Here the grid is
+processed in chunks of pixels, each one going through every step while
+it is in cache, using small buffers allocated once and numpy ufuncs with
+the out parameter.
+
+The results are bit-identical to the ones of Quantizer.encode followed
+by AlertExtractor.get_alerts, as the same float32 operations are applied
+in the same order.
+
+Only numpy is imported here.
+"""
+import numpy as np
+
+# the number of pixels processed at once, small enough for the buffers to stay in cache
+CHUNK_SIZE = 1 << 16
+
+
+def _threshold_chunk(accumul, land, steps, nodata, alerts):
+    """Compare the quantized accumulation of some land pixels with the thresholds
+
+    :param accumul: numpy.ndarray
+        the flat quantized accumulation
+    :param land: numpy.ndarray
+        the flat indices of the land pixels of the chunk
+    :param steps: numpy.ndarray
+        the thresholds of those pixels, in quantization steps
+    :param nodata: int
+        the quantized value reserved for NoData
+    :param alerts: numpy.ndarray
+        the flat alerts, updated in place
+    :return: None
+    """
+    values = accumul[land]
+    exceeded = np.greater(values, steps)
+    exceeded &= values != nodata
+    alerts[land] = exceeded
+
+
+def threshold_alerts(accumul, land, steps, nodata, alerts=None, chunk_size=CHUNK_SIZE):
+    """Get the alerts of the land pixels from the quantized accumulation
+
+    :param accumul: numpy.ndarray
+        the 2d quantized accumulation
+    :param land: numpy.ndarray
+        the sorted flat indices of the land pixels
+    :param steps: numpy.ndarray
+        the thresholds of the land pixels, in quantization steps
+    :param nodata: int
+        the quantized value reserved for NoData
+    :param alerts: numpy.ndarray
+        if provided, the 2d C-contiguous uint8 buffer where the alerts are stored
+    :param chunk_size: int
+        the number of land pixels processed at once
+    :return: numpy.ndarray
+        the 2d uint8 alerts, zero on the sea pixels
+    """
+    if alerts is None:
+        alerts = np.empty(accumul.shape, np.uint8)
+    alerts[...] = 0
+    flat, flat_alerts = accumul.ravel(), alerts.ravel()
+    for start in range(0, len(land), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        _threshold_chunk(flat, land[chunk], steps[chunk], nodata, flat_alerts)
+    return alerts
+
+
+def accumulate_alerts(rainc, rainnc, no_data, quantizer, land, steps, accumul=None, alerts=None,
+                      chunk_size=CHUNK_SIZE):
+    """Get the quantized accumulation and the alerts in a single pass
+
+    :param rainc: numpy.ndarray
+        the 2d RAINC values, not masked
+    :param rainnc: numpy.ndarray
+        the 2d RAINNC values, not masked
+    :param no_data: tuple
+        the NoData values of RAINC and RAINNC
+    :param quantizer: quantize.Quantizer
+        the compact representation of the precipitation values
+    :param land: numpy.ndarray
+        the sorted flat indices of the land pixels
+    :param steps: numpy.ndarray
+        the thresholds of the land pixels, in quantization steps
+    :param accumul: numpy.ndarray
+        if provided, the 2d C-contiguous buffer of quantizer dtype
+        where the accumulation is stored
+    :param alerts: numpy.ndarray
+        if provided, the 2d C-contiguous uint8 buffer where the alerts are stored
+    :param chunk_size: int
+        the number of pixels processed at once
+    :return: tuple
+        the quantized accumulation and the alerts, zero on the sea pixels
+    """
+    if accumul is None:
+        accumul = np.empty(rainc.shape, quantizer.dtype)
+    if alerts is None:
+        alerts = np.empty(rainc.shape, np.uint8)
+    alerts[...] = 0
+    flat_rainc, flat_rainnc = rainc.ravel(), rainnc.ravel()
+    flat_accumul, flat_alerts = accumul.ravel(), alerts.ravel()
+    size = flat_accumul.size
+    work = np.empty(min(chunk_size, size), np.float32)
+    invalid = np.empty(len(work), bool)
+    other = np.empty(len(work), bool)
+    # the land pixels of each chunk, as the land indices are sorted
+    bounds = np.searchsorted(land, np.arange(0, size + chunk_size, chunk_size))
+    for i, start in enumerate(range(0, size, chunk_size)):
+        stop = min(start + chunk_size, size)
+        n = stop - start
+        c, nc, w, inv, oth = flat_rainc[start:stop], flat_rainnc[start:stop], work[:n], invalid[:n], other[:n]
+        # the same steps of WrfItaAux.read_rain and Quantizer.encode
+        np.add(c, nc, out=w)
+        np.equal(c, no_data[0], out=inv)
+        np.equal(nc, no_data[1], out=oth)
+        inv |= oth
+        np.subtract(w, quantizer.offset, out=w, dtype=np.float32)
+        np.divide(w, quantizer.scale, out=w)
+        np.rint(w, out=w)
+        np.clip(w, *quantizer.valid_range, out=w)
+        out = flat_accumul[start:stop]
+        out[...] = w
+        out[inv] = quantizer.nodata
+        chunk = slice(bounds[i], bounds[i + 1])
+        _threshold_chunk(flat_accumul, land[chunk], steps[chunk], quantizer.nodata, flat_alerts)
+    return accumul, alerts
@@ -1,15 +1,105 @@
 """A module used for mirroring a SFTP file
 
-Export the MirrorSFTP especially conceived for the scope.
+Export the MirrorSFTP especially conceived for the scope, which
+shares an SFTPPool of connections among its downloads.
+
+In the in-memory mode the files are read into memory and appended
+to the run archives (see run_archive.RunArchive.append), without
+writing the hourly files to DATADIR unless keep_raw is set.
+
+The outputs of the latest model run can be published back to the
+SFTP: they are uploaded in parallel to a new folder, then the JSON file
+naming the folder of the latest model run is replaced with a single
+rename, so that the consumers following it never read the outputs of
+different model runs:
+    <publish folder>/<output subfolder>/<json file>
+    <publish folder>/<output subfolder>/<YYYYmmddHH>_<ns>/<outputs>
 """
 import os
-import configparser
+import io
+import re
+import json
+import time
+import posixpath
+import queue
 import datetime
+import threading
+import contextlib
+import concurrent.futures
 
 import pysftp
 
+from filenames import parse_wrf_fname
+from quantize import Quantizer
+from retention import apply_retention
+from run_archive import RunArchive
+from settings import get_settings
 from wrfita_aux import WrfItaAux
 
+# the remote folders of the published model runs, see MirrorSFTP.publish
+_VERSION_RE = re.compile(r'^\d{10}_\d+$')
+
+
+class SFTPPool:
+    """A pool of connections to the SFTP, shared by the threads downloading files
+
+    The connections are opened when first needed and reused afterwards.
+
+    Attributes:
+        size: int
+            the maximum number of connections open at the same time
+    """
+    def __init__(self, host, username, password, port, cnopts, size=4):
+        """
+        :param host: str
+            the hostname of the SFTP
+        :param username: str
+            the username of a valid account to the SFTP
+        :param password: str
+            the password of a valid account to the SFTP
+        :param port: int
+            the port of the SFTP
+        :param cnopts: pysftp.CnOpts
+            the options of the connections
+        :param size: int
+            the maximum number of connections open at the same time
+        """
+        self._params = dict(host=host, username=username, password=password, port=port, cnopts=cnopts)
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, waiting for one to be free if all of them are in use
+
+        A connection raising an error is closed instead of being reused.
+
+        :return: pysftp.Connection
+        """
+        with self._slots:
+            try:
+                sftp = self._idle.get_nowait()
+            except queue.Empty:
+                sftp = pysftp.Connection(**self._params)
+            try:
+                yield sftp
+            except Exception:
+                sftp.close()
+                raise
+            self._idle.put(sftp)
+
+    def close(self):
+        """Close the idle connections
+
+        :return: None
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
 
 class MirrorSFTP:
     """A class used for mirroring the content of the SFTP file
@@ -22,50 +112,77 @@ class MirrorSFTP:
             the username of a valid account to the SFTP
         PASSWORD: str
             the password of a valid account to the SFTP
+        PORT: int
+            the port of the SFTP
         remote_folder: str
             the name of the remote folder to be mirrored
         DATADIR: str
             the local folder used for mirroring the SFTP files
+        pool: SFTPPool
+            the connections to the SFTP
+        in_memory: bool
+            whether the files are ingested from memory into the run archives
+        keep_raw: bool
+            whether the files ingested from memory are written to DATADIR as well
+        publish_folder: str
+            the remote folder where the outputs are published, or None
     """
     def __init__(self):
         self.cnopts = pysftp.CnOpts()
         self.cnopts.hostkeys = None
         self.remote_folder = 'wrf'
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        self.HOST = config['SFTP']['HOST']
-        self.USER = config['SFTP']['USER']
-        self.PASSWORD = config['SFTP']['PASSWORD']
-        self.DATADIR = config['STRUCTURE']['DATADIR']
+        settings = get_settings()
+        self.HOST = settings.HOST
+        self.USER = settings.USER
+        self.PASSWORD = settings.PASSWORD
+        self.PORT = settings.PORT
+        self.DATADIR = settings.DATADIR
+        self.pool = SFTPPool(self.HOST, self.USER, self.PASSWORD, self.PORT, self.cnopts,
+                             settings.sftp['connections'])
+        self.in_memory = settings.sftp['in_memory']
+        self.keep_raw = settings.sftp['keep_raw']
+        self.publish_folder = settings.sftp['publish_folder']
 
     def list_today_sftp_files(self):
         """Prepare and return a list of filenames available remotely.
 
-        Only the filenames related to the model run
-        in the current day are given.
+        Only the filenames related to the model runs of the configured
+        domains and hours in the current day are given.
 
         :return: list
         """
         # TODO test this method
-        sftp_files = self.list_sftp_files()
-        file_prefix = datetime.date.today().strftime(WrfItaAux.FILENAME_FORMAT)[:-1]
-        return [sftp_file for sftp_file in sftp_files if sftp_file.startswith(file_prefix)]
+        settings = get_settings()
+        today = datetime.date.today()
+        sftp_files = []
+        for sftp_file in self.list_sftp_files():
+            fields = parse_wrf_fname(sftp_file)
+            if (fields is not None and fields.domain in settings.DOMAINS and fields.model_run_dt.date() == today
+                    and fields.model_run_dt.hour in settings.RUN_HOURS):
+                sftp_files.append(sftp_file)
+        return sftp_files
 
     def list_sftp_files(self):
         """Prepare and return a list of filenames available remotely
 
         :return: list
         """
-        with pysftp.Connection(self.HOST, username=self.USER, password=self.PASSWORD, cnopts=self.cnopts) as sftp:
+        with self.pool.connection() as sftp:
             filenames = sftp.listdir(self.remote_folder)
         return filenames
 
     def list_local_files(self):
         """Prepare and return a list of filenames available locally
 
+        The files appended to the run archives are included.
+
         :return: list
         """
-        return os.listdir(self.DATADIR)
+        filenames = os.listdir(self.DATADIR)
+        for domain in get_settings().DOMAINS:
+            for archive in RunArchive.from_dir(self.DATADIR, domain).values():
+                filenames.extend(archive.sources)
+        return filenames
 
     def id_missing_files(self):
         """Identify missing files locally
@@ -94,7 +211,7 @@ class MirrorSFTP:
         print('Saving {0} ...'.format(fname))
         for i in range(1, 4):
             print('    Attempt number ' + str(i))
-            with pysftp.Connection(self.HOST, username=self.USER, password=self.PASSWORD, cnopts=self.cnopts) as sftp:
+            with self.pool.connection() as sftp:
                 sftp.get(remotepath, localpath)
             try:
                 # verify that it is a valid netCDF4 file
@@ -124,34 +241,266 @@ class MirrorSFTP:
             self.get_file(fname)
         return 0
 
+    def read_file(self, fname):
+        """Download the given filename from the SFTP into memory
+        with a 3-attempts policy
+
+        :param fname: str
+            the name of file to be downloaded
+        :return: bytes
+            the content of the file, or None if all the attempts failed
+        """
+        remotepath = '/'.join([self.remote_folder, fname])
+        for i in range(1, 4):
+            buffer = io.BytesIO()
+            try:
+                with self.pool.connection() as sftp:
+                    sftp.getfo(remotepath, buffer)
+                return buffer.getvalue()
+            except Exception as exc:
+                print('The download attempt number {:d} of {} did not work, details below'.format(i, fname))
+                print(exc)
+        return None
+
+    def ingest_files(self, fnames):
+        """Download a number of files from the SFTP into the run archives
+
+        The files of each model run are downloaded in parallel over the
+        pooled connections, a batch at a time, and appended to the run
+        archive in order of forecast hour. The files are opened from
+        memory by this thread only, as the netCDF library is not
+        thread-safe. The hours following a failed download are left to
+        the next mirroring, as the archive cannot have gaps. The files
+        are written to DATADIR only with keep_raw.
+
+        :param fnames: iterable
+        :return: int
+            the number of files ingested
+        """
+        quantizer = Quantizer.from_settings(get_settings())
+        runs = {}
+        for fname in fnames:
+            fields = parse_wrf_fname(fname)
+            runs.setdefault((fields.domain, fields.model_run_dt), []).append((len(fields.lead), fields.lead, fname))
+        ingested = 0
+        with concurrent.futures.ThreadPoolExecutor(self.pool.size) as executor:
+            for (domain, model_run_dt), leads in sorted(runs.items()):
+                archive_abspath = RunArchive.abspath_for(self.DATADIR, model_run_dt, domain)
+                run_fnames = [fname for _, _, fname in sorted(leads)]
+                print('Ingesting ', len(run_fnames), ' files of model run ', domain, model_run_dt.isoformat(),
+                      ' --> ', archive_abspath)
+                try:
+                    for start in range(0, len(run_fnames), self.pool.size):
+                        batch = run_fnames[start:start + self.pool.size]
+                        for fname, content in zip(batch, executor.map(self.read_file, batch)):
+                            self._ingest(fname, content, archive_abspath, quantizer)
+                            ingested += 1
+                except ValueError as exc:
+                    print(exc)
+        self.pool.close()
+        print('\t', ingested, ' files ingested!')
+        return ingested
+
+    def _ingest(self, fname, content, archive_abspath, quantizer):
+        """Append a file downloaded into memory to its run archive
+
+        :param fname: str
+            the name of the file
+        :param content: bytes
+            the content of the file, None if the download failed
+        :param archive_abspath: str
+            the absolute path of the run archive
+        :param quantizer: Quantizer
+            the compact representation of the precipitation values
+        :return: None
+        :raise: ValueError
+            if the file cannot be appended, so that the next hours are not
+        """
+        if content is None:
+            raise ValueError('Download of ' + fname + ' failed, the next hours are left to the next mirroring')
+        # verify that it is a valid netCDF4 file
+        try:
+            measure = WrfItaAux(os.path.join(self.DATADIR, fname), memory=content)
+        except Exception as exc:
+            raise ValueError('Not a valid netCDF4 file ' + fname + ': ' + str(exc))
+        RunArchive.append(measure, archive_abspath, quantizer)
+        if self.keep_raw:
+            with open(measure.abspath + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(measure.abspath + '.tmp', measure.abspath)
+
     def get_missing_files(self):
         """Download a number of files from the SFTP.
 
-        In particular the files that are missing locally on disk.
+        In particular the files that are missing locally on disk,
+        or from the run archives in the in-memory mode.
 
         :return: 0
         """
-        self.get_files(self.id_missing_files())
+        if self.in_memory:
+            self.ingest_files(self.id_missing_files())
+        else:
+            self.get_files(self.id_missing_files())
         return 0
 
     def clean_workdir(self):
         """Clean working directory from old files.
 
-        Delete files that are older than the current day.
+        Evict the files of previous model runs according to the
+        retention policy, without listing the SFTP.
 
         :return: None
         """
-        local_fnames = set(self.list_local_files())
-        relevant_fnames = set(self.list_today_sftp_files())
-        to_be_deleted = local_fnames - relevant_fnames
-        for fname in to_be_deleted:
+        apply_retention(get_settings())
+
+    def output_files(self, domain=None, run_hour=None):
+        """Prepare and return a list of the outputs of a domain and model run hour
+
+        Only the outputs available locally are listed, the JSON file
+        containing the latest model run is not.
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :param run_hour: int
+            the hour of the model run (default is the first configured one)
+        :return: list
+            containing the absolute paths of the outputs
+        """
+        settings = get_settings()
+        out_dir = settings.output_dir(domain, run_hour)
+        fnames = []
+        for hours in sorted(settings.grid_thresholds_for(domain)):
+            for fname_format in (settings.ACCUMUL_FNAME, settings.ALERT_FNAME, settings.LEAD_TIME_FNAME,
+                                 settings.PROBABILITY_FNAME):
+                fnames.append(fname_format.format(hours=hours))
+        fnames.append(settings.ALERT_CHANGES_FNAME)
+        abspaths = [os.path.join(out_dir, fname) for fname in fnames]
+        return [abspath for abspath in abspaths if os.path.exists(abspath)]
+
+    def put_file(self, localpath, remotepath, content=None):
+        """Upload the given file to the SFTP with a 3-attempts policy
+
+        :param localpath: str
+            the absolute path of the file to be uploaded
+        :param remotepath: str
+            the path of the file on the SFTP
+        :param content: bytes
+            if provided, uploaded instead of the local file
+        :return: bool
+            True if successful, False if all the attempts failed
+        """
+        for i in range(1, 4):
             try:
-                os.remove(os.path.join(self.DATADIR, fname))
-                print('File removed: ', fname)
-            except IsADirectoryError:
-                try:
-                    os.rmdir(os.path.join(self.DATADIR, fname))
-                except:
-                    print('Cannot remove ' + fname)
-            except:
-                print('Cannot remove' + fname)
+                with self.pool.connection() as sftp:
+                    if content is None:
+                        sftp.put(localpath, remotepath)
+                    else:
+                        sftp.putfo(io.BytesIO(content), remotepath)
+                return True
+            except Exception as exc:
+                print('The upload attempt number {:d} of {} did not work, details below'.format(i, remotepath))
+                print(exc)
+        return False
+
+    @staticmethod
+    def _rename(sftp, src, dst):
+        """Rename a remote file, replacing the destination
+
+        The POSIX rename extension of OpenSSH replaces the destination
+        at once, otherwise the destination is removed first and is
+        missing for a moment.
+
+        :param sftp: pysftp.Connection
+        :param src: str
+            the remote path of the file
+        :param dst: str
+            the new remote path of the file
+        :return: None
+        """
+        try:
+            sftp.sftp_client.posix_rename(src, dst)
+        except IOError:
+            if sftp.exists(dst):
+                sftp.remove(dst)
+            sftp.rename(src, dst)
+
+    @staticmethod
+    def _remove_folder(sftp, remote_dir):
+        """Remove a remote folder of a published model run, with its files
+
+        :param sftp: pysftp.Connection
+        :param remote_dir: str
+            the remote path of the folder
+        :return: None
+        """
+        for fname in sftp.listdir(remote_dir):
+            sftp.remove(posixpath.join(remote_dir, fname))
+        sftp.rmdir(remote_dir)
+
+    def publish(self, domain=None, run_hour=None, keep=2):
+        """Publish the outputs of the latest model run of a domain and model run hour
+
+        The outputs are uploaded in parallel to a new remote folder over
+        the pooled connections, so that the publishing time is bounded by
+        the slowest file. Then, only if all the outputs were uploaded, the
+        JSON file naming the model run and its folder is uploaded to a
+        temporary name and renamed, which is the only change seen by the
+        consumers following it. The older folders are removed, except for
+        the last ones still being read by the consumers. Nothing is
+        published if the local outputs are replaced by another model run
+        while uploading, see procedure.start.
+        The outputs are published to the same subfolder of the remote
+        publish folder as the one of DATADIR where they are written.
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :param run_hour: int
+            the hour of the model run (default is the first configured one)
+        :param keep: int
+            the number of folders of model runs kept, including the new one
+        :return: int
+            0 if successful
+        """
+        settings = get_settings()
+        if not self.publish_folder:
+            raise ValueError('No publish folder in the configuration file')
+        model_run_dt = settings.read_ref_time(domain, run_hour)
+        if model_run_dt is None:
+            print('No model run processed yet, nothing to publish')
+            return 1
+        subdir = os.path.relpath(settings.output_dir(domain, run_hour), settings.DATADIR)
+        remote_dir = self.publish_folder if subdir == os.curdir else posixpath.join(
+            self.publish_folder, *subdir.split(os.sep))
+        # a new folder even when the model run is published again, as the current one may be in use
+        version = '{}_{:d}'.format(model_run_dt.strftime('%Y%m%d%H'), time.time_ns())
+        version_dir = posixpath.join(remote_dir, version)
+        localpaths = self.output_files(domain, run_hour)
+        remotepaths = [posixpath.join(version_dir, os.path.basename(localpath)) for localpath in localpaths]
+        print('Publishing ', len(localpaths), ' outputs of model run ', model_run_dt.isoformat(), ' --> ', version_dir)
+        with self.pool.connection() as sftp:
+            sftp.makedirs(version_dir)
+        with concurrent.futures.ThreadPoolExecutor(self.pool.size) as executor:
+            uploaded = list(executor.map(self.put_file, localpaths, remotepaths))
+        json_remotepath = posixpath.join(remote_dir, os.path.basename(settings.json_abspath(domain, run_hour)))
+        marker = json.dumps({'model_run': model_run_dt.isoformat(), 'folder': version}).encode()
+        # the outputs are replaced by procedure.start with the JSON file removed,
+        # if it changed while uploading they may belong to different model runs
+        replaced = settings.read_ref_time(domain, run_hour) != model_run_dt
+        if replaced:
+            print('The outputs were replaced by another model run while uploading')
+        if replaced or not all(uploaded) or not self.put_file(None, json_remotepath + '.tmp', marker):
+            print('Some outputs could not be uploaded, the model run is not published')
+            with contextlib.suppress(Exception), self.pool.connection() as sftp:
+                self._remove_folder(sftp, version_dir)
+            self.pool.close()
+            return 1
+        with self.pool.connection() as sftp:
+            # the consumers look for the folder of the new model run in the JSON file
+            self._rename(sftp, json_remotepath + '.tmp', json_remotepath)
+            versions = sorted(fname for fname in sftp.listdir(remote_dir) if _VERSION_RE.match(fname))
+            for old_version in versions[:-keep]:
+                if old_version != version:
+                    self._remove_folder(sftp, posixpath.join(remote_dir, old_version))
+        self.pool.close()
+        print('\tmodel run published!')
+        return 0
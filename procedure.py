@@ -1,97 +1,617 @@
-import configparser
+"""Main module of the procedure, to be run from the command line.
+
+The procedure is split in the subcommands listed below,
+run without subcommand to perform the whole daily procedure
+(mirror, process, publish if configured, and clean):
+    - mirror: download the files of the current model run from the SFTP
+    - ingest: pack the files of a complete model run into its run archive
+    - process: extract accumulations and alerts for the model runs
+      of the configured domains and hours, in parallel
+    - publish: upload the outputs of the latest model runs to the SFTP
+    - clean: evict the input files related to previous model runs
+    - backfill: process the model runs of a range of past days
+    - serve: answer point queries on the latest outputs over HTTP
+    - stations: extract the hourly precipitation at a list of stations
+    - climatology: reduce the archived model runs into candidate thresholds
+
+The heavy libraries (GDAL, netCDF4, numpy, pysftp) are imported
+only by the subcommands that need them, so that short scheduled
+tasks such as clean start quickly.
+"""
+import time
+_T0 = time.perf_counter()
+
+import argparse
+import concurrent.futures
+import contextlib
 import os
+import shutil
+import sys
+import tempfile
 import datetime
 import json
-import glob
-
-from time_serie import PrecipTimeSerie
-from manage_ftp import MirrorSFTP
-from alerts import AlertExtractor
-
-# read working dir and other congif from the configuration file
-config = configparser.ConfigParser()
-config.read('config.ini')
-DATADIR = config['STRUCTURE']['DATADIR']
-ACCUMUL_FNAME = config['Filename formats']['accumulated_rain']
-ALERT_FNAME = config['Filename formats']['alert']
-MODEL_RUN_REF_TIME = config['Filename formats']['model_run_ref_time']
-del config
-# define the absolute path on disk for the JSON file
-# containing the latest run of the module
-JSON_ABSFILEP = os.path.join(DATADIR, MODEL_RUN_REF_TIME)
-# recall the format of the WRF filename
-FILENAME_FORMAT = 'sft_rftm_rg_wrfita_aux_d02_%Y-%m-%d_00_*'
-
-
-def start(model_run_datetime=None):
+
+from retention import RunManifest, apply_retention
+from settings import get_settings
+
+# the prefix of the folders where the outputs of a model run are written before being moved in place
+STAGING_PREFIX = '.staging_'
+
+
+def start(model_run_datetime=None, out_dir=None, update_ref_time=True, domain=None, tile_size=None, workers=None,
+          record_use=True):
     """Perform the entire procedure for extracting the alerts.
 
-    For the 24-hours and 48-hours periods:
+    For each period with a grid threshold (e.g. 24 hours and 48 hours):
     - extract the accumulated precipitation values and save it to disk
     - generate the alerts related to extreme precipitation
       and save them to disk
 
-    The procedure run by default on the current date run,
+    The procedure run by default on the latest model run available,
     but can run for every model run date, if provided in input.
+    When the JSON file of the latest model run is updated, the changes
+    of the alerts since the previous model run are saved as well.
+    With a lagged ensemble of several model runs, the exceedance
+    probability of the thresholds is saved too, see ensemble.
+    If enabled, the accumulations and the alerts are also rendered as
+    web-map tiles from memory, except in the tiled processing and when
+    the JSON file is not updated, e.g. in backfill, as the tiles of the
+    latest model run are served.
+    The outputs are written to a staging folder and moved to the output
+    folder only once they are all written, so that a failure leaves the
+    outputs of the previous model run untouched. Likewise, the web-map
+    tiles are served only after the JSON file is written.
 
     :param model_run_datetime: datetime.datetime
         if provided, contains the date and time of the model run
-    :return: None
+    :param out_dir: str
+        if provided, the folder where outputs are written
+        (default is the output folder of the domain and model run hour)
+    :param update_ref_time: bool
+        whether to update the JSON file containing the latest model run
+    :param domain: str
+        the WRF domain to be processed (default is the first configured one)
+    :param tile_size: int
+        if provided, the grid is processed in tiles of this size
+        by a pool of worker processes, see tiling.process_tiled
+    :param workers: int
+        the number of worker processes of the tiled processing
+        (default is the number of CPUs)
+    :param record_use: bool
+        whether to record the use of the model run in the manifest of the
+        retention policy, which the caller does otherwise, see process_all
+    :return: datetime.datetime
+        the date and time of the model run processed
     """
+    from time_serie import PrecipTimeSerie
+    from alerts import AlertExtractor
+    from alert_diff import AlertState, publish_alert_changes, severity_grid
+
+    settings = get_settings()
+    if domain is None:
+        domain = settings.DOMAINS[0]
     # define duration for accumulation
-    duration_hours = (24, 48)
-    for duration_hour in duration_hours:
-        duration = datetime.timedelta(hours=duration_hour)
-        # create time serie instance
-        tsobj = PrecipTimeSerie.earliest_from_dir(DATADIR, model_run_datetime, duration)
-        # define the output absolute filename for the accumulated precipitation
-        oabspath = os.path.join(DATADIR, ACCUMUL_FNAME.format(hours=duration_hour))
-        # write the accumulated precipitation to disk
-        tsobj.accumul_to_tiff(oabspath)
-        # define the output absolute filename for the alerts file
-        alert_absfname = os.path.join(DATADIR, ALERT_FNAME.format(hours=duration_hour))
-        # extract alerts and save them to disk
-        AlertExtractor.from_serie(tsobj).save_alerts(alert_absfname)
-    # save model run timestamp
-    with open(JSON_ABSFILEP, 'w') as jf:
+    duration_hours = sorted(settings.grid_thresholds_for(domain))
+    tile_products = {}
+    staging_dir = tiles_version_dir = None
+    try:
+        if tile_size:
+            from tiling import process_tiled
+
+            tsobj = PrecipTimeSerie.earliest_from_dir(settings.DATADIR, model_run_datetime, domain=domain)
+            model_run_datetime = tsobj.measures[0].model_run_dt
+            if out_dir is None:
+                out_dir = settings.output_dir(domain, model_run_datetime.hour)
+                os.makedirs(out_dir, exist_ok=True)
+            staging_dir = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=out_dir)
+            severity = process_tiled(model_run_datetime, domain, staging_dir, tile_size, workers)
+            if settings.tiles['enabled']:
+                print('The web-map tiles are not rendered by the tiled processing')
+        else:
+            barrays = []
+            for duration_hour in duration_hours:
+                duration = datetime.timedelta(hours=duration_hour)
+                # create time serie instance
+                tsobj = PrecipTimeSerie.earliest_from_dir(settings.DATADIR, model_run_datetime, duration, domain)
+                # the same model run is used for all the periods
+                model_run_datetime = tsobj.measures[0].model_run_dt
+                if out_dir is None:
+                    out_dir = settings.output_dir(domain, model_run_datetime.hour)
+                    os.makedirs(out_dir, exist_ok=True)
+                if staging_dir is None:
+                    staging_dir = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=out_dir)
+                # extract alerts, together with the accumulated precipitation
+                extractor = AlertExtractor.from_serie(tsobj)
+                alerts_obj = extractor.get_alerts()
+                # define the output absolute filename for the accumulated precipitation
+                oabspath = os.path.join(staging_dir, settings.ACCUMUL_FNAME.format(hours=duration_hour))
+                # write the accumulated precipitation to disk
+                tsobj.accumul_to_tiff(oabspath)
+                # define the output absolute filename for the alerts file and save alerts to disk
+                alert_absfname = os.path.join(staging_dir, settings.ALERT_FNAME.format(hours=duration_hour))
+                alerts_obj.save2tiff(alert_absfname)
+                barrays.append(alerts_obj.masked_barray)
+                if settings.tiles['enabled'] and update_ref_time:
+                    from web_tiles import accumul_classes, alert_classes
+
+                    accumul_name = 'accumulated_{}h'.format(duration_hour)
+                    alerts_name = 'alerts_{}h'.format(duration_hour)
+                    tile_products[accumul_name] = accumul_classes(tsobj.accumul, tsobj.quantizer)
+                    tile_products[alerts_name] = alert_classes(alerts_obj.masked_barray)
+                # extract the lead times of the alerts and save them to disk
+                extractor.save_lead_times(os.path.join(staging_dir,
+                                                       settings.LEAD_TIME_FNAME.format(hours=duration_hour)))
+            severity = severity_grid(barrays)
+            if tile_products:
+                from web_tiles import render_version
+
+                # rendered from memory, but served only once the model run is the latest one
+                tiles_version_dir = render_version(tile_products, tsobj.geotransform,
+                                                   settings.tiles_dir(domain, model_run_datetime.hour),
+                                                   model_run_datetime,
+                                                   range(settings.tiles['min_zoom'], settings.tiles['max_zoom'] + 1),
+                                                   settings.tiles['workers'])
+        if settings.ensemble['members'] > 1:
+            from ensemble import LaggedEnsemble
+
+            # the exceedance probability of the thresholds among the latest model runs
+            ensemble = LaggedEnsemble.from_serie(tsobj)
+            for duration_hour in duration_hours:
+                probability = ensemble.get_probability(duration_hour)
+                probability.save2tiff(os.path.join(staging_dir, settings.PROBABILITY_FNAME.format(hours=duration_hour)))
+            ensemble.precache(duration_hours)
+            ensemble.prune()
+        if update_ref_time:
+            # compare the alerts with the ones of the previous model run, before replacing it
+            publish_alert_changes(settings,
+                                  AlertState.from_grid(domain, model_run_datetime, severity, tsobj.geotransform),
+                                  model_run_datetime.hour, os.path.join(staging_dir, settings.ALERT_CHANGES_FNAME))
+    except BaseException:
+        # the outputs of a model run are never mixed with the ones of another one
+        for folder in (staging_dir, tiles_version_dir):
+            if folder is not None:
+                shutil.rmtree(folder, ignore_errors=True)
+        raise
+    # save model run timestamp, if required, after all the outputs are in place
+    _commit_outputs(staging_dir, out_dir,
+                    settings.json_abspath(domain, model_run_datetime.hour) if update_ref_time else None,
+                    model_run_datetime)
+    if tiles_version_dir is not None:
+        from web_tiles import switch_version
+
+        switch_version(settings.tiles_dir(domain, model_run_datetime.hour), tiles_version_dir)
+        print('\ttiles published!')
+    # record the use of the model run, for the retention policy
+    if record_use:
+        RunManifest.from_settings(settings).touch(model_run_datetime)
+    return model_run_datetime
+
+
+def _commit_outputs(staging_dir, out_dir, json_abspath=None, model_run_dt=None):
+    """Move the outputs of a model run from their staging folder to the output folder
+
+    The JSON file containing the latest model run, if given, is removed
+    before any output is replaced and written again once they are all
+    in place, so that it never names a model run whose outputs are not
+    complete, see query_service and manage_ftp.MirrorSFTP.publish.
+
+    :param staging_dir: str
+        the folder where the outputs have been written
+    :param out_dir: str
+        the output folder
+    :param json_abspath: str
+        the JSON file containing the latest model run,
+        or None if it is not updated
+    :param model_run_dt: datetime.datetime
+        the date and time of the model run
+    :return: None
+    """
+    if json_abspath is not None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(json_abspath)
+    for fname in os.listdir(staging_dir):
+        os.replace(os.path.join(staging_dir, fname), os.path.join(out_dir, fname))
+    os.rmdir(staging_dir)
+    if json_abspath is not None:
         print('Writing json file with current model run datetime...')
-        json.dump(tsobj.measures[0].model_run_dt.isoformat(), jf)
+        with open(json_abspath + '.tmp', 'w') as jf:
+            json.dump(model_run_dt.isoformat(), jf)
+        os.replace(json_abspath + '.tmp', json_abspath)
         print('\tjson file written!')
 
 
-def clean_datadir():
+def clean_datadir(failed=()):
     """Clean local working directory.
 
-    In particular delete the files that are related to previous model runs.
+    In particular evict the files that are related to previous model runs,
+    according to the retention policy in the configuration file.
+    The latest processed model run is always kept.
 
+    :param failed: iterable
+        the (domain, model run datetime) combinations that failed,
+        whose files are kept as well, to be processed again
     :return: None
     """
-    with open(JSON_ABSFILEP, 'r') as jf:
-        latest_model_run_dt = datetime.datetime.strptime(json.load(jf)[:11], '%Y-%m-%dT')
-    to_keep = set(glob.glob(os.path.join(DATADIR, latest_model_run_dt.strftime(FILENAME_FORMAT))))
-    all = set(glob.glob(os.path.join(DATADIR, FILENAME_FORMAT[:-13] + '*')))
-    to_delete = all - to_keep
-    print('Deleting ',  len(to_delete), ' older input files...')
-    for absfname in to_delete:
-        try:
-            os.remove(absfname)
-        except:
-            print('Cannot remove file ', absfname, ' Please remove it manually.')
-    print('\tfiles deleted!')
+    evicted = apply_retention(get_settings(), [model_run_dt for _, model_run_dt in failed])
+    print('\t', len(evicted), ' older model runs evicted!')
 
 
-if __name__ == '__main__':
-    # STEP 1 mirroring the sftp site,
-    # by getting the files available for today
+def mirror():
+    """Mirror the SFTP site, by getting the files available for today.
+
+    :return: None
+    """
+    from manage_ftp import MirrorSFTP
+
     MirrorSFTP().get_missing_files()
-    # STEP 2 start the accumulation and alert calculation procedure
-    start()
-    # STEP 3 clean the local data directory from old files
-    clean_datadir()
+
+
+def publish(failed=()):
+    """Publish the outputs of the latest model runs to the SFTP.
+
+    The outputs of each configured domain and model run hour are
+    published to a new remote folder, named by the JSON file of the
+    latest model run, see manage_ftp.MirrorSFTP.publish.
+
+    :param failed: iterable
+        the (domain, model run datetime) combinations that failed,
+        whose outputs are not published
+    :return: None
+    """
+    from manage_ftp import MirrorSFTP
+
+    settings = get_settings()
+    skipped = {(domain, model_run_dt.hour) for domain, model_run_dt in failed}
+    mirror_obj = MirrorSFTP()
+    for domain in settings.DOMAINS:
+        for run_hour in settings.RUN_HOURS:
+            if (domain, run_hour) in skipped:
+                print('Skipping the outputs of the failed model run ', domain, run_hour)
+                continue
+            mirror_obj.publish(domain, run_hour)
+
+
+def ingest(model_run_datetime=None, domain=None):
+    """Pack the files of a complete model run into its run archive.
+
+    A model run is complete when it covers the longest accumulation
+    period with a grid threshold. Once packed, the model run
+    is read from its run archive, see run_archive.RunArchive,
+    and the hours downloaded later are appended to it.
+
+    :param model_run_datetime: datetime.datetime
+        if provided, contains the date and time of the model run
+        (default is the latest model run available)
+    :param domain: str
+        the WRF domain to be packed (default is the first configured one)
+    :return: None
+    """
+    import glob
+    from filenames import parse_model_run_dt, wrf_glob
+    from time_serie import PrecipTimeSerie
+    from run_archive import RunArchive
+    from wrfita_aux import WrfItaAux
+
+    settings = get_settings()
+    if domain is None:
+        domain = settings.DOMAINS[0]
+    tsobj = PrecipTimeSerie.earliest_from_dir(settings.DATADIR, model_run_datetime, domain=domain)
+    model_run_dt = tsobj.measures[0].model_run_dt
+    if tsobj.archive is not None:
+        # the hourly files of a packed model run are ignored, unless appended
+        archived = set(tsobj.archive.sources)
+        newer = sorted(WrfItaAux(abspath) for abspath in glob.glob(os.path.join(settings.DATADIR, wrf_glob(domain)))
+                       if os.path.basename(abspath) not in archived
+                       and parse_model_run_dt(os.path.basename(abspath)) == model_run_dt)
+        newer = [measure for measure in newer if measure.end_dt > tsobj.stop_dt]
+        appended = 0
+        for measure in newer:
+            try:
+                RunArchive.append(measure, tsobj.archive.abspath, tsobj.quantizer)
+            except ValueError as exc:
+                print('Model run ', domain, model_run_dt.isoformat(), ': ', exc)
+                break
+            appended += 1
+        print('Model run ', domain, model_run_dt.isoformat(), ' already packed, ', appended, ' hours appended')
+        return
+    if tsobj.duration < datetime.timedelta(hours=max(settings.grid_thresholds_for(domain))):
+        print('Model run ', domain, model_run_dt.isoformat(), ' not complete yet, not packed')
+        return
+    RunArchive.pack(tsobj, RunArchive.abspath_for(settings.DATADIR, model_run_dt, domain))
+
+
+def _process_run(domain, model_run_dt, pack, tile_size=None, workers=None):
+    """Process the model run of a domain, to be run in a worker process
+
+    :param domain: str
+        the WRF domain
+    :param model_run_dt: datetime.datetime
+        the date and time of the model run
+    :param pack: bool
+        whether to pack the model run into its run archive first
+    :param tile_size: int
+        if provided, the grid is processed in tiles of this size
+    :param workers: int
+        the number of worker processes of the tiled processing
+    :return: datetime.datetime
+        the date and time of the model run processed
+    """
+    if pack:
+        ingest(model_run_dt, domain)
+    return start(model_run_dt, domain=domain, tile_size=tile_size, workers=workers, record_use=False)
+
+
+def process_all(model_run_date=None, workers=None, pack=False, tile_size=None):
+    """Process the model runs of all the configured domains and hours.
+
+    Each combination of domain and model run hour is independent, so
+    that they are processed in parallel by a pool of worker processes,
+    each writing to the output folder of its domain and model run hour.
+    The combinations that cannot be processed (e.g. because the
+    model run is not available yet) are reported and skipped.
+    In the tiled mode the pool of worker processes is used by the
+    tiles of each combination instead, and the combinations are
+    processed one after the other. The use of the model runs processed
+    is recorded at the end, by this process only.
+
+    :param model_run_date: datetime.date
+        the date of the model runs (default is the current day)
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :param pack: bool
+        whether to pack each model run into its run archive first
+    :param tile_size: int
+        if provided, each grid is processed in tiles of this size
+    :return: list
+        the (domain, model run datetime) combinations that failed
+    """
+    settings = get_settings()
+    if model_run_date is None:
+        model_run_date = datetime.date.today()
+    runs = [(domain, datetime.datetime.combine(model_run_date, datetime.time(run_hour)))
+            for domain in settings.DOMAINS for run_hour in settings.RUN_HOURS]
+    failed = []
+    used = []
+    if len(runs) == 1 or tile_size:
+        for domain, model_run_dt in runs:
+            try:
+                used.append(_process_run(domain, model_run_dt, pack, tile_size, workers))
+            except Exception as exc:
+                print('Cannot process model run ', domain, model_run_dt.isoformat(), ': ', exc)
+                failed.append((domain, model_run_dt))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_process_run, domain, model_run_dt, pack): (domain, model_run_dt)
+                       for domain, model_run_dt in runs}
+            for future in concurrent.futures.as_completed(futures):
+                domain, model_run_dt = futures[future]
+                try:
+                    used.append(future.result())
+                    print('Model run ', domain, model_run_dt.isoformat(), ' processed')
+                except Exception as exc:
+                    print('Cannot process model run ', domain, model_run_dt.isoformat(), ': ', exc)
+                    failed.append((domain, model_run_dt))
+    # record the use of the model runs, for the retention policy
+    if used:
+        RunManifest.from_settings(settings).touch(*used)
+    return failed
+
+
+def backfill(first_date, last_date=None):
+    """Process the model runs of a range of past days.
+
+    The outputs of each domain and model run are written to a dedicated
+    subfolder of DATADIR, named after the domain and the model run date,
+    and the JSON file containing the latest model run is left untouched.
+
+    :param first_date: datetime.date
+        the date of the first model run to be processed
+    :param last_date: datetime.date
+        the date of the last model run to be processed
+        (default is first_date)
+    :return: None
+    """
+    settings = get_settings()
+    if last_date is None:
+        last_date = first_date
+    day = first_date
+    while day <= last_date:
+        for domain in settings.DOMAINS:
+            for run_hour in settings.RUN_HOURS:
+                model_run_dt = datetime.datetime.combine(day, datetime.time(run_hour))
+                out_dir = os.path.join(settings.DATADIR, 'backfill',
+                                       domain + '_' + model_run_dt.strftime('%Y-%m-%d_%H'))
+                os.makedirs(out_dir, exist_ok=True)
+                print('Backfilling model run ', domain, model_run_dt.isoformat())
+                try:
+                    start(model_run_dt, out_dir, update_ref_time=False, domain=domain)
+                except Exception as exc:
+                    print('Cannot process model run ', domain, model_run_dt.isoformat(), ': ', exc)
+        day += datetime.timedelta(days=1)
+
+
+def serve(host=None, port=None, socket_path=None):
+    """Answer point queries on the latest outputs, until interrupted.
+
+    :param host: str
+        the address to listen on (default is the one in the configuration file)
+    :param port: int
+        the port to listen on (default is the one in the configuration file)
+    :param socket_path: str
+        if provided, the Unix socket to listen on instead
+    :return: None
+    """
+    from query_service import QueryService
+
+    QueryService().serve_forever(host, port, socket_path)
+
+
+def stations(csv_abspath, out_abspath, model_run_datetime=None, domain=None):
+    """Extract the hourly precipitation of a model run at a list of stations.
+
+    :param csv_abspath: str
+        the CSV file of the stations, with the id, lat and lon columns
+    :param out_abspath: str
+        the output file, a CSV table or a numpy .npz archive
+    :param model_run_datetime: datetime.datetime
+        if provided, contains the date and time of the model run
+        (default is the latest model run available)
+    :param domain: str
+        the WRF domain (default is the first configured one)
+    :return: None
+    """
+    from time_serie import PrecipTimeSerie, read_stations
+
+    tsobj = PrecipTimeSerie.earliest_from_dir(get_settings().DATADIR, model_run_datetime, domain=domain)
+    tsobj.stations_to_file(read_stations(csv_abspath), os.path.abspath(out_abspath))
+
+
+def climatology(first_date=None, last_date=None, domain=None, out_dir=None, workers=None):
+    """Reduce the archived model runs of a domain into candidate threshold rasters.
+
+    :param first_date: datetime.date
+        if provided, the day of the first model run
+    :param last_date: datetime.date
+        if provided, the day of the last model run
+    :param domain: str
+        the WRF domain (default is the first configured one)
+    :param out_dir: str
+        the folder where outputs are written (default is the configured one)
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :return: None
+    """
+    from climatology import build_climatology
+
+    build_climatology(domain, out_dir=out_dir, first_date=first_date, last_date=last_date, workers=workers)
+
+
+def _parse_date(text):
+    """Parse a date given on the command line in the YYYY-MM-DD format
+
+    :param text: str
+    :return: datetime.date
+    """
+    return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def _parse_args(argv=None):
+    """Parse the command line arguments
+
+    :param argv: list
+        the arguments to be parsed (default is sys.argv[1:])
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Generate forecasted alerts for extreme-precipitation events.')
+    parser.add_argument('--timings', action='store_true', help='print the startup and execution times')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('mirror', help='download the files of the current model run from the SFTP')
+    ingest_parser = subparsers.add_parser('ingest', help='pack the files of a complete model run into its archive')
+    ingest_parser.add_argument('--date', type=_parse_date, default=None,
+                               help='the date of the model run, as YYYY-MM-DD (default is the latest)')
+    ingest_parser.add_argument('--run-hour', type=int, default=None,
+                               help='the hour of the model run (default is the first configured one)')
+    ingest_parser.add_argument('--domain', default=None, help='the WRF domain (default is the first configured one)')
+    process_parser = subparsers.add_parser('process', help='extract accumulations and alerts for the model runs')
+    process_parser.add_argument('--date', type=_parse_date, default=None,
+                                help='the date of the model runs, as YYYY-MM-DD (default is today)')
+    process_parser.add_argument('--workers', type=int, default=None,
+                                help='the number of worker processes (default is the number of CPUs)')
+    process_parser.add_argument('--tile-size', type=int, default=None,
+                                help='process the grid in square tiles of this number of pixels, with bounded memory')
+    subparsers.add_parser('publish', help='upload the outputs of the latest model runs to the SFTP')
+    subparsers.add_parser('clean', help='evict the input files related to previous model runs')
+    backfill_parser = subparsers.add_parser('backfill', help='process the model runs of a range of past days')
+    backfill_parser.add_argument('first_date', type=_parse_date, help='the first day, as YYYY-MM-DD')
+    backfill_parser.add_argument('last_date', type=_parse_date, nargs='?', default=None,
+                                 help='the last day, as YYYY-MM-DD (default is the first day)')
+    stations_parser = subparsers.add_parser('stations', help='extract the hourly precipitation at a list of stations')
+    stations_parser.add_argument('stations_csv', help='the CSV file of the stations, with id, lat and lon columns')
+    stations_parser.add_argument('output', help='the output file, a CSV table or a .npz archive')
+    stations_parser.add_argument('--date', type=_parse_date, default=None,
+                                 help='the date of the model run, as YYYY-MM-DD (default is the latest)')
+    stations_parser.add_argument('--run-hour', type=int, default=None,
+                                 help='the hour of the model run (default is the first configured one)')
+    stations_parser.add_argument('--domain', default=None, help='the WRF domain (default is the first configured one)')
+    serve_parser = subparsers.add_parser('serve', help='answer point queries on the latest outputs over HTTP')
+    serve_parser.add_argument('--host', default=None, help='the address to listen on (default from config.ini)')
+    serve_parser.add_argument('--port', type=int, default=None, help='the port to listen on (default from config.ini)')
+    serve_parser.add_argument('--socket', default=None, help='the Unix socket to listen on instead of host and port')
+    climatology_parser = subparsers.add_parser('climatology',
+                                               help='reduce the archived model runs into candidate thresholds')
+    climatology_parser.add_argument('--first-date', type=_parse_date, default=None,
+                                    help='the day of the first model run, as YYYY-MM-DD (default is the earliest)')
+    climatology_parser.add_argument('--last-date', type=_parse_date, default=None,
+                                    help='the day of the last model run, as YYYY-MM-DD (default is the latest)')
+    climatology_parser.add_argument('--domain', default=None,
+                                    help='the WRF domain (default is the first configured one)')
+    climatology_parser.add_argument('--output', default=None, help='the output folder (default from config.ini)')
+    climatology_parser.add_argument('--workers', type=int, default=None,
+                                    help='the number of worker processes (default is the number of CPUs)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the subcommand given on the command line
+
+    :param argv: list
+        the arguments to be parsed (default is sys.argv[1:])
+    :return: int
+        the exit status, 1 if some model runs could not be processed
+    """
+    args = _parse_args(argv)
+    failed = []
+    if args.timings:
+        print('Startup completed in {:.3f} s'.format(time.perf_counter() - _T0))
+    if args.command == 'mirror':
+        mirror()
+    elif args.command in ('ingest', 'stations'):
+        model_run_dt = None
+        if args.date is not None:
+            run_hour = get_settings().RUN_HOURS[0] if args.run_hour is None else args.run_hour
+            model_run_dt = datetime.datetime.combine(args.date, datetime.time(run_hour))
+        if args.command == 'ingest':
+            ingest(model_run_dt, args.domain)
+        else:
+            stations(args.stations_csv, args.output, model_run_dt, args.domain)
+    elif args.command == 'process':
+        failed = process_all(args.date, args.workers, tile_size=args.tile_size)
+    elif args.command == 'publish':
+        publish()
+    elif args.command == 'clean':
+        clean_datadir()
+    elif args.command == 'backfill':
+        backfill(args.first_date, args.last_date)
+    elif args.command == 'serve':
+        serve(args.host, args.port, args.socket)
+    elif args.command == 'climatology':
+        climatology(args.first_date, args.last_date, args.domain, args.output, args.workers)
+    else:
+        # STEP 1 mirroring the sftp site,
+        # by getting the files available for today
+        mirror()
+        # STEP 2 pack the model runs, if complete, into their run archives
+        # and start the accumulation and alert calculation procedure
+        failed = process_all(pack=True)
+        # STEP 3 publish the outputs to the SFTP, if configured,
+        # except the ones of the model runs that failed
+        if get_settings().sftp['publish_folder']:
+            publish(failed)
+        # STEP 4 clean the local data directory from old files,
+        # keeping the ones of the model runs that failed
+        clean_datadir(failed)
+    if args.timings:
+        print('Completed in {:.3f} s'.format(time.perf_counter() - _T0))
+    if failed:
+        print(len(failed), ' model runs could not be processed')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
 
     ## ALTERNATIVELY
-    ## for testing purposes you can impose the model run date, as done below.
-    ## This allows to use old available data on disk, avoiding the download step.
-    # model_run_dt = datetime.datetime(2020, 6, 5)
-    ## Then start the process with that specific date
-    # start(model_run_dt)
+    ## for testing purposes you can process an old model run,
+    ## using old available data on disk and avoiding the download step:
+    # python3 procedure.py process --date 2020-06-05
@@ -0,0 +1,155 @@
+"""Define a class for storing precipitation values in a compact form.
+
+Precipitation values (in millimetres) are stored as unsigned integers
+according to:
+    value = quantized * scale + offset
+with one integer value reserved for NoData.
+"""
+import numpy as np
+
+# GDAL data type names of the supported integer types
+GDAL_TYPE_NAMES = {'uint8': 'Byte', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32'}
+
+
+class Quantizer:
+    """A class for encoding and decoding quantized precipitation values
+
+    Attributes:
+        dtype: numpy.dtype
+            the integer type of the quantized values
+        scale: float
+            the precipitation amount of one quantization step
+        offset: float
+            the precipitation amount corresponding to the quantized zero
+        nodata: int
+            the quantized value reserved for NoData
+    """
+    def __init__(self, dtype='uint16', scale=0.1, offset=0.0, nodata=None):
+        """
+        :param dtype: str
+            the name of the integer type of the quantized values
+        :param scale: float
+            the precipitation amount of one quantization step
+        :param offset: float
+            the precipitation amount corresponding to the quantized zero
+        :param nodata: int
+            the quantized value reserved for NoData
+            (default is the maximum value of dtype)
+        :raise: ValueError
+            if the type is not supported or the scale is not positive
+        """
+        if dtype not in GDAL_TYPE_NAMES:
+            raise ValueError('Unsupported quantization type: ' + str(dtype))
+        if scale <= 0:
+            raise ValueError('The quantization scale must be positive')
+        self.dtype = np.dtype(dtype)
+        self.scale = float(scale)
+        self.offset = float(offset)
+        info = np.iinfo(self.dtype)
+        self.nodata = info.max if nodata is None else int(nodata)
+        if not info.min <= self.nodata <= info.max:
+            raise ValueError('The NoData value does not fit the quantization type')
+        # the range of valid quantized values, excluding NoData
+        self._qmin = info.min + 1 if self.nodata == info.min else info.min
+        self._qmax = info.max - 1 if self.nodata == info.max else info.max
+
+    def __eq__(self, other):
+        """Compare the current Quantizer object with another.
+
+        Return true if both objects give the same quantized values.
+
+        :param other: Quantizer
+            the other object in comparison
+        :return: bool
+        """
+        if not isinstance(other, Quantizer):
+            return NotImplemented
+        return ((self.dtype, self.scale, self.offset, self.nodata) ==
+                (other.dtype, other.scale, other.offset, other.nodata))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Alternate constructor based on the configuration of the procedure
+
+        :param settings: settings.Settings
+        :return: Quantizer
+        """
+        return cls(**settings.quantization)
+
+    @property
+    def gdal_type_name(self):
+        """Get the name of the GDAL data type matching dtype
+
+        :return: str
+        """
+        return GDAL_TYPE_NAMES[self.dtype.name]
+
+    @property
+    def valid_range(self):
+        """Get the lowest and the highest quantized values, excluding NoData
+
+        :return: tuple
+        """
+        return self._qmin, self._qmax
+
+    def encode(self, values, valid=None, out=None, work=None):
+        """Quantize precipitation values, rounding to the nearest step
+
+        Values out of the representable range are clipped,
+        masked or not-valid values are set to NoData.
+
+        :param values: numpy.ndarray
+            the precipitation values, possibly a masked array
+        :param valid: numpy.ndarray
+            if provided, a boolean array that is False where values
+            are NoData
+        :param out: numpy.ndarray
+            if provided, the array of dtype type where the result is stored
+        :param work: numpy.ndarray
+            if provided, a float32 buffer used for intermediate results,
+            it can be values itself, which is then overwritten
+        :return: numpy.ndarray
+        """
+        if np.ma.isMaskedArray(values):
+            invalid = np.ma.getmaskarray(values)
+            values = values.data
+        else:
+            invalid = None
+        steps = np.subtract(values, self.offset, out=work, dtype=np.float32)
+        np.divide(steps, self.scale, out=steps)
+        np.rint(steps, out=steps)
+        np.clip(steps, self._qmin, self._qmax, out=steps)
+        if out is None:
+            out = np.empty(steps.shape, self.dtype)
+        out[...] = steps
+        if invalid is not None:
+            out[invalid] = self.nodata
+        if valid is not None:
+            out[~valid] = self.nodata
+        return out
+
+    def decode(self, qvalues):
+        """Convert quantized values back to precipitation values
+
+        :param qvalues: numpy.ndarray
+            the quantized values
+        :return: numpy.ma.MaskedArray
+            of float32 type, masked where values are NoData
+        """
+        values = qvalues.astype(np.float32)
+        values *= self.scale
+        values += self.offset
+        return np.ma.masked_array(values, qvalues == self.nodata)
+
+    def to_steps(self, values):
+        """Express precipitation amounts in quantization steps
+
+        Values are not rounded, so that comparing quantized values
+        with the result gives the same outcome of comparing the
+        decoded values with the precipitation amounts.
+
+        :param values: numpy.ndarray or float
+            the precipitation amounts
+        :return: numpy.ndarray or float
+        """
+        return (np.asarray(values, dtype=np.float64) - self.offset) / self.scale
@@ -0,0 +1,380 @@
+"""A local HTTP service answering point queries on the latest outputs.
+
+The accumulation, alert and lead time rasters of the latest model run
+of each domain (the one in the JSON file containing the latest model
+run) are read once into memory, so that each query is answered by
+converting the coordinates to a pixel through the geotransform and
+indexing the arrays, without opening any file.
+
+A background thread polls the JSON files and, when a new model run
+has been processed, loads its rasters and swaps them in with a single
+assignment, so that every query is answered from a complete model run.
+
+The service answers the requests below with JSON documents:
+    - GET /point?lat=<lat>&lon=<lon>[&domain=<domain>]
+    - POST /points with a body like {"points": [[lat, lon], ...], "domain": ...}
+    - GET /status
+"""
+import http.server
+import json
+import os
+import socketserver
+import threading
+import urllib.parse
+
+import numpy as np
+from osgeo import gdal
+
+from settings import get_settings
+
+# the attempts to load the outputs of a model run that keep being replaced while loading
+LOAD_ATTEMPTS = 3
+
+
+class RunSnapshot:
+    """The outputs of a model run of a domain, held in memory
+
+    Attributes:
+        domain: str
+            the WRF domain
+        model_run_dt: datetime.datetime
+            the date and time of the model run
+        geotransform: tuple
+            the affine geotransform coefficients shared by the rasters
+        shape: tuple
+            the number of rows and columns shared by the rasters
+        rasters: dict
+            by duration in hours, the quantized accumulation with its
+            scale, offset and NoData value, the alerts and the lead times
+    """
+    def __init__(self, domain, model_run_dt, geotransform, shape, rasters):
+        """
+        :param domain: str
+            the WRF domain
+        :param model_run_dt: datetime.datetime
+            the date and time of the model run
+        :param geotransform: tuple
+            the affine geotransform coefficients shared by the rasters
+        :param shape: tuple
+            the number of rows and columns shared by the rasters
+        :param rasters: dict
+            by duration in hours, a dict with the accumul, scale, offset,
+            nodata, alerts and lead_times keys
+        """
+        self.domain = domain
+        self.model_run_dt = model_run_dt
+        self.geotransform = geotransform
+        self.shape = shape
+        self.rasters = rasters
+
+    @classmethod
+    def load(cls, settings, domain, run_hour):
+        """Alternate constructor reading the latest outputs of a domain and model run hour
+
+        :param settings: settings.Settings
+        :param domain: str
+            the WRF domain
+        :param run_hour: int
+            the hour of the model run
+        :return: RunSnapshot
+            or None if no model run has been processed yet
+        """
+        model_run_dt = settings.read_ref_time(domain, run_hour)
+        if model_run_dt is None:
+            return None
+        out_dir = settings.output_dir(domain, run_hour)
+        geotransform = shape = None
+        rasters = {}
+        for hours in sorted(settings.grid_thresholds_for(domain)):
+            ds = gdal.Open(os.path.join(out_dir, settings.ACCUMUL_FNAME.format(hours=hours)), gdal.GA_ReadOnly)
+            band = ds.GetRasterBand(1)
+            geotransform = ds.GetGeoTransform()
+            rasters[hours] = {'accumul': band.ReadAsArray(),
+                              'scale': band.GetScale() or 1.0,
+                              'offset': band.GetOffset() or 0.0,
+                              'nodata': band.GetNoDataValue()}
+            shape = rasters[hours]['accumul'].shape
+            for key, fname in (('alerts', settings.ALERT_FNAME), ('lead_times', settings.LEAD_TIME_FNAME)):
+                ds = gdal.Open(os.path.join(out_dir, fname.format(hours=hours)), gdal.GA_ReadOnly)
+                rasters[hours][key] = ds.GetRasterBand(1).ReadAsArray()
+        return cls(domain, model_run_dt, geotransform, shape, rasters)
+
+    def pixels(self, lats, lons):
+        """Convert coordinates to the pixels of the rasters
+
+        :param lats: numpy.ndarray
+            the latitudes of the points
+        :param lons: numpy.ndarray
+            the longitudes of the points
+        :return: tuple
+            the rows and columns of the points and a boolean array
+            which is False for the points out of the rasters
+        """
+        gt = self.geotransform
+        rows = np.floor((np.asarray(lats, np.float64) - gt[3]) / gt[5]).astype(np.intp)
+        cols = np.floor((np.asarray(lons, np.float64) - gt[0]) / gt[1]).astype(np.intp)
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        return np.where(inside, rows, 0), np.where(inside, cols, 0), inside
+
+    def query(self, lats, lons):
+        """Get the accumulations, alerts and lead times at some points
+
+        :param lats: sequence
+            the latitudes of the points
+        :param lons: sequence
+            the longitudes of the points
+        :return: list
+            a dict for each point, the values are None for
+            the points out of the rasters and for NoData
+        """
+        rows, cols, inside = self.pixels(lats, lons)
+        values = {}
+        for hours, raster in self.rasters.items():
+            accumul = raster['accumul'][rows, cols]
+            rain = accumul * raster['scale'] + raster['offset']
+            valid = inside & (accumul != raster['nodata'])
+            values[hours] = (rain, valid, raster['alerts'][rows, cols], raster['lead_times'][rows, cols])
+        results = []
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            result = {'lat': lat, 'lon': lon, 'domain': self.domain,
+                      'model_run': self.model_run_dt.isoformat(), 'accumulations': {}}
+            for hours, (rain, valid, alerts, lead_times) in values.items():
+                result['accumulations'][str(hours)] = {
+                    'rain_mm': round(float(rain[i]), 3) if valid[i] else None,
+                    'alert': bool(alerts[i]) if inside[i] else None,
+                    'lead_time': int(lead_times[i]) if inside[i] and alerts[i] else None}
+            results.append(result)
+        return results
+
+
+class QueryService:
+    """The latest outputs of every domain, hot-swapped when a new model run is processed
+
+    Attributes:
+        settings: settings.Settings
+        poll_seconds: float
+            the interval between two checks of the JSON files
+        snapshots: dict
+            the RunSnapshot of the latest model run, by domain
+    """
+    def __init__(self, settings=None, poll_seconds=None):
+        """
+        :param settings: settings.Settings
+            (default is the shared one)
+        :param poll_seconds: float
+            the interval between two checks of the JSON files
+            (default is the one in the configuration file)
+        """
+        self.settings = get_settings() if settings is None else settings
+        self.poll_seconds = self.settings.service['poll_seconds'] if poll_seconds is None else poll_seconds
+        self.snapshots = {}
+        self._stop = threading.Event()
+
+    def refresh(self):
+        """Load the model runs processed since the last check
+
+        The new snapshots are prepared aside and published with a single
+        assignment, so that concurrent queries never see partial outputs.
+
+        :return: bool
+            True if a new model run has been loaded
+        """
+        snapshots = dict(self.snapshots)
+        changed = False
+        for domain in self.settings.DOMAINS:
+            latest = snapshots.get(domain)
+            for run_hour in self.settings.RUN_HOURS:
+                snapshot = self._load_newer(domain, run_hour, latest)
+                if snapshot is not None:
+                    latest = snapshot
+                    changed = True
+            if latest is not None:
+                snapshots[domain] = latest
+        if changed:
+            self.snapshots = snapshots
+            print('Serving model runs ', {domain: s.model_run_dt.isoformat() for domain, s in snapshots.items()})
+        return changed
+
+    def _load_newer(self, domain, run_hour, latest=None):
+        """Load the outputs of a domain and model run hour, if newer than the ones loaded
+
+        The outputs are replaced by procedure.start while the JSON file
+        containing the latest model run is missing, so they are taken
+        only if the JSON file names the same model run before and after
+        loading them, otherwise they are loaded again.
+
+        :param domain: str
+            the WRF domain
+        :param run_hour: int
+            the hour of the model run
+        :param latest: RunSnapshot
+            the latest model run of the domain loaded so far, if any
+        :return: RunSnapshot
+            or None if there is no newer model run, or if its outputs
+            could not be loaded consistently
+        """
+        for _ in range(LOAD_ATTEMPTS):
+            model_run_dt = self.settings.read_ref_time(domain, run_hour)
+            if model_run_dt is None or (latest is not None and model_run_dt <= latest.model_run_dt):
+                return None
+            try:
+                snapshot = RunSnapshot.load(self.settings, domain, run_hour)
+            except Exception as exc:
+                # e.g. the outputs are being replaced by a newer model run
+                print('Cannot load model run ', domain, model_run_dt.isoformat(), ': ', exc)
+                continue
+            if snapshot is not None and snapshot.model_run_dt == model_run_dt and \
+                    self.settings.read_ref_time(domain, run_hour) == model_run_dt:
+                return snapshot
+            print('The outputs of model run ', domain, model_run_dt.isoformat(), ' changed while loading')
+        return None
+
+    def _poll(self):
+        """Refresh the snapshots until the service is stopped
+
+        :return: None
+        """
+        while not self._stop.wait(self.poll_seconds):
+            self.refresh()
+
+    def query(self, points, domain=None):
+        """Get the accumulations, alerts and lead times at some points
+
+        :param points: list
+            of (lat, lon) pairs
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :return: list
+            a dict for each point
+        :raise: LookupError
+            if no model run of the domain has been loaded
+        """
+        domain = self.settings.DOMAINS[0] if domain is None else domain
+        snapshot = self.snapshots.get(domain)
+        if snapshot is None:
+            raise LookupError('No model run available for the domain ' + domain)
+        lats = [float(lat) for lat, lon in points]
+        lons = [float(lon) for lat, lon in points]
+        return snapshot.query(lats, lons)
+
+    def status(self):
+        """Get the model run being served for each domain
+
+        :return: dict
+        """
+        return {domain: snapshot.model_run_dt.isoformat() for domain, snapshot in self.snapshots.items()}
+
+    def serve_forever(self, host=None, port=None, socket_path=None):
+        """Answer the queries until interrupted
+
+        :param host: str
+            the address to listen on (default is the one in the configuration file)
+        :param port: int
+            the port to listen on (default is the one in the configuration file)
+        :param socket_path: str
+            if provided, the Unix socket to listen on instead
+        :return: None
+        """
+        self.refresh()
+        poller = threading.Thread(target=self._poll, daemon=True)
+        poller.start()
+        socket_path = socket_path or self.settings.service['socket']
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = _UnixHTTPServer(socket_path, _QueryHandler)
+            print('Serving point queries on ', socket_path)
+        else:
+            address = (host or self.settings.service['host'], port or self.settings.service['port'])
+            server = http.server.ThreadingHTTPServer(address, _QueryHandler)
+            print('Serving point queries on ', address)
+        server.service = self
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            server.server_close()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """An HTTP server listening on a Unix socket"""
+    daemon_threads = True
+
+
+class _QueryHandler(http.server.BaseHTTPRequestHandler):
+    """Answer the point queries with the QueryService of the server"""
+
+    def address_string(self):
+        """Get the address of the client, for logging
+
+        The address of a Unix socket client is an empty string.
+
+        :return: str
+        """
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send_json(self, code, document):
+        """Send a response with a JSON document
+
+        :param code: int
+            the HTTP status code
+        :param document: object
+            the document to be serialized
+        :return: None
+        """
+        body = json.dumps(document).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, points, domain):
+        """Send the values at some points, or the error
+
+        :param points: list
+            of (lat, lon) pairs
+        :param domain: str
+            the WRF domain, or None
+        :return: None
+        """
+        try:
+            self._send_json(200, self.server.service.query(points, domain))
+        except LookupError as exc:
+            self._send_json(503, {'error': str(exc)})
+        except (TypeError, ValueError) as exc:
+            self._send_json(400, {'error': str(exc)})
+
+    def do_GET(self):
+        """Answer the /point and /status requests"""
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        if url.path == '/status':
+            self._send_json(200, self.server.service.status())
+        elif url.path == '/point':
+            if 'lat' not in params or 'lon' not in params:
+                self._send_json(400, {'error': 'The lat and lon parameters are required'})
+                return
+            domain = params.get('domain', [None])[0]
+            self._answer([(params['lat'][0], params['lon'][0])], domain)
+        else:
+            self._send_json(404, {'error': 'Unknown path ' + url.path})
+
+    def do_POST(self):
+        """Answer the /points requests"""
+        if urllib.parse.urlsplit(self.path).path != '/points':
+            self._send_json(404, {'error': 'Unknown path ' + self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self._send_json(400, {'error': 'The body is not a valid JSON document'})
+            return
+        if isinstance(request, list):
+            request = {'points': request}
+        if not isinstance(request, dict):
+            self._send_json(400, {'error': 'The body must contain a list of points'})
+            return
+        self._answer(request.get('points', []), request.get('domain'))
@@ -0,0 +1,188 @@
+"""Define a class for resampling rasters onto the WRF grid.
+
+The threshold and mask rasters may differ from the WRF grid in
+resolution, extent or orientation. A nearest-neighbour index mapping
+the source pixels onto the target pixels is computed once per pair of
+grids from their geotransforms, stored on disk and then applied with
+fancy indexing, which is far cheaper than warping the rasters each run.
+
+Only north-up (or south-up) grids are supported, i.e. geotransforms
+without rotation terms, so that the index is separable into one
+source row per target row and one source column per target column.
+"""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def write_cache_file(abspath, write):
+    """Write a file of the cache on disk, atomically
+
+    Several processes may compute the same file at once, so that each
+    one writes to a temporary file of its own in the same folder and
+    then renames it. A failed rename is a cache hit, if another process
+    has written the file in the meantime.
+
+    :param abspath: str
+        the absolute path of the file in the cache
+    :param write: callable
+        writing the content to the binary file object given
+    :return: None
+    """
+    os.makedirs(os.path.dirname(abspath), exist_ok=True)
+    fd, tmp_abspath = tempfile.mkstemp(dir=os.path.dirname(abspath), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_abspath, abspath)
+    except OSError:
+        if not os.path.exists(abspath):
+            raise
+    finally:
+        if os.path.exists(tmp_abspath):
+            os.remove(tmp_abspath)
+
+
+class RegridIndex:
+    """A nearest-neighbour index mapping a source grid onto a target grid
+
+    Attributes:
+        rows: numpy.ndarray
+            the source row of each target row, -1 if out of the source extent
+        cols: numpy.ndarray
+            the source column of each target column, -1 if out of the source extent
+    """
+    def __init__(self, rows, cols):
+        """
+        :param rows: numpy.ndarray
+            the source row of each target row, -1 if out of the source extent
+        :param cols: numpy.ndarray
+            the source column of each target column, -1 if out of the source extent
+        """
+        self.rows = rows
+        self.cols = cols
+
+    @property
+    def shape(self):
+        """Get the shape of the target grid
+
+        :return: tuple
+        """
+        return len(self.rows), len(self.cols)
+
+    @staticmethod
+    def _axis_index(src_origin, src_step, src_size, dst_origin, dst_step, dst_size):
+        """Compute the nearest-neighbour index along one axis
+
+        :return: numpy.ndarray
+        """
+        centers = dst_origin + (np.arange(dst_size) + 0.5) * dst_step
+        index = np.floor((centers - src_origin) / src_step).astype(np.int32)
+        index[(index < 0) | (index >= src_size)] = -1
+        return index
+
+    @classmethod
+    def compute(cls, src_geotransform, src_shape, dst_geotransform, dst_shape):
+        """Compute the index from the geotransforms of the two grids
+
+        :param src_geotransform: tuple
+            the affine geotransform coefficients of the source grid
+        :param src_shape: tuple
+            the number of rows and columns of the source grid
+        :param dst_geotransform: tuple
+            the affine geotransform coefficients of the target grid
+        :param dst_shape: tuple
+            the number of rows and columns of the target grid
+        :return: RegridIndex
+        :raise: ValueError
+            if any of the geotransforms has rotation terms
+        """
+        if src_geotransform[2] or src_geotransform[4] or dst_geotransform[2] or dst_geotransform[4]:
+            raise ValueError('Rotated geotransforms are not supported')
+        rows = cls._axis_index(src_geotransform[3], src_geotransform[5], src_shape[0],
+                               dst_geotransform[3], dst_geotransform[5], dst_shape[0])
+        cols = cls._axis_index(src_geotransform[0], src_geotransform[1], src_shape[1],
+                               dst_geotransform[0], dst_geotransform[1], dst_shape[1])
+        return cls(rows, cols)
+
+    @classmethod
+    def cached(cls, cache_dir, src_geotransform, src_shape, dst_geotransform, dst_shape):
+        """Load the index from the cache on disk, computing and storing it if missing
+
+        :param cache_dir: str
+            the folder of the cached indexes
+        :param src_geotransform: tuple
+            the affine geotransform coefficients of the source grid
+        :param src_shape: tuple
+            the number of rows and columns of the source grid
+        :param dst_geotransform: tuple
+            the affine geotransform coefficients of the target grid
+        :param dst_shape: tuple
+            the number of rows and columns of the target grid
+        :return: RegridIndex
+        """
+        key = repr(([round(float(c), 9) for c in src_geotransform], tuple(src_shape),
+                    [round(float(c), 9) for c in dst_geotransform], tuple(dst_shape)))
+        abspath = os.path.join(cache_dir, 'regrid_' + hashlib.sha1(key.encode()).hexdigest() + '.npz')
+        if os.path.exists(abspath):
+            with np.load(abspath) as npz:
+                return cls(npz['rows'], npz['cols'])
+        index = cls.compute(src_geotransform, src_shape, dst_geotransform, dst_shape)
+        write_cache_file(abspath, lambda f: np.savez(f, rows=index.rows, cols=index.cols))
+        return index
+
+    def cropped(self):
+        """Get the window of the source grid actually used by the index
+
+        Reading only this window of the source raster keeps the memory
+        bounded when the target grid is a small tile of a large one.
+
+        :return: tuple
+            containing the window as (row offset, column offset,
+            number of rows, number of columns) and the index relative
+            to the window; a single pixel window is returned if the
+            target grid is out of the source extent
+        """
+        rows = self.rows[self.rows >= 0]
+        cols = self.cols[self.cols >= 0]
+        if not len(rows) or not len(cols):
+            return (0, 0, 1, 1), RegridIndex(np.full_like(self.rows, -1), np.full_like(self.cols, -1))
+        row_off, col_off = int(rows.min()), int(cols.min())
+        window = (row_off, col_off, int(rows.max()) - row_off + 1, int(cols.max()) - col_off + 1)
+        return window, RegridIndex(np.where(self.rows >= 0, self.rows - row_off, -1),
+                                   np.where(self.cols >= 0, self.cols - col_off, -1))
+
+    def take(self, source, indices, fill=0):
+        """Resample a source array onto some pixels of the target grid only
+
+        :param source: numpy.ndarray
+            the 2d array of the source grid
+        :param indices: numpy.ndarray
+            the flat indices of the target pixels
+        :param fill: scalar
+            the value of the target pixels out of the source extent
+        :return: numpy.ndarray
+            the 1d array of the values of the target pixels
+        """
+        rows, cols = np.divmod(indices, len(self.cols))
+        rows, cols = self.rows[rows], self.cols[cols]
+        values = source[np.maximum(rows, 0), np.maximum(cols, 0)]
+        values[(rows < 0) | (cols < 0)] = fill
+        return values
+
+    def apply(self, source, fill=0):
+        """Resample a source array onto the target grid
+
+        :param source: numpy.ndarray
+            the 2d array of the source grid
+        :param fill: scalar
+            the value of the target pixels out of the source extent
+        :return: numpy.ndarray
+            the 2d array of the target grid
+        """
+        target = source[np.ix_(np.maximum(self.rows, 0), np.maximum(self.cols, 0))]
+        target[self.rows < 0, :] = fill
+        target[:, self.cols < 0] = fill
+        return target
@@ -0,0 +1,272 @@
+"""This module manages the retention of model runs in DATADIR.
+
+Define two classes:
+    - a RunManifest for recording when each model run was last used
+    - a RetentionEngine for selecting the model runs to be kept
+      and evicting (deleting or archiving) the other ones
+
+The model runs are catalogued from the local filenames and the
+manifest only, without touching the network.
+"""
+import os
+import json
+import datetime
+import tarfile
+import tempfile
+
+from filenames import RUN_ARCHIVE_SUBDIR, parse_archive_model_run_dt, parse_model_run_dt
+
+
+class RunManifest:
+    """A class for recording when each model run was last used
+
+    The manifest is a JSON file mapping the ISO format of each
+    model run datetime to the ISO format of its last use.
+
+    Attributes:
+        abspath: str
+            the absolute path of the manifest on disk
+        last_used: dict
+            the datetime of last use, by model run datetime
+    """
+    def __init__(self, abspath):
+        """
+        :param abspath: str
+            the absolute path of the manifest on disk
+        """
+        self.abspath = abspath
+        self.last_used = {}
+        if os.path.exists(abspath):
+            with open(abspath, 'r') as jf:
+                self.last_used = {datetime.datetime.fromisoformat(run): datetime.datetime.fromisoformat(used)
+                                  for run, used in json.load(jf).items()}
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Alternate constructor based on the configuration of the procedure
+
+        :param settings: settings.Settings
+        :return: RunManifest
+        """
+        return cls(os.path.join(settings.DATADIR, settings.RUN_MANIFEST))
+
+    def touch(self, *model_run_dts, when=None):
+        """Record the use of some model runs and save the manifest
+
+        The manifest is read and written by a single process, e.g. the
+        parent of the worker processes, otherwise the uses recorded by
+        the other processes in the meantime are lost.
+
+        :param model_run_dts: datetime.datetime
+            the model runs being used
+        :param when: datetime.datetime
+            the instant of use (default is now)
+        """
+        when = datetime.datetime.now() if when is None else when
+        for model_run_dt in model_run_dts:
+            self.last_used[model_run_dt] = when
+        self.save()
+
+    def forget(self, model_run_dt):
+        """Remove a model run from the manifest, without saving it
+
+        :param model_run_dt: datetime.datetime
+        """
+        self.last_used.pop(model_run_dt, None)
+
+    def save(self):
+        """Write the manifest to disk, atomically
+
+        :return: None
+        """
+        # a temporary file of its own, should another process be saving the manifest
+        fd, tmp_abspath = tempfile.mkstemp(dir=os.path.dirname(self.abspath) or None, suffix='.tmp')
+        with os.fdopen(fd, 'w') as jf:
+            json.dump({run.isoformat(): used.isoformat() for run, used in sorted(self.last_used.items())}, jf,
+                      indent=1)
+        os.replace(tmp_abspath, self.abspath)
+
+
+class RetentionEngine:
+    """A class for keeping the most recently used model runs in DATADIR
+
+    Model runs are ranked by their last use (as recorded in the
+    manifest, or by the modification time of their files), then kept
+    as long as both the number of runs and the byte budget allow it.
+    The remaining model runs are evicted, least-recently-used first.
+
+    Attributes:
+        datadir: str
+            the local folder containing the WRF files
+        manifest: RunManifest
+            the record of the last use of each model run
+        keep_runs: int
+            the maximum number of model runs to keep
+        max_bytes: int
+            the maximum size on disk of the model runs to keep,
+            0 means no limit
+        archive_dir: str
+            if not None, the folder where evicted model runs
+            are archived as compressed tarballs instead of deleted
+    """
+    def __init__(self, datadir, manifest, keep_runs=1, max_bytes=0, archive_dir=None):
+        """
+        :param datadir: str
+            the local folder containing the WRF files
+        :param manifest: RunManifest
+            the record of the last use of each model run
+        :param keep_runs: int
+            the maximum number of model runs to keep
+        :param max_bytes: int
+            the maximum size on disk of the model runs to keep,
+            0 means no limit
+        :param archive_dir: str
+            if provided, the folder where evicted model runs
+            are archived instead of deleted
+        :raise: ValueError
+            if keep_runs is lower than 1
+        """
+        if keep_runs < 1:
+            raise ValueError('At least one model run must be kept')
+        self.datadir = datadir
+        self.manifest = manifest
+        self.keep_runs = keep_runs
+        self.max_bytes = max_bytes
+        self.archive_dir = archive_dir
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Alternate constructor based on the configuration of the procedure
+
+        The members of the lagged ensemble are always kept, see ensemble.
+
+        :param settings: settings.Settings
+        :return: RetentionEngine
+        """
+        retention = dict(settings.retention)
+        retention['keep_runs'] = max(retention['keep_runs'], settings.ensemble['members'])
+        return cls(settings.DATADIR, RunManifest.from_settings(settings), **retention)
+
+    def catalog(self):
+        """Catalog the model runs available locally
+
+        Both the hourly WRF files and the run archives are catalogued.
+
+        :return: dict
+            the list of (absolute path, size in bytes) tuples of the
+            files of each model run, by model run datetime
+        """
+        runs = {}
+        folders = ((self.datadir, parse_model_run_dt),
+                   (os.path.join(self.datadir, RUN_ARCHIVE_SUBDIR), parse_archive_model_run_dt))
+        for folder, parse in folders:
+            if not os.path.isdir(folder):
+                continue
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    model_run_dt = parse(entry.name)
+                    if model_run_dt is not None:
+                        runs.setdefault(model_run_dt, []).append((entry.path, entry.stat().st_size))
+        return runs
+
+    def _last_used(self, model_run_dt, files):
+        """Get the last use of a model run
+
+        :param model_run_dt: datetime.datetime
+        :param files: list
+            the (absolute path, size in bytes) tuples of its files
+        :return: datetime.datetime
+        """
+        if model_run_dt in self.manifest.last_used:
+            return self.manifest.last_used[model_run_dt]
+        return datetime.datetime.fromtimestamp(max(os.path.getmtime(abspath) for abspath, _ in files))
+
+    def select(self, runs, protected=()):
+        """Split the model runs into those to be kept and those to be evicted
+
+        :param runs: dict
+            the catalog of the model runs, see the catalog method
+        :param protected: iterable
+            the model runs that are always kept, e.g. the latest one
+        :return: tuple
+            containing the list of the model runs to be kept and the
+            list of the ones to be evicted, most recently used first
+        """
+        protected = set(protected)
+        ranked = sorted(runs, key=lambda run: (run in protected, self._last_used(run, runs[run]), run), reverse=True)
+        to_keep, to_evict = [], []
+        used_bytes = 0
+        for run in ranked:
+            run_bytes = sum(size for _, size in runs[run])
+            fits = len(to_keep) < self.keep_runs and (not self.max_bytes or used_bytes + run_bytes <= self.max_bytes)
+            if run in protected or (fits and not to_evict):
+                to_keep.append(run)
+                used_bytes += run_bytes
+            else:
+                to_evict.append(run)
+        return to_keep, to_evict
+
+    def evict(self, model_run_dt, files):
+        """Delete or archive the files of a model run
+
+        :param model_run_dt: datetime.datetime
+        :param files: list
+            the (absolute path, size in bytes) tuples of its files
+        :return: None
+        """
+        if self.archive_dir is not None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            tar_abspath = os.path.join(self.archive_dir, model_run_dt.strftime('wrfita_aux_%Y-%m-%d_%H.tar.gz'))
+            print('Archiving model run ', model_run_dt.isoformat(), ' --> ', tar_abspath)
+            with tarfile.open(tar_abspath + '.tmp', 'w:gz') as tar:
+                for abspath, _ in files:
+                    tar.add(abspath, os.path.basename(abspath))
+            os.replace(tar_abspath + '.tmp', tar_abspath)
+        print('Deleting ', len(files), ' input files of model run ', model_run_dt.isoformat(), '...')
+        for abspath, _ in files:
+            try:
+                os.remove(abspath)
+            except OSError:
+                print('Cannot remove file ', abspath, ' Please remove it manually.')
+        self.manifest.forget(model_run_dt)
+
+    def apply(self, protected=()):
+        """Evict the model runs exceeding the retention policy
+
+        :param protected: iterable
+            the model runs that are always kept, e.g. the latest one
+        :return: list
+            the evicted model runs
+        """
+        runs = self.catalog()
+        _, to_evict = self.select(runs, protected)
+        for model_run_dt in reversed(to_evict):
+            self.evict(model_run_dt, runs[model_run_dt])
+        if to_evict:
+            self.manifest.save()
+        return to_evict
+
+
+def apply_retention(settings, protected=()):
+    """Apply the configured retention policy to DATADIR
+
+    The latest processed model run of each domain and model run hour,
+    as recorded in the JSON files of the model run reference time,
+    is always kept.
+
+    :param settings: settings.Settings
+    :param protected: iterable
+        the datetimes of further model runs to be kept,
+        e.g. the ones whose processing failed and is to be retried
+    :return: list
+        the evicted model runs
+    """
+    protected = list(protected)
+    for domain in settings.DOMAINS:
+        for run_hour in settings.RUN_HOURS:
+            model_run_dt = settings.read_ref_time(domain, run_hour)
+            if model_run_dt is not None:
+                protected.append(model_run_dt)
+    return RetentionEngine.from_settings(settings).apply(protected)
@@ -0,0 +1,368 @@
+"""Define classes for consolidating the hourly WRF files of a model run.
+
+A model run is made of 48+ hourly netCDF files. Once the model run is
+complete, its precipitation (the sum of RAINC and RAINNC) is packed
+into one netCDF file, quantized (see quantize.Quantizer), compressed
+and chunked by hour, together with the shared coordinates and
+the time axis. Reading a model run back then takes one open.
+The hours can also be appended one at a time as they are downloaded,
+see manage_ftp, so that the hourly files are never written to disk.
+
+Define two classes:
+    - a RunArchive for packing and reading the consolidated files
+    - an ArchivedMeasure, standing for one hour of an archived model run
+      in place of a WrfItaAux object
+"""
+import os
+import datetime
+import glob
+
+from netCDF4 import Dataset
+import numpy as np
+
+from filenames import RUN_ARCHIVE_SUBDIR, parse_archive_fname, run_archive_fname, run_archive_glob
+from quantize import Quantizer
+from wrfita_aux import WrfItaAux
+
+# the origin of the time axis of the WRF files
+TIME_ORIGIN = datetime.datetime(2000, 1, 1)
+
+
+class RunArchive:
+    """A class for packing and reading the consolidated file of a model run
+
+    Attributes:
+        abspath: str
+            the absolute path of the archive on disk
+        model_run_dt: datetime.datetime
+            the instant in time corresponding to the run of the model
+        domain: str
+            the WRF domain of the model run, e.g. d02
+        quantizer: Quantizer
+            the compact representation of the stored precipitation values
+        lats: numpy.ndarray
+            the latitude values of the grid
+        lons: numpy.ndarray
+            the longitude values of the grid
+        periods: list
+            the datetime.timedelta of the end of each hour,
+            with respect to January 1st, 2000
+        sources: list
+            the filenames of the hourly WRF files that were archived
+    """
+    def __init__(self, abspath):
+        """
+        :param abspath: str
+            the absolute path of the archive on disk
+        """
+        self.abspath = abspath
+        with Dataset(abspath) as ds:
+            ds.set_auto_maskandscale(False)
+            self.model_run_dt = datetime.datetime.fromisoformat(ds.model_run)
+            self.domain = ds.domain
+            rain = ds.variables['rain']
+            self.quantizer = Quantizer(rain.dtype.name, rain.scale_factor, rain.add_offset, rain._FillValue)
+            self.lats = ds.variables['lat'][:]
+            self.lons = ds.variables['lon'][:]
+            self.periods = [datetime.timedelta(hours=float(hours)) for hours in ds.variables['time'][:]]
+            self.sources = [fname for fname in getattr(ds, 'sources', '').split(',') if fname]
+        self._measures = None
+
+    def __len__(self):
+        """Get the number of hours in the archive.
+
+        :return: int
+        """
+        return len(self.periods)
+
+    @staticmethod
+    def abspath_for(datadir, model_run_dt, domain):
+        """Get the absolute path of the archive of a model run
+
+        :param datadir: str
+            the local folder containing the WRF files
+        :param model_run_dt: datetime.datetime
+        :param domain: str
+            the WRF domain of the model run, e.g. d02
+        :return: str
+        """
+        return os.path.join(datadir, RUN_ARCHIVE_SUBDIR, run_archive_fname(domain, model_run_dt))
+
+    @classmethod
+    def from_dir(cls, datadir, domain):
+        """Open all the archives of a domain available in a folder
+
+        :param datadir: str
+            the local folder containing the WRF files
+        :param domain: str
+            the WRF domain, e.g. d02
+        :return: dict
+            the RunArchive objects, by model run datetime
+        """
+        archives = {}
+        for abspath in glob.glob(os.path.join(datadir, RUN_ARCHIVE_SUBDIR, run_archive_glob(domain))):
+            fields = parse_archive_fname(os.path.basename(abspath))
+            if fields is not None and fields[0] == domain:
+                archive = cls(abspath)
+                archives[archive.model_run_dt] = archive
+        return archives
+
+    @classmethod
+    def pack(cls, serie, abspath, complevel=4):
+        """Pack a time serie into an archive on disk
+
+        The file is written to a temporary name and then renamed,
+        so that incomplete archives are never read.
+
+        :param serie: PrecipTimeSerie
+            the time serie of a whole model run
+        :param abspath: str
+            the absolute path of the archive on disk
+        :param complevel: int
+            the zlib compression level
+        :return: RunArchive
+        """
+        first = serie.measures[0]
+        os.makedirs(os.path.dirname(abspath), exist_ok=True)
+        tmp_abspath = abspath + '.tmp'
+        print('Packing model run ', first.model_run_dt.isoformat(), ' --> ', abspath)
+        with Dataset(tmp_abspath, 'w') as ds:
+            rain_var = cls._create(ds, first, serie.quantizer, complevel)
+            ds.variables['time'][:] = [measure.period.total_seconds() / 3600 for measure in serie.measures]
+            ds.sources = ','.join(measure.basename for measure in serie.measures)
+            rain_var[:] = serie.serie
+        os.replace(tmp_abspath, abspath)
+        print('\tmodel run packed!')
+        return cls(abspath)
+
+    @classmethod
+    def append(cls, measure, abspath, quantizer, complevel=4):
+        """Append an hour of a model run to its archive on disk
+
+        The archive is created by the first hour of the model run and the
+        next hours must be appended in order. Unlike pack, the archive is
+        updated in place, so it should not be processed while the model
+        run is being ingested.
+
+        :param measure: WrfItaAux
+            the hour to be appended, e.g. read from memory
+        :param abspath: str
+            the absolute path of the archive on disk
+        :param quantizer: Quantizer
+            the compact representation of the precipitation values,
+            used when the archive is created
+        :param complevel: int
+            the zlib compression level, used when the archive is created
+        :return: RunArchive
+        :raise: ValueError
+            if the hour does not follow the last archived one
+        """
+        if os.path.exists(abspath):
+            archive = cls(abspath)
+            last_dt = TIME_ORIGIN + archive.periods[-1] if archive.periods else measure.model_run_dt
+            quantizer = archive.quantizer
+        else:
+            last_dt = measure.model_run_dt
+        if measure.start_dt != last_dt:
+            raise ValueError('The measure ' + measure.basename + ' does not follow the last archived hour')
+        rain, valid = measure.read_rain()
+        qvalues = quantizer.encode(rain, valid, work=rain)
+        if not os.path.exists(abspath):
+            os.makedirs(os.path.dirname(abspath), exist_ok=True)
+            tmp_abspath = abspath + '.tmp'
+            with Dataset(tmp_abspath, 'w') as ds:
+                cls._create(ds, measure, quantizer, complevel)
+                ds.sources = ''
+            os.replace(tmp_abspath, abspath)
+        with Dataset(abspath, 'a') as ds:
+            ds.set_auto_maskandscale(False)
+            index = len(ds.dimensions['time'])
+            ds.variables['rain'][index] = qvalues
+            ds.variables['time'][index] = measure.period.total_seconds() / 3600
+            ds.sources = ','.join(fname for fname in (ds.sources, measure.basename) if fname)
+        return cls(abspath)
+
+    @staticmethod
+    def _create(ds, first, quantizer, complevel):
+        """Define the dimensions, the variables and the attributes of an archive
+
+        :param ds: netCDF4.Dataset
+            the archive, opened for writing
+        :param first: WrfItaAux
+            the first hour of the model run, defining the grid
+        :param quantizer: Quantizer
+            the compact representation of the precipitation values
+        :param complevel: int
+            the zlib compression level
+        :return: netCDF4.Variable
+            the empty rain variable
+        """
+        ds.set_auto_maskandscale(False)
+        ds.model_run = first.model_run_dt.isoformat()
+        ds.domain = first.domain
+        ds.createDimension('time', None)
+        ds.createDimension('lat', len(first.lats))
+        ds.createDimension('lon', len(first.lons))
+        time_var = ds.createVariable('time', 'f8', ('time',))
+        time_var.units = 'hours since 2000-01-01 00:00:00'
+        ds.createVariable('lat', 'f8', ('lat',))[:] = first.lats
+        ds.createVariable('lon', 'f8', ('lon',))[:] = first.lons
+        rain_var = ds.createVariable('rain', quantizer.dtype, ('time', 'lat', 'lon'), zlib=True,
+                                     complevel=complevel, shuffle=True,
+                                     chunksizes=(1, len(first.lats), len(first.lons)),
+                                     fill_value=quantizer.nodata)
+        rain_var.set_auto_maskandscale(False)
+        rain_var.units = 'mm'
+        rain_var.long_name = 'accumulated total precipitation (RAINC + RAINNC) since the model run'
+        rain_var.scale_factor = quantizer.scale
+        rain_var.add_offset = quantizer.offset
+        return rain_var
+
+    @property
+    def measures(self):
+        """Get the hours of the archive as measures of a time serie
+
+        :return: list
+            of ArchivedMeasure objects
+        """
+        if self._measures is None:
+            self._measures = [ArchivedMeasure(self, index) for index in range(len(self))]
+        return self._measures
+
+    def read(self, first, last, window=None):
+        """Read the quantized precipitation of a range of hours
+
+        :param first: int
+            the index of the first hour
+        :param last: int
+            the index of the last hour (included)
+        :param window: tuple
+            if provided, the row and column slices of the grid to be read,
+            or sorted arrays of row and column indices (orthogonal indexing)
+        :return: numpy.ndarray
+            a 3d array of quantized values
+        :raise: OSError
+            in case the variable cannot be read.
+        """
+        try:
+            with Dataset(self.abspath) as ds:
+                ds.set_auto_maskandscale(False)
+                if window is None:
+                    window = (slice(None), slice(None))
+                return ds.variables['rain'][(slice(first, last + 1),) + tuple(window)]
+        except OSError as ose:
+            print('Cannot read rain data from: ', self.abspath)
+            raise ose
+
+
+class ArchivedMeasure(WrfItaAux):
+    """One hour of an archived model run, in place of a WrfItaAux object
+
+    Attributes:
+        archive: RunArchive
+            the archive containing this hour
+        index: int
+            the position of this hour in the archive
+    """
+    def __init__(self, archive, index):
+        """
+        :param archive: RunArchive
+            the archive containing this hour
+        :param index: int
+            the position of this hour in the archive
+        """
+        self.archive = archive
+        self.index = index
+        self.abspath = archive.abspath
+        self.dirname, self.basename = os.path.split(archive.abspath)
+        self.period = archive.periods[index]
+        self.end_dt = TIME_ORIGIN + self.period
+        self.start_dt = self.end_dt - datetime.timedelta(hours=1)
+        self.model_run_dt = archive.model_run_dt
+        self.domain = archive.domain
+        if self.model_run_dt > self.start_dt:
+            self.start_dt = self.model_run_dt
+        # geometric characteristics below
+        self._x_min = None
+        self._x_max = None
+        self._y_min = None
+        self._y_max = None
+        self._pixel_size_x = None
+        self._pixel_size_y = None
+        self._geotransform = None
+        self._no_data = archive.quantizer.nodata
+
+    @property
+    def lats(self):
+        """Get the array of latitude values.
+
+        :return: numpy.ndarray
+        """
+        return self.archive.lats
+
+    @property
+    def lons(self):
+        """Get the array of longitude values.
+
+        :return: numpy.ndarray
+        """
+        return self.archive.lons
+
+    @property
+    def rainc(self):
+        """RAINC is not archived separately, see the rain property
+
+        :raise: AttributeError
+        """
+        raise AttributeError('Archived measures only store the total precipitation')
+
+    @property
+    def rainnc(self):
+        """RAINNC is not archived separately, see the rain property
+
+        :raise: AttributeError
+        """
+        raise AttributeError('Archived measures only store the total precipitation')
+
+    @property
+    def rain(self):
+        """Get the total precipitation values.
+
+        :return: numpy.ma.MaskedArray
+        """
+        return self.archive.quantizer.decode(self.read_quantized())
+
+    def read_quantized(self, window=None):
+        """Read the quantized total precipitation values.
+
+        :param window: tuple
+            if provided, the row and column slices of the grid to be read,
+            or sorted arrays of row and column indices (orthogonal indexing)
+        :return: numpy.ndarray
+        """
+        return self.archive.read(self.index, self.index, window)[0]
+
+    def read_rain(self, out=None, valid=None, window=None):
+        """Read the total precipitation values into a plain array.
+
+        :param out: numpy.ndarray
+            if provided, the float32 buffer where the result is stored
+        :param valid: numpy.ndarray
+            if provided, a boolean array that is updated in place
+            setting to False the NoData pixels of this measure
+        :param window: tuple
+            if provided, the row and column slices of the grid to be read,
+            or sorted arrays of row and column indices (orthogonal indexing)
+        :return: tuple
+            containing the precipitation and the validity arrays
+        """
+        qvalues = self.read_quantized(window)
+        if out is None:
+            out = np.empty(qvalues.shape, np.float32)
+        if valid is None:
+            valid = np.ones(qvalues.shape, bool)
+        valid &= qvalues != self.archive.quantizer.nodata
+        out[...] = qvalues
+        out *= self.archive.quantizer.scale
+        out += self.archive.quantizer.offset
+        return out, valid
@@ -0,0 +1,277 @@
+"""This module loads the configuration of the procedure.
+
+The config.ini file is parsed only once per process, always
+relative to the project root (not to the current working directory),
+and exposed as a shared Settings instance through get_settings().
+
+Only the standard library is imported here, so that reading
+the configuration never pulls in GDAL, netCDF4, numpy or pysftp.
+"""
+import os
+import configparser
+import datetime
+import json
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_ABSPATH = os.path.join(PROJECT_ROOT, 'config.ini')
+TOOL_DATA_DIR = os.path.join(PROJECT_ROOT, 'tool_data')
+
+_settings = None
+
+
+class Settings:
+    """A class holding the configuration values of the procedure
+
+    Attributes:
+        config_abspath: str
+            the absolute path of the configuration file that was read
+        HOST: str
+            the hostname of the SFTP
+        USER: str
+            the username of a valid account to the SFTP
+        PASSWORD: str
+            the password of a valid account to the SFTP
+        PORT: int
+            the port of the SFTP
+        sftp: dict
+            the number of pooled connections to the SFTP, the options
+            of the in-memory ingest and the remote folder where the outputs
+            are published, see manage_ftp.MirrorSFTP
+        DATADIR: str
+            the local folder used for storing input and output data
+        CACHEDIR: str
+            the local folder used for storing cached intermediate data,
+            such as the regridding indexes
+        DOMAINS: list
+            the WRF domains to be processed, e.g. ['d02']
+        RUN_HOURS: list
+            the hours of the model runs to be processed, e.g. [0, 12]
+        OUTPUT_SUBDIR: str
+            the format of the subfolder of DATADIR where the outputs of a
+            domain and model run hour are written, with the {domain} and
+            {run_hour} fields (empty for writing to DATADIR)
+        TOOL_DATA_DIR: str
+            the local folder containing the mask and the threshold rasters
+        ACCUMUL_FNAME: str
+            the format of the accumulated precipitation filename
+        ALERT_FNAME: str
+            the format of the alerts filename
+        LEAD_TIME_FNAME: str
+            the format of the alert lead times filename
+        ALERT_CHANGES_FNAME: str
+            the filename of the JSON file with the changes of the alerts
+            since the previous model run, see alert_diff.AlertChanges
+        PROBABILITY_FNAME: str
+            the format of the exceedance probability filename
+        MODEL_RUN_REF_TIME: str
+            the filename of the JSON file containing the latest model run
+        MASK_FNAME: str
+            the filename of the sea/land mask
+        grid_thresholds: dict
+            the filenames of the threshold rasters, by duration in hours,
+            used by the domains without a specific configuration
+        quantization: dict
+            the parameters of the compact representation of precipitation
+            values, see quantize.Quantizer
+        RUN_MANIFEST: str
+            the filename of the JSON file recording the last use of each
+            model run
+        retention: dict
+            the parameters of the retention policy of DATADIR,
+            see retention.RetentionEngine
+        service: dict
+            the address and the polling interval of the point query
+            service, see query_service.QueryService
+        ensemble: dict
+            the number of members of the lagged ensemble,
+            see ensemble.LaggedEnsemble
+        tiles: dict
+            whether the web-map tiles are rendered, their zoom levels,
+            their folder and the number of worker processes, see web_tiles
+        climatology: dict
+            the quantiles written as candidate thresholds, the amounts whose
+            exceedances are counted and the output folder, see climatology
+    """
+    def __init__(self, config_abspath=CONFIG_ABSPATH):
+        """
+        :param config_abspath: str
+            the absolute path of the configuration file
+        :raise: FileNotFoundError
+            if the configuration file cannot be read
+        """
+        config = configparser.ConfigParser(inline_comment_prefixes=('#',))
+        if not config.read(config_abspath):
+            raise FileNotFoundError('Cannot read the configuration file: ' + config_abspath)
+        self.config_abspath = config_abspath
+        self.HOST = config['SFTP']['HOST']
+        self.USER = config['SFTP']['USER']
+        self.PASSWORD = config['SFTP']['PASSWORD']
+        self.PORT = config['SFTP'].getint('PORT', fallback=22)
+        self.sftp = {'connections': config['SFTP'].getint('connections', fallback=4),
+                     'in_memory': config['SFTP'].getboolean('in_memory', fallback=False),
+                     'keep_raw': config['SFTP'].getboolean('keep_raw', fallback=False),
+                     'publish_folder': config['SFTP'].get('publish_folder') or None}
+        self.DATADIR = config['STRUCTURE']['DATADIR']
+        self.CACHEDIR = config['STRUCTURE'].get('CACHEDIR') or os.path.join(self.DATADIR, 'cache')
+        self.DOMAINS = _split(config['STRUCTURE'].get('DOMAINS', 'd02'))
+        self.RUN_HOURS = [int(hour) for hour in _split(config['STRUCTURE'].get('RUN_HOURS', '00'))]
+        self.TOOL_DATA_DIR = TOOL_DATA_DIR
+        self.ACCUMUL_FNAME = config['Filename formats']['accumulated_rain']
+        self.ALERT_FNAME = config['Filename formats']['alert']
+        self.LEAD_TIME_FNAME = config['Filename formats'].get('alert_lead_time',
+                                                              'ithaca_cima_wrf_alerts_lead_time_{hours}_hours.tif')
+        self.ALERT_CHANGES_FNAME = config['Filename formats'].get('alert_changes',
+                                                                  'ithaca_cima_wrf_alerts_changes.json')
+        self.PROBABILITY_FNAME = config['Filename formats'].get(
+            'exceedance_probability', 'ithaca_cima_wrf_exceedance_probability_{hours}_hours.tif')
+        self.MODEL_RUN_REF_TIME = config['Filename formats']['model_run_ref_time']
+        self.MASK_FNAME = config['Filename formats']['mask']
+        self.OUTPUT_SUBDIR = config['Filename formats'].get('output_subdir', '')
+        self.grid_thresholds = {int(key[:-1]): value for key, value in config['Grid Thresholds'].items()}
+        # the configuration specific to each domain, in the [Domain <domain>] sections
+        self._domains = {domain: config['Domain ' + domain] if config.has_section('Domain ' + domain) else {}
+                         for domain in self.DOMAINS}
+        if len(self.DOMAINS) > 1 and '{domain}' not in self.OUTPUT_SUBDIR:
+            raise ValueError('With several domains, output_subdir must contain the {domain} field')
+        if len(self.RUN_HOURS) > 1 and '{run_hour' not in self.OUTPUT_SUBDIR:
+            raise ValueError('With several model run hours, output_subdir must contain the {run_hour} field')
+        quantization = config['Quantization'] if config.has_section('Quantization') else {}
+        self.quantization = {'dtype': quantization.get('dtype', 'uint16'),
+                             'scale': float(quantization.get('scale', 0.1)),
+                             'offset': float(quantization.get('offset', 0.0)),
+                             'nodata': int(quantization['nodata']) if quantization.get('nodata') else None}
+        self.RUN_MANIFEST = config['Filename formats'].get('run_manifest', 'run_manifest.json')
+        retention = config['Retention'] if config.has_section('Retention') else {}
+        archive_dir = None
+        if retention.get('archive', 'no').lower() in ('yes', 'true', 'on', '1'):
+            archive_dir = retention.get('archive_dir') or os.path.join(self.DATADIR, 'archive')
+        self.retention = {'keep_runs': int(retention.get('keep_runs', 1)),
+                          'max_bytes': int(retention.get('max_bytes', 0)),
+                          'archive_dir': archive_dir}
+        service = config['Service'] if config.has_section('Service') else {}
+        self.service = {'host': service.get('host', '127.0.0.1'),
+                        'port': int(service.get('port', 8080)),
+                        'socket': service.get('socket') or None,
+                        'poll_seconds': float(service.get('poll_seconds', 30))}
+        ensemble = config['Ensemble'] if config.has_section('Ensemble') else {}
+        self.ensemble = {'members': int(ensemble.get('members', 1))}
+        tiles = config['Tiles'] if config.has_section('Tiles') else {}
+        self.tiles = {'enabled': config.getboolean('Tiles', 'enabled', fallback=False),
+                      'min_zoom': int(tiles.get('min_zoom', 4)),
+                      'max_zoom': int(tiles.get('max_zoom', 8)),
+                      'dir': tiles.get('dir') or os.path.join(self.DATADIR, 'tiles'),
+                      'workers': int(tiles['workers']) if tiles.get('workers') else None}
+        climatology = config['Climatology'] if config.has_section('Climatology') else {}
+        amounts = climatology.get('amounts', '10, 20, 40, 60, 80, 100, 150')
+        self.climatology = {'quantiles': [float(q) for q in _split(climatology.get('quantiles', '0.95, 0.99'))],
+                            'amounts': [float(amount) for amount in _split(amounts)],
+                            'output_dir': climatology.get('output_dir') or os.path.join(self.DATADIR, 'climatology')}
+
+    def output_dir(self, domain=None, run_hour=None):
+        """Get the folder where the outputs of a domain and model run hour are written
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :param run_hour: int
+            the hour of the model run (default is the first configured one)
+        :return: str
+        """
+        domain = self.DOMAINS[0] if domain is None else domain
+        run_hour = self.RUN_HOURS[0] if run_hour is None else run_hour
+        return os.path.join(self.DATADIR, self.OUTPUT_SUBDIR.format(domain=domain, run_hour=run_hour))
+
+    def json_abspath(self, domain=None, run_hour=None):
+        """Get the absolute path of the JSON file containing the latest model run
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :param run_hour: int
+            the hour of the model run (default is the first configured one)
+        :return: str
+        """
+        return os.path.join(self.output_dir(domain, run_hour), self.MODEL_RUN_REF_TIME)
+
+    def tiles_dir(self, domain=None, run_hour=None):
+        """Get the folder of the web-map tiles of a domain and model run hour
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :param run_hour: int
+            the hour of the model run (default is the first configured one)
+        :return: str
+        """
+        domain = self.DOMAINS[0] if domain is None else domain
+        run_hour = self.RUN_HOURS[0] if run_hour is None else run_hour
+        return os.path.join(self.tiles['dir'], '{}_{:02d}'.format(domain, run_hour))
+
+    def read_ref_time(self, domain=None, run_hour=None):
+        """Read the latest model run of a domain and model run hour from its JSON file
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :param run_hour: int
+            the hour of the model run (default is the first configured one)
+        :return: datetime.datetime
+            or None if the file is missing or being written
+        """
+        try:
+            with open(self.json_abspath(domain, run_hour)) as jf:
+                return datetime.datetime.fromisoformat(json.load(jf))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def grid_thresholds_for(self, domain=None):
+        """Get the filenames of the threshold rasters of a domain
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :return: dict
+            the filenames of the threshold rasters, by duration in hours
+        """
+        domain = self.DOMAINS[0] if domain is None else domain
+        section = self._domains.get(domain, {})
+        overrides = {int(key[:-1]): value for key, value in section.items() if key.endswith('h')}
+        return overrides or self.grid_thresholds
+
+    def mask_abspath(self, domain=None):
+        """Get the absolute path of the sea/land mask of a domain on disk
+
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :return: str
+        """
+        domain = self.DOMAINS[0] if domain is None else domain
+        return os.path.join(self.TOOL_DATA_DIR, self._domains.get(domain, {}).get('mask', self.MASK_FNAME))
+
+    def threshold_abspath(self, hours, domain=None):
+        """Get the absolute path of the threshold raster of a domain on disk
+
+        :param hours: int
+            the duration to which the threshold values refer
+        :param domain: str
+            the WRF domain (default is the first configured one)
+        :return: str
+        :raise: KeyError
+            if no threshold raster is configured for that duration
+        """
+        return os.path.join(self.TOOL_DATA_DIR, self.grid_thresholds_for(domain)[hours])
+
+
+def _split(text):
+    """Split a comma-separated list of values from the configuration file
+
+    :param text: str
+    :return: list
+    """
+    return [value.strip() for value in text.split(',') if value.strip()]
+
+
+def get_settings():
+    """Get the shared Settings instance, reading config.ini on first use
+
+    :return: Settings
+    """
+    global _settings
+    if _settings is None:
+        _settings = Settings()
+    return _settings
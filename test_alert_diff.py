@@ -0,0 +1,62 @@
+import unittest
+import os
+import datetime
+import tempfile
+
+import numpy as np
+
+from alert_diff import AlertState, AlertChanges, severity_grid
+
+GEOTRANSFORM = (-11.0, 0.5, 0, 29.5, 0, 0.5)
+PREVIOUS_RUN = datetime.datetime(2020, 4, 1)
+MODEL_RUN = datetime.datetime(2020, 4, 2)
+
+
+class TestAlertChanges(unittest.TestCase):
+    def setUp(self):
+        old = np.zeros((10, 12), np.uint8)
+        old[1:3, 1:3] = 1
+        old[6, 6] = 2
+        old[8, 10] = 2
+        new = np.zeros((10, 12), np.uint8)
+        new[1:3, 1:3] = 2
+        new[6, 6] = 1
+        new[4, 8:11] = 1
+        self.previous = AlertState.from_grid('d02', PREVIOUS_RUN, old, GEOTRANSFORM)
+        self.current = AlertState.from_grid('d02', MODEL_RUN, new, GEOTRANSFORM)
+
+    def test_severity_grid(self):
+        barray = np.zeros((2, 2), np.uint8)
+        barray[0, 0] = 1
+        np.testing.assert_array_equal([[2, 0], [0, 0]], severity_grid([barray, barray]))
+
+    def test_changes(self):
+        changes = AlertChanges(self.current, self.previous)
+        document = changes.to_dict()
+        self.assertEqual([4, 4, 4], document['raised']['rows'])
+        self.assertEqual([8, 9, 10], document['raised']['cols'])
+        self.assertEqual([2], document['cleared']['previous_severity'])
+        self.assertEqual([1, 1, 1, 1], document['upgraded']['previous_severity'])
+        self.assertEqual([1], document['downgraded']['severity'])
+        self.assertEqual([{'pixels': 3, 'rows': [4, 4], 'cols': [8, 10], 'lon': -6.25, 'lat': 31.75, 'severity': 1}],
+                         document['raised']['clusters'])
+
+    def test_without_previous(self):
+        changes = AlertChanges(self.current)
+        self.assertEqual(np.count_nonzero(self.current.severity), len(changes))
+        self.assertEqual(len(changes), len(changes.changes['raised'][0]))
+        self.assertIsNone(changes.to_dict()['previous_model_run'])
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            abspath = AlertState.abspath_for(cache_dir, 'd02', 0)
+            self.current.save(abspath)
+            state = AlertState.load(abspath)
+            self.assertEqual(MODEL_RUN, state.model_run_dt)
+            self.assertEqual(GEOTRANSFORM, state.geotransform)
+            np.testing.assert_array_equal(self.current.severity, state.severity)
+            self.assertIsNone(AlertState.load(os.path.join(cache_dir, 'missing.npz')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import os
+import datetime
+import tempfile
+from unittest import mock
+
+import numpy as np
+
+from alerts import (pack_alerts, unpack_alerts, alerts_to_coo, coo_to_alerts, land_index, Alerts, AlertExtractor,
+                    Threshold)
+from quantize import Quantizer
+from time_serie import PrecipTimeSerie
+
+GEOTRANSFORM = (-11.0, 0.5, 0, 29.5, 0, 0.5)
+MODEL_RUN_DT = datetime.datetime(2020, 4, 1)
+
+
+class SyntheticSerie(PrecipTimeSerie):
+    """A quantized serie of the hours given, without WRF files"""
+    serie = None
+    shape = None
+
+    def __init__(self, serie, hours):
+        self.serie = serie
+        self.shape = serie.shape[1:]
+        self.quantizer = Quantizer()
+        self.geotransform = GEOTRANSFORM
+        self.EPSG_CODE = 4326
+        self.domain = 'd02'
+        self.measures = [type('Measure', (), {'model_run_dt': MODEL_RUN_DT,
+                                              'end_dt': MODEL_RUN_DT + datetime.timedelta(hours=hour)})
+                         for hour in hours]
+
+
+class TestAlertConverters(unittest.TestCase):
+    def setUp(self):
+        self.barray = np.zeros((7, 9), np.uint8)
+        self.barray[2, 3:6] = 1
+        self.barray[6, 8] = 3
+
+    def test_packed(self):
+        packed = pack_alerts(self.barray)
+        self.assertEqual(8, packed.nbytes)
+        np.testing.assert_array_equal(self.barray != 0, unpack_alerts(packed, self.barray.shape))
+
+    def test_coo(self):
+        indices, values = alerts_to_coo(self.barray)
+        self.assertEqual([21, 22, 23, 62], indices.tolist())
+        self.assertEqual([1, 1, 1, 3], values.tolist())
+        np.testing.assert_array_equal(self.barray, coo_to_alerts(indices, values, self.barray.shape))
+
+    def test_from_land(self):
+        land = np.array([21, 22, 30])
+        alerts_obj = Alerts.from_land(np.array([True, False, True]), land, self.barray.shape, GEOTRANSFORM, 4326)
+        self.assertEqual([21, 30], np.flatnonzero(alerts_obj.masked_barray).tolist())
+
+
+class TestLandIndex(unittest.TestCase):
+    def test_land_index(self):
+        # sea, land, NoData and fractional values, as the baseline multiplied the alerts by the mask
+        mask = np.array([[0, 1, 255], [1, 0.5, 1]], np.float32)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mask_abspath = os.path.join(tmpdir, 'mask.tif')
+            open(mask_abspath, 'wb').close()
+            settings = mock.Mock(CACHEDIR=os.path.join(tmpdir, 'cache'))
+            with mock.patch('alerts.get_settings', return_value=settings), \
+                    mock.patch('alerts.tif2grid', return_value=mask) as tif2grid:
+                self.assertEqual([1, 3, 5], land_index(mask_abspath, GEOTRANSFORM, mask.shape).tolist())
+                # read from the cache
+                self.assertEqual([1, 3, 5], land_index(mask_abspath, GEOTRANSFORM, mask.shape).tolist())
+            self.assertEqual(1, tif2grid.call_count)
+
+
+class TestLeadTimes(unittest.TestCase):
+    def test_get_lead_times(self):
+        nodata = Quantizer().nodata
+        # the quantized values of the 6 pixels at each hour, the pixel 3 is on the sea
+        serie = np.array([[50, 0, nodata, 500, 0, nodata],
+                          [150, 0, 150, 500, 0, nodata],
+                          [200, 0, 160, 500, 0, nodata],
+                          [250, 0, 170, 500, 150, nodata]], np.uint16).reshape((4, 2, 3))
+        extractor = AlertExtractor(SyntheticSerie(serie, [1, 2, 3, 300]), Threshold.__new__(Threshold))
+        extractor._land = np.array([0, 1, 2, 4, 5])
+        extractor._land_steps = np.full(5, 100.0)
+        lead_times = extractor.get_lead_times().masked_barray
+        # the first crossing, never exceeded, after a NoData hour, on the sea, capped to 255, always NoData
+        self.assertEqual([2, 0, 2, 0, 255, 0], np.asarray(lead_times).ravel().tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import os
+import datetime
+import tempfile
+
+import numpy as np
+
+from climatology import ClimatologyState
+
+SHAPE = (4, 5)
+AMOUNTS = (10, 50)
+
+
+class TestClimatologyState(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.values = rng.gamma(0.8, 20, (200,) + SHAPE).astype(np.float32)
+        self.valid = rng.random((200,) + SHAPE) > 0.1
+
+    def reduce(self, indices):
+        state = ClimatologyState(SHAPE, amounts=AMOUNTS)
+        for i in indices:
+            state.update(self.values[i], self.valid[i], datetime.datetime(2020, 1, 1) + datetime.timedelta(hours=i))
+        return state
+
+    def test_update(self):
+        state = self.reduce(range(len(self.values)))
+        masked = np.ma.masked_array(self.values.astype(np.float64), ~self.valid)
+        np.testing.assert_array_equal(self.valid.sum(axis=0), state.count)
+        np.testing.assert_allclose(masked.mean(axis=0), state.mean)
+        np.testing.assert_allclose(masked.var(axis=0, ddof=1), state.variance)
+        for exceedances, amount in zip(state.exceedances, AMOUNTS):
+            np.testing.assert_array_equal((masked > amount).sum(axis=0), exceedances)
+        np.testing.assert_array_equal(state.count, state.histogram.sum(axis=0))
+
+    def test_merge(self):
+        whole = self.reduce(range(len(self.values)))
+        merged = self.reduce(range(0, len(self.values), 3))
+        merged.merge(self.reduce(range(1, len(self.values), 3))).merge(self.reduce(range(2, len(self.values), 3)))
+        np.testing.assert_array_equal(whole.count, merged.count)
+        np.testing.assert_allclose(whole.mean, merged.mean)
+        np.testing.assert_allclose(whole.variance, merged.variance)
+        np.testing.assert_array_equal(whole.exceedances, merged.exceedances)
+        np.testing.assert_array_equal(whole.histogram, merged.histogram)
+        self.assertEqual(whole.runs, merged.runs)
+        with self.assertRaises(ValueError):
+            merged.merge(ClimatologyState(SHAPE))
+        # the model runs already reduced are not counted twice
+        with self.assertRaises(ValueError):
+            merged.merge(self.reduce([0]))
+
+    def test_quantile(self):
+        state = self.reduce(range(len(self.values)))
+        masked = np.ma.masked_array(self.values, ~self.valid)
+        for q in (0.5, 0.95):
+            expected = np.array([np.quantile(column.compressed(), q) for column in masked.reshape(200, -1).T])
+            # the error is bounded by the width of the bins
+            np.testing.assert_allclose(expected.reshape(SHAPE), state.quantile(q), atol=10)
+        empty = ClimatologyState(SHAPE)
+        self.assertTrue(np.isnan(empty.quantile(0.5)).all())
+
+    def test_save_load(self):
+        state = self.reduce(range(10))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            abspath = os.path.join(tmpdir, 'state.npz')
+            state.save(abspath)
+            loaded = ClimatologyState.load(abspath)
+        self.assertEqual(state.shape, loaded.shape)
+        np.testing.assert_array_equal(state.amounts, loaded.amounts)
+        np.testing.assert_array_equal(state.histogram, loaded.histogram)
+        np.testing.assert_array_equal(state.m2, loaded.m2)
+        self.assertEqual(state.runs, loaded.runs)
+        self.assertEqual(10, len(loaded.runs))
+
+
+if __name__ == '__main__':
+    unittest.main()
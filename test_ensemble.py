@@ -0,0 +1,102 @@
+import unittest
+import os
+import datetime
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from ensemble import LaggedEnsemble, scheduled_runs
+from quantize import Quantizer
+
+GEOTRANSFORM = (-11.0, 0.5, 0, 29.5, 0, 0.5)
+MODEL_RUN = datetime.datetime(2020, 4, 3, 12)
+
+
+class TestScheduledRuns(unittest.TestCase):
+    def test_previous(self):
+        runs = scheduled_runs(MODEL_RUN, [0, 12], 4)
+        self.assertEqual([MODEL_RUN, datetime.datetime(2020, 4, 3), datetime.datetime(2020, 4, 2, 12),
+                          datetime.datetime(2020, 4, 2)], runs)
+
+    def test_later(self):
+        runs = scheduled_runs(MODEL_RUN, [0], 3, later=True)
+        self.assertEqual([MODEL_RUN, datetime.datetime(2020, 4, 4), datetime.datetime(2020, 4, 5)], runs)
+
+
+class TestLaggedEnsemble(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        measure = SimpleNamespace(model_run_dt=MODEL_RUN)
+        serie = SimpleNamespace(domain='d02', measures=[measure], geotransform=GEOTRANSFORM, shape=(3, 4),
+                                EPSG_CODE=4326, quantizer=Quantizer('uint16', 0.1, 0.0, 65535))
+        self.ensemble = LaggedEnsemble(serie, 3, self.tmpdir.name, self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_members(self):
+        self.assertEqual(MODEL_RUN, self.ensemble.members[0])
+        self.assertEqual(3, len(self.ensemble.members))
+
+    def test_cumulative(self):
+        np.testing.assert_array_equal(np.zeros((3, 4)), self.ensemble.cumulative(MODEL_RUN, MODEL_RUN))
+        member_dt = self.ensemble.members[1]
+        cumulative = np.arange(12, dtype=np.uint16).reshape((3, 4))
+        np.save(self.ensemble.cache_abspath(member_dt, MODEL_RUN), cumulative)
+        np.testing.assert_array_equal(cumulative, self.ensemble.cumulative(member_dt, MODEL_RUN))
+        # neither cached nor available in the data folder
+        self.assertIsNone(self.ensemble.cumulative(member_dt, MODEL_RUN + datetime.timedelta(hours=24)))
+
+    def test_prune(self):
+        for member_dt in (self.ensemble.members[-1], self.ensemble.members[-1] - datetime.timedelta(days=1)):
+            np.save(self.ensemble.cache_abspath(member_dt, MODEL_RUN), np.zeros((3, 4), np.uint16))
+        removed = self.ensemble.prune()
+        self.assertEqual(1, len(removed))
+        self.assertFalse(os.path.exists(removed[0]))
+
+    def test_prune_run_hours(self):
+        self.ensemble.run_hours = [0, 12]
+        self.ensemble.members = scheduled_runs(MODEL_RUN, self.ensemble.run_hours, 3)
+        # the oldest member of the ensemble of the model run at 00 is kept
+        for hours in (12, 24):
+            member_dt = self.ensemble.members[-1] - datetime.timedelta(hours=hours)
+            np.save(self.ensemble.cache_abspath(member_dt, MODEL_RUN), np.zeros((3, 4), np.uint16))
+        removed = self.ensemble.prune()
+        self.assertEqual([self.ensemble.cache_abspath(self.ensemble.members[-1] - datetime.timedelta(hours=24),
+                                                      MODEL_RUN)], removed)
+
+    def test_get_probability(self):
+        self.ensemble.members = scheduled_runs(MODEL_RUN, [0, 12], 4)
+        stop_dt = MODEL_RUN + datetime.timedelta(hours=24)
+        land = np.array([0, 1, 2, 3, 5, 11])
+        nodata = 65535
+        # the quantized cumulative precipitation of the land pixels at the start and at the end of the period,
+        # by member: the latest model run starts from zero, the oldest one is not available until the end
+        cumulatives = {
+            self.ensemble.members[0]: (None, [150, 50, 200, nodata, nodata, 101]),
+            self.ensemble.members[1]: ([100, 0, nodata, nodata, 0, 0], [150, 120, 500, 0, 300, 50]),
+            self.ensemble.members[2]: ([0] * 6, [120, 0, 0, nodata, 0, 0]),
+            self.ensemble.members[3]: ([0] * 6, None)}
+        for member_dt, values in cumulatives.items():
+            for valid_dt, land_values in zip((MODEL_RUN, stop_dt), values):
+                if land_values is not None:
+                    cumulative = np.zeros((3, 4), np.uint16)
+                    cumulative.ravel()[land] = land_values
+                    np.save(self.ensemble.cache_abspath(member_dt, valid_dt), cumulative)
+        threshold = mock.Mock()
+        # 100 quantization steps
+        threshold.land_values.return_value = np.full(len(land), 10.0)
+        with mock.patch('ensemble.land_index', return_value=land), \
+                mock.patch('ensemble.Threshold', return_value=threshold), \
+                mock.patch('ensemble.get_settings'):
+            probability = self.ensemble.get_probability(24)
+        # the accumulations are the differences at the valid times, the NoData values and the
+        # missing members are excluded, and the pixels without valid members have zero probability
+        np.testing.assert_array_equal([67, 33, 50, 0, 50, 33], probability.masked_barray.ravel()[land])
+        np.testing.assert_array_equal(0, np.delete(probability.masked_barray.ravel(), land))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+
+from kernels import accumulate_alerts, threshold_alerts
+from quantize import Quantizer
+
+NO_DATA = np.float32(-8.999999873090293e+33)
+SHAPE = (45, 76)
+
+
+class TestKernels(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.rainc = rng.gamma(0.5, 8., SHAPE).astype(np.float32)
+        self.rainnc = rng.gamma(0.5, 20., SHAPE).astype(np.float32)
+        self.rainc[3, 4:9] = NO_DATA
+        self.rainnc[10, 10] = NO_DATA
+        self.land = np.flatnonzero(rng.random(SHAPE) > 0.6).astype(np.uint32)
+        self.thresholds = rng.uniform(5., 60., len(self.land))
+
+    def reference(self, quantizer):
+        """The accumulation and alerts computed as in read_rain, encode and get_alerts"""
+        rain = np.add(self.rainc, self.rainnc, out=np.empty(SHAPE, np.float32))
+        valid = (self.rainc != NO_DATA) & (self.rainnc != NO_DATA)
+        accumul = quantizer.encode(rain, valid, work=rain)
+        values = accumul.ravel()[self.land]
+        steps = quantizer.to_steps(self.thresholds)
+        alerts = np.zeros(SHAPE, np.uint8)
+        alerts.ravel()[self.land] = (values > steps) & (values != quantizer.nodata)
+        return accumul, alerts
+
+    def test_accumulate_alerts(self):
+        for quantizer in (Quantizer('uint16', 0.1, 0.0, 65535), Quantizer('uint8', 0.5, 1.0, 0)):
+            accumul, alerts = self.reference(quantizer)
+            for chunk_size in (1000, 1 << 16):
+                fused_accumul, fused_alerts = accumulate_alerts(
+                    self.rainc, self.rainnc, (NO_DATA, NO_DATA), quantizer, self.land,
+                    quantizer.to_steps(self.thresholds), chunk_size=chunk_size)
+                self.assertEqual(accumul.dtype, fused_accumul.dtype)
+                self.assertEqual(accumul.tobytes(), fused_accumul.tobytes())
+                self.assertEqual(alerts.tobytes(), fused_alerts.tobytes())
+
+    def test_threshold_alerts(self):
+        quantizer = Quantizer()
+        accumul, alerts = self.reference(quantizer)
+        buffer = np.ones(SHAPE, np.uint8)
+        result = threshold_alerts(accumul, self.land, quantizer.to_steps(self.thresholds), quantizer.nodata,
+                                  buffer, chunk_size=500)
+        self.assertIs(buffer, result)
+        self.assertEqual(alerts.tobytes(), result.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+import os
+import json
+import datetime
+import tempfile
+import contextlib
+import posixpath
+from unittest import mock
+
+from manage_ftp import MirrorSFTP
+
+MODEL_RUN_DT = datetime.datetime(2020, 4, 1, 12)
+
+
+class FakeSFTP:
+    """An in-memory SFTP recording the uploads and the renames"""
+    def __init__(self, fail=()):
+        self.files = {}
+        self.log = []
+        self.fail = fail
+
+    def makedirs(self, remote_dir):
+        pass
+
+    def put(self, localpath, remotepath):
+        if os.path.basename(remotepath) in self.fail:
+            raise IOError('upload failed')
+        with open(localpath, 'rb') as f:
+            self.files[remotepath] = f.read()
+        self.log.append(('put', remotepath))
+
+    def putfo(self, flo, remotepath):
+        self.files[remotepath] = flo.read()
+        self.log.append(('put', remotepath))
+
+    def rename(self, src, dst):
+        self.files[dst] = self.files.pop(src)
+        self.log.append(('rename', dst))
+
+    @property
+    def sftp_client(self):
+        return mock.Mock(posix_rename=self.rename)
+
+    def listdir(self, remote_dir):
+        names = set()
+        for path in self.files:
+            if path.startswith(remote_dir + '/'):
+                names.add(path[len(remote_dir) + 1:].split('/')[0])
+        return sorted(names)
+
+    def remove(self, remotepath):
+        del self.files[remotepath]
+        self.log.append(('remove', remotepath))
+
+    def rmdir(self, remote_dir):
+        self.log.append(('rmdir', remote_dir))
+
+
+class FakePool:
+    """A pool sharing a single FakeSFTP"""
+    size = 2
+
+    def __init__(self, sftp):
+        self.sftp = sftp
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self.sftp
+
+    def close(self):
+        pass
+
+
+class TestPublish(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.localpaths = []
+        for fname in ('accumul_24.tif', 'alerts_24.tif', 'changes.json'):
+            self.localpaths.append(os.path.join(self.tmpdir.name, fname))
+            with open(self.localpaths[-1], 'w') as f:
+                f.write(fname)
+        self.settings = settings = mock.Mock(DATADIR=self.tmpdir.name)
+        settings.read_ref_time.return_value = MODEL_RUN_DT
+        settings.output_dir.return_value = self.tmpdir.name
+        settings.json_abspath.return_value = os.path.join(self.tmpdir.name, 'model_run_ref_time.json')
+        patcher = mock.patch('manage_ftp.get_settings', return_value=settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def mirror(self, sftp):
+        mirror_obj = MirrorSFTP.__new__(MirrorSFTP)
+        mirror_obj.pool = FakePool(sftp)
+        mirror_obj.publish_folder = '/pub'
+        mirror_obj.output_files = lambda domain, run_hour: self.localpaths
+        return mirror_obj
+
+    def test_publish(self):
+        sftp = FakeSFTP()
+        self.assertEqual(0, self.mirror(sftp).publish('d02', 12))
+        marker = json.loads(sftp.files['/pub/model_run_ref_time.json'])
+        self.assertEqual(MODEL_RUN_DT.isoformat(), marker['model_run'])
+        self.assertTrue(marker['folder'].startswith('2020040112_'))
+        for localpath in self.localpaths:
+            remotepath = posixpath.join('/pub', marker['folder'], os.path.basename(localpath))
+            self.assertEqual(os.path.basename(localpath).encode(), sftp.files[remotepath])
+        # the outputs are uploaded to the new folder, then the JSON file is the only one renamed
+        self.assertEqual([('put', '/pub/model_run_ref_time.json.tmp'), ('rename', '/pub/model_run_ref_time.json')],
+                         sftp.log[-2:])
+        self.assertEqual(['put'] * 3, [action for action, _ in sftp.log[:3]])
+
+    def test_failed_upload(self):
+        sftp = FakeSFTP()
+        self.assertEqual(0, self.mirror(sftp).publish('d02', 12))
+        published = dict(sftp.files)
+        sftp.fail = ('alerts_24.tif',)
+        sftp.log.clear()
+        self.assertEqual(1, self.mirror(sftp).publish('d02', 12))
+        # nothing renamed, and the outputs uploaded are removed
+        self.assertNotIn('rename', [action for action, _ in sftp.log])
+        self.assertEqual(published, sftp.files)
+
+    def test_replaced_outputs(self):
+        sftp = FakeSFTP()
+        # another model run is being processed while uploading
+        self.settings.read_ref_time.side_effect = [MODEL_RUN_DT, None]
+        self.assertEqual(1, self.mirror(sftp).publish('d02', 12))
+        self.assertEqual({}, sftp.files)
+        self.assertNotIn('rename', [action for action, _ in sftp.log])
+
+    def test_older_folders(self):
+        sftp = FakeSFTP()
+        for _ in range(3):
+            self.assertEqual(0, self.mirror(sftp).publish('d02', 12, keep=2))
+        folders = [name for name in sftp.listdir('/pub') if not name.endswith('.json')]
+        self.assertEqual(2, len(folders))
+        self.assertIn(json.loads(sftp.files['/pub/model_run_ref_time.json'])['folder'], folders)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+
+from quantize import Quantizer
+
+
+class TestQuantizer(unittest.TestCase):
+    def setUp(self):
+        self.quantizer = Quantizer('uint16', 0.1, 0.0, 65535)
+        self.values = np.ma.masked_array(np.array([[0., 0.04, 0.05, 12.34], [100., 7000., -1., 3.]], np.float32),
+                                         [[False, False, False, False], [False, False, False, True]])
+
+    def test_encode(self):
+        qvalues = self.quantizer.encode(self.values)
+        self.assertEqual(np.uint16, qvalues.dtype)
+        np.testing.assert_array_equal([[0, 0, 0, 123], [1000, 65534, 0, 65535]], qvalues)
+
+    def test_encode_valid(self):
+        valid = np.ones(self.values.shape, bool)
+        valid[0, 0] = False
+        qvalues = self.quantizer.encode(self.values.data, valid)
+        self.assertEqual(65535, qvalues[0, 0])
+        self.assertEqual(30, qvalues[1, 3])
+
+    def test_decode(self):
+        values = self.quantizer.decode(self.quantizer.encode(self.values))
+        self.assertTrue(values.mask[1, 3])
+        self.assertAlmostEqual(12.3, values[0, 3], places=5)
+        self.assertAlmostEqual(100., values[1, 0], places=5)
+
+    def test_round_trip(self):
+        qvalues = np.arange(0, 65535, dtype=np.uint16)
+        np.testing.assert_array_equal(qvalues, self.quantizer.encode(self.quantizer.decode(qvalues)))
+
+    def test_to_steps(self):
+        qvalues = self.quantizer.encode(self.values)
+        np.testing.assert_array_equal(self.quantizer.decode(qvalues).filled(-1) > 10,
+                                      qvalues.astype(np.int64) * (qvalues != 65535) > self.quantizer.to_steps(10))
+
+    def test_nodata_range(self):
+        self.assertRaises(ValueError, Quantizer, 'uint8', 0.1, 0.0, 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import datetime
+from unittest import mock
+
+import numpy as np
+
+from query_service import RunSnapshot, QueryService, LOAD_ATTEMPTS
+
+# a south-up grid like the WRF one
+GEOTRANSFORM = (-11.0, 0.5, 0, 29.5, 0, 0.5)
+SHAPE = (30, 40)
+
+
+class TestRunSnapshot(unittest.TestCase):
+    def setUp(self):
+        accumul = np.arange(SHAPE[0] * SHAPE[1], dtype=np.uint16).reshape(SHAPE)
+        accumul[0, 0] = 65535
+        alerts = np.zeros(SHAPE, np.uint8)
+        alerts[2, 4] = 1
+        lead_times = alerts * 12
+        rasters = {24: {'accumul': accumul, 'scale': 0.1, 'offset': 0.0, 'nodata': 65535,
+                        'alerts': alerts, 'lead_times': lead_times}}
+        self.snapshot = RunSnapshot('d02', datetime.datetime(2020, 4, 1), GEOTRANSFORM, SHAPE, rasters)
+
+    def test_pixels(self):
+        rows, cols, inside = self.snapshot.pixels([29.6, 31.2, 28.0], [-10.9, -9.0, 0.0])
+        self.assertEqual([0, 3], list(rows[:2]))
+        self.assertEqual([0, 4], list(cols[:2]))
+        self.assertEqual([True, True, False], list(inside))
+
+    def test_query(self):
+        results = self.snapshot.query([29.6, 30.6, 45.0], [-10.9, -8.9, 0.0])
+        self.assertIsNone(results[0]['accumulations']['24']['rain_mm'])
+        self.assertEqual({'rain_mm': 8.4, 'alert': True, 'lead_time': 12}, results[1]['accumulations']['24'])
+        self.assertIsNone(results[2]['accumulations']['24']['alert'])
+
+
+class TestQueryService(unittest.TestCase):
+    def test_refresh(self):
+        first, second = datetime.datetime(2020, 4, 1), datetime.datetime(2020, 4, 2)
+        settings = mock.Mock(DOMAINS=['d02'], RUN_HOURS=[0], service={'poll_seconds': 1})
+        # a new model run replaces the outputs while the first one is being loaded
+        settings.read_ref_time.side_effect = [first, None, second, second]
+        snapshots = [RunSnapshot('d02', model_run_dt, GEOTRANSFORM, SHAPE, {}) for model_run_dt in (first, second)]
+        service = QueryService(settings)
+        with mock.patch.object(RunSnapshot, 'load', side_effect=snapshots):
+            self.assertTrue(service.refresh())
+        self.assertEqual(second, service.snapshots['d02'].model_run_dt)
+        # the outputs keep changing
+        settings.read_ref_time.side_effect = [datetime.datetime(2020, 4, 3 + i) for i in range(2 * LOAD_ATTEMPTS)]
+        with mock.patch.object(RunSnapshot, 'load', return_value=snapshots[1]):
+            self.assertFalse(service.refresh())
+        self.assertEqual(second, service.snapshots['d02'].model_run_dt)
+
+
+if __name__ == '__main__':
+    unittest.main()
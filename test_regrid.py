@@ -0,0 +1,74 @@
+import unittest
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+
+from regrid import RegridIndex, write_cache_file
+
+# a south-up grid like the WRF one, and the same grid north-up
+WRF_GEOTRANSFORM = (-11.0, 0.5, 0, 29.5, 0, 0.5)
+NORTH_UP_GEOTRANSFORM = (-11.0, 0.5, 0, 29.5 + 0.5 * 30, 0, -0.5)
+SHAPE = (30, 40)
+
+
+class TestRegridIndex(unittest.TestCase):
+    def setUp(self):
+        self.source = np.arange(SHAPE[0] * SHAPE[1]).reshape(SHAPE)
+
+    def test_flip(self):
+        index = RegridIndex.compute(NORTH_UP_GEOTRANSFORM, SHAPE, WRF_GEOTRANSFORM, SHAPE)
+        np.testing.assert_array_equal(np.flipud(self.source), index.apply(self.source))
+
+    def test_finer_source(self):
+        finer_geotransform = (-11.0, 0.25, 0, 29.5 + 0.5 * 30, 0, -0.25)
+        finer = np.repeat(np.repeat(self.source, 2, axis=0), 2, axis=1)
+        index = RegridIndex.compute(finer_geotransform, finer.shape, WRF_GEOTRANSFORM, SHAPE)
+        np.testing.assert_array_equal(np.flipud(self.source), index.apply(finer))
+
+    def test_out_of_extent(self):
+        shifted_geotransform = (-10.0, 0.5, 0, 29.5 + 0.5 * 30, 0, -0.5)
+        index = RegridIndex.compute(shifted_geotransform, SHAPE, WRF_GEOTRANSFORM, SHAPE)
+        target = index.apply(self.source, fill=-1)
+        self.assertTrue((target[:, :2] == -1).all())
+        self.assertTrue((target[:, 2:] >= 0).all())
+
+    def test_cropped(self):
+        tile_geotransform = (-11.0 + 0.5 * 10, 0.5, 0, 29.5 + 0.5 * 5, 0, 0.5)
+        index = RegridIndex.compute(NORTH_UP_GEOTRANSFORM, SHAPE, tile_geotransform, (8, 6))
+        (row_off, col_off, nrows, ncols), cropped = index.cropped()
+        self.assertEqual((17, 10, 8, 6), (row_off, col_off, nrows, ncols))
+        window = self.source[row_off:row_off + nrows, col_off:col_off + ncols]
+        np.testing.assert_array_equal(index.apply(self.source), cropped.apply(window))
+
+    def test_take(self):
+        index = RegridIndex.compute(NORTH_UP_GEOTRANSFORM, SHAPE, WRF_GEOTRANSFORM, SHAPE)
+        indices = np.array([0, 41, SHAPE[0] * SHAPE[1] - 1])
+        np.testing.assert_array_equal(index.apply(self.source).ravel()[indices], index.take(self.source, indices))
+
+    def test_cached(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            index = RegridIndex.cached(cache_dir, NORTH_UP_GEOTRANSFORM, SHAPE, WRF_GEOTRANSFORM, SHAPE)
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            cached = RegridIndex.cached(cache_dir, NORTH_UP_GEOTRANSFORM, SHAPE, WRF_GEOTRANSFORM, SHAPE)
+            np.testing.assert_array_equal(index.rows, cached.rows)
+            np.testing.assert_array_equal(index.cols, cached.cols)
+
+    def test_write_cache_file(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            abspath = os.path.join(cache_dir, 'entry.npy')
+            write_cache_file(abspath, lambda f: np.save(f, np.arange(3)))
+            # another process has written the file, the failed rename is a cache hit
+            with mock.patch('os.replace', side_effect=PermissionError):
+                write_cache_file(abspath, lambda f: np.save(f, np.arange(4)))
+            np.testing.assert_array_equal(np.arange(3), np.load(abspath))
+            self.assertEqual(['entry.npy'], os.listdir(cache_dir))
+            missing = os.path.join(cache_dir, 'missing.npy')
+            with mock.patch('os.replace', side_effect=PermissionError), self.assertRaises(PermissionError):
+                write_cache_file(missing, lambda f: np.save(f, np.arange(4)))
+            self.assertEqual(['entry.npy'], os.listdir(cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
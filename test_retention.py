@@ -0,0 +1,96 @@
+import unittest
+import os
+import datetime
+import tempfile
+from unittest import mock
+
+from retention import RunManifest, RetentionEngine, apply_retention
+
+RUN_DTS = [datetime.datetime(2020, 4, day) for day in (1, 2, 3, 4)]
+
+
+class TestRunManifest(unittest.TestCase):
+    def test_touch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            abspath = os.path.join(tmpdir, 'run_manifest.json')
+            RunManifest(abspath).touch(*RUN_DTS[:2], when=datetime.datetime(2020, 5, 1))
+            RunManifest(abspath).touch(RUN_DTS[1], when=datetime.datetime(2020, 5, 2))
+            self.assertEqual({RUN_DTS[0]: datetime.datetime(2020, 5, 1), RUN_DTS[1]: datetime.datetime(2020, 5, 2)},
+                             RunManifest(abspath).last_used)
+            self.assertEqual(['run_manifest.json'], os.listdir(tmpdir))
+
+
+class TestRetentionEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.datadir = self.tmpdir.name
+        for run_dt in RUN_DTS:
+            for hour in (1, 2):
+                fname = run_dt.strftime('sft_rftm_rg_wrfita_aux_d02_%Y-%m-%d_%H_') + '{:02d}'.format(hour)
+                with open(os.path.join(self.datadir, fname), 'wb') as f:
+                    f.write(b'0' * 100)
+        self.manifest = RunManifest(os.path.join(self.datadir, 'run_manifest.json'))
+        for run_dt in RUN_DTS:
+            self.manifest.last_used[run_dt] = run_dt + datetime.timedelta(hours=3)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_catalog(self):
+        runs = RetentionEngine(self.datadir, self.manifest).catalog()
+        self.assertEqual(set(RUN_DTS), set(runs))
+        self.assertEqual(2, len(runs[RUN_DTS[0]]))
+
+    def test_keep_runs(self):
+        engine = RetentionEngine(self.datadir, self.manifest, keep_runs=2)
+        to_keep, to_evict = engine.select(engine.catalog())
+        self.assertEqual(RUN_DTS[:1:-1], to_keep)
+        self.assertEqual(RUN_DTS[1::-1], to_evict)
+
+    def test_max_bytes(self):
+        engine = RetentionEngine(self.datadir, self.manifest, keep_runs=4, max_bytes=450)
+        to_keep, _ = engine.select(engine.catalog())
+        self.assertEqual(2, len(to_keep))
+
+    def test_least_recently_used(self):
+        self.manifest.last_used[RUN_DTS[0]] = datetime.datetime(2020, 5, 1)
+        engine = RetentionEngine(self.datadir, self.manifest, keep_runs=1)
+        to_keep, _ = engine.select(engine.catalog(), protected=[RUN_DTS[1]])
+        self.assertEqual([RUN_DTS[1]], to_keep)
+
+    def test_eviction_order(self):
+        # the last uses are not in the order of the model runs
+        for run_dt, day in zip(RUN_DTS, (30, 10, 20, 5)):
+            self.manifest.last_used[run_dt] = datetime.datetime(2020, 4, day)
+        engine = RetentionEngine(self.datadir, self.manifest, keep_runs=2)
+        to_keep, to_evict = engine.select(engine.catalog())
+        self.assertEqual([RUN_DTS[0], RUN_DTS[2]], to_keep)
+        self.assertEqual([RUN_DTS[1], RUN_DTS[3]], to_evict)
+        to_keep, to_evict = engine.select(engine.catalog(), protected=[RUN_DTS[3]])
+        self.assertEqual([RUN_DTS[3], RUN_DTS[0]], to_keep)
+        self.assertEqual([RUN_DTS[2], RUN_DTS[1]], to_evict)
+        # the least recently used model runs are evicted first
+        evicted = []
+        engine.evict = lambda model_run_dt, files: evicted.append(model_run_dt)
+        engine.apply()
+        self.assertEqual([RUN_DTS[3], RUN_DTS[1]], evicted)
+
+    def test_archive(self):
+        archive_dir = os.path.join(self.datadir, 'archive')
+        engine = RetentionEngine(self.datadir, self.manifest, keep_runs=3, archive_dir=archive_dir)
+        self.assertEqual([RUN_DTS[0]], engine.apply())
+        self.assertEqual(['wrfita_aux_2020-04-01_00.tar.gz'], os.listdir(archive_dir))
+        self.assertEqual(set(RUN_DTS[1:]), set(engine.catalog()))
+
+    def test_apply_retention(self):
+        self.manifest.save()
+        settings = mock.Mock(DATADIR=self.datadir, RUN_MANIFEST='run_manifest.json', DOMAINS=['d02'], RUN_HOURS=[0],
+                             retention={'keep_runs': 1}, ensemble={'members': 1})
+        settings.read_ref_time.return_value = RUN_DTS[-1]
+        # the model runs that failed are kept as well as the latest processed one
+        self.assertEqual(RUN_DTS[1:3], sorted(apply_retention(settings, protected=[RUN_DTS[0]])))
+        self.assertEqual({RUN_DTS[0], RUN_DTS[-1]}, set(RetentionEngine(self.datadir, self.manifest).catalog()))
+
+
+if __name__ == '__main__':
+    unittest.main()
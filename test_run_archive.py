@@ -0,0 +1,52 @@
+import unittest
+import os
+import glob
+import tempfile
+
+import numpy as np
+
+from run_archive import RunArchive, ArchivedMeasure
+from time_serie import PrecipTimeSerie
+from wrfita_aux import WrfItaAux
+
+DATADIR = os.path.join(os.path.dirname(__file__), 'wrf')
+
+
+class TestRunArchive(unittest.TestCase):
+    def setUp(self):
+        fpaths = glob.glob(os.path.join(DATADIR, 'sft_rftm_rg_wrfita_aux_d02_*'))
+        self.timeserie = PrecipTimeSerie([WrfItaAux(fpath) for fpath in fpaths])
+        self.tmpdir = tempfile.TemporaryDirectory()
+        model_run_dt = self.timeserie.measures[0].model_run_dt
+        self.archive = RunArchive.pack(self.timeserie, RunArchive.abspath_for(self.tmpdir.name, model_run_dt))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_measures(self):
+        self.assertEqual(len(self.timeserie), len(self.archive))
+        self.assertIsInstance(self.archive.measures[0], ArchivedMeasure)
+        self.assertEqual(self.timeserie.geotransform, self.archive.measures[0].geotransform)
+
+    def test_serie(self):
+        timeserie = PrecipTimeSerie(self.archive.measures)
+        self.assertIs(self.archive, timeserie.archive)
+        np.testing.assert_array_equal(self.timeserie.serie, timeserie.serie)
+
+    def test_append(self):
+        abspath = os.path.join(self.tmpdir.name, 'appended.nc')
+        for measure in self.timeserie.measures:
+            with open(measure.abspath, 'rb') as f:
+                archive = RunArchive.append(WrfItaAux(measure.abspath, memory=f.read()), abspath,
+                                            self.timeserie.quantizer)
+        self.assertEqual([measure.basename for measure in self.timeserie.measures], archive.sources)
+        np.testing.assert_array_equal(self.archive.read(0, len(archive) - 1), archive.read(0, len(archive) - 1))
+        with self.assertRaises(ValueError):
+            RunArchive.append(self.timeserie.measures[0], abspath, self.timeserie.quantizer)
+
+    def test_from_dir(self):
+        self.assertEqual([self.archive.model_run_dt], list(RunArchive.from_dir(self.tmpdir.name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
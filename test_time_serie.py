@@ -26,6 +26,33 @@ class TestTimeSerie(unittest.TestCase):
         self.assertIsInstance(self.timeserie.accumul, np.ndarray)
         self.assertEqual(2, self.timeserie.accumul.ndim)
 
+    def test_valid(self):
+        self.assertEqual(bool, self.timeserie.valid.dtype)
+        self.assertEqual(self.timeserie.serie.shape[1:], self.timeserie.valid.shape)
+        # the NoData pixels are the ones of the last hour, whatever is read first
+        np.testing.assert_array_equal(self.timeserie.serie[-1] != self.timeserie.quantizer.nodata,
+                                      self.timeserie.valid)
+
+    def test_window(self):
+        window = (slice(1, 5), slice(2, 8))
+        timeserie = PrecipTimeSerie(self.timeserie.measures, window=window)
+        self.assertEqual((4, 6), timeserie.shape)
+        np.testing.assert_array_equal(self.timeserie.serie[:, 1:5, 2:8], timeserie.serie)
+
+    def test_head(self):
+        timeserie = self.timeserie.head(datetime.timedelta(hours=1))
+        self.assertEqual(1, len(timeserie))
+        np.testing.assert_array_equal(self.timeserie.serie[0], timeserie.accumul)
+
+    def test_extract_stations(self):
+        gt = self.timeserie.geotransform
+        stations = [('in', gt[3] + 2.5 * gt[5], gt[0] + 3.5 * gt[1]), ('out', gt[3] - gt[5], gt[0] - gt[1])]
+        hourly = self.timeserie.extract_stations(stations)
+        self.assertEqual((2, len(self.timeserie)), hourly.shape)
+        self.assertTrue(np.isnan(hourly[1]).all())
+        serie = self.timeserie.serie[:, 2, 3].astype(np.float64) * self.timeserie.quantizer.scale
+        np.testing.assert_allclose(serie[1:] - serie[:-1], hourly[0, 1:], atol=1e-4)
+
     def test_accumul_to_tiff(self):
         oabspath = os.path.join(DATADIR, 'geo' + str(self.timeserie.duration.seconds // 3600) + '.tif')
         self.assertEqual(0, self.timeserie.accumul_to_tiff(oabspath))
@@ -0,0 +1,75 @@
+import unittest
+import os
+import zlib
+import struct
+import datetime
+import tempfile
+
+import numpy as np
+
+from web_tiles import (write_png, tile_range, tile_pixels, alert_classes, publish_tiles, render_version,
+                       switch_version, CURRENT_LINK)
+
+# a grid of 0.5 degrees covering 30N-45N and 10W-10E, south-up as the WRF grids
+GEOTRANSFORM = (-10.0, 0.5, 0, 30.0, 0, 0.5)
+SHAPE = (30, 40)
+
+
+class TestWebTiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_write_png(self):
+        rgba = np.arange(2 * 3 * 4, dtype=np.uint8).reshape((2, 3, 4))
+        abspath = os.path.join(self.tmpdir.name, 'tile.png')
+        write_png(abspath, rgba)
+        with open(abspath, 'rb') as f:
+            png = f.read()
+        self.assertEqual(b'\x89PNG\r\n\x1a\n', png[:8])
+        self.assertEqual((3, 2), struct.unpack('>II', png[16:24]))
+        idat_length = struct.unpack('>I', png[33:37])[0]
+        scanlines = np.frombuffer(zlib.decompress(png[41:41 + idat_length]), np.uint8).reshape((2, 13))
+        np.testing.assert_array_equal(rgba.reshape((2, 12)), scanlines[:, 1:])
+
+    def test_tile_range(self):
+        xs, ys = tile_range(GEOTRANSFORM, SHAPE, 3)
+        self.assertEqual(range(3, 5), xs)
+        self.assertEqual(range(2, 4), ys)
+
+    def test_tile_pixels(self):
+        rows, cols, rows_inside, cols_inside = tile_pixels(GEOTRANSFORM, SHAPE, 3, 4, 3)
+        # the tile spans from 0 to 45E and from the equator to about 41N
+        self.assertEqual(20, cols[0])
+        self.assertTrue(cols_inside[:56].all())
+        self.assertFalse(cols_inside[57:].any())
+        self.assertTrue(rows_inside[0])
+        self.assertFalse(rows_inside[-1])
+        self.assertTrue(np.all(np.diff(rows[rows_inside]) <= 0))
+
+    def test_publish_tiles(self):
+        barray = np.zeros(SHAPE, np.uint8)
+        barray[10:15, 25:30] = 1
+        tiles_dir = os.path.join(self.tmpdir.name, 'tiles')
+        version_dir = publish_tiles({'alerts_24h': alert_classes(barray)}, GEOTRANSFORM, tiles_dir,
+                                    datetime.datetime(2020, 4, 1), range(3, 4), workers=1)
+        self.assertEqual(os.path.realpath(version_dir), os.path.realpath(os.path.join(tiles_dir, CURRENT_LINK)))
+        # only the tile covering the alerts is written
+        self.assertEqual(['3.png'], os.listdir(os.path.join(tiles_dir, CURRENT_LINK, 'alerts_24h', '3', '4')))
+        self.assertEqual(['4'], os.listdir(os.path.join(tiles_dir, CURRENT_LINK, 'alerts_24h', '3')))
+
+    def test_render_version(self):
+        products = {'alerts_24h': alert_classes(np.ones(SHAPE, np.uint8))}
+        tiles_dir = os.path.join(self.tmpdir.name, 'tiles')
+        current_dir = publish_tiles(products, GEOTRANSFORM, tiles_dir, datetime.datetime(2020, 4, 1), range(3, 4), 1)
+        version_dir = render_version(products, GEOTRANSFORM, tiles_dir, datetime.datetime(2020, 4, 2), range(3, 4), 1)
+        # the new version is served only once switched to
+        self.assertEqual(os.path.realpath(current_dir), os.path.realpath(os.path.join(tiles_dir, CURRENT_LINK)))
+        switch_version(tiles_dir, version_dir)
+        self.assertEqual(os.path.realpath(version_dir), os.path.realpath(os.path.join(tiles_dir, CURRENT_LINK)))
+
+
+if __name__ == '__main__':
+    unittest.main()
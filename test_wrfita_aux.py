@@ -19,6 +19,9 @@ class TestWrfItaAux(unittest.TestCase):
     def test_start_dt(self):
         self.assertIsInstance(self.wrf.start_dt, datetime.datetime)
 
+    def test_domain(self):
+        self.assertEqual('d02', self.wrf.domain)
+
     def test_rain(self):
         self.assertIsInstance(self.wrf.rain, np.ndarray)
         self.assertEqual(2, self.wrf.rain.ndim)
@@ -31,6 +34,12 @@ class TestWrfItaAux(unittest.TestCase):
         self.assertIsInstance(self.wrf.rainc, np.ndarray)
         self.assertEqual(2, self.wrf.rain.ndim)
 
+    def test_read_rain(self):
+        rain, valid = self.wrf.read_rain()
+        self.assertEqual(np.float32, rain.dtype)
+        self.assertEqual(bool, valid.dtype)
+        np.testing.assert_allclose(self.wrf.rain[valid], rain[valid])
+
     def test_lats(self):
         self.assertIsInstance(self.wrf.lats, np.ndarray)
         self.assertEqual(1, self.wrf.lats.ndim)
@@ -0,0 +1,166 @@
+"""Process a model run in tiles, with bounded memory.
+
+The WRF grid is split in square tiles, each processed by a worker
+process which reads only its window of the input files (see the
+window parameter of PrecipTimeSerie) and of the threshold and mask
+rasters (see alerts.tif2grid). The longest serie of the tile is read
+once and the shorter accumulations are taken from its first hours.
+The output rasters are created at full size by the parent process,
+which writes the blocks of the tiles as they are completed, so that
+the memory needed is proportional to the tile size and to the number
+of workers rather than to the size of the grid: only a few tiles per
+worker are submitted at a time, and the results of each tile are
+dropped once written.
+"""
+import concurrent.futures
+import datetime
+import itertools
+import os
+
+import numpy as np
+from osgeo import gdal, osr
+
+from alerts import AlertExtractor, alerts_to_coo, coo_to_alerts, pack_alerts, unpack_alerts
+from settings import get_settings
+from time_serie import PrecipTimeSerie
+
+# the number of tiles submitted to each worker process ahead of the results being written
+MAX_PENDING_PER_WORKER = 2
+
+
+def iter_tiles(shape, tile_size):
+    """Split a grid in square tiles
+
+    :param shape: tuple
+        the number of rows and columns of the grid
+    :param tile_size: int
+        the number of rows and columns of a tile,
+        the tiles on the last row and column may be smaller
+    :return: generator
+        of (row slice, column slice) tuples
+    """
+    if tile_size < 1:
+        raise ValueError('The tile size must be a positive number of pixels')
+    for row in range(0, shape[0], tile_size):
+        for col in range(0, shape[1], tile_size):
+            yield slice(row, min(row + tile_size, shape[0])), slice(col, min(col + tile_size, shape[1]))
+
+
+def _process_tile(measures, duration_hours, window):
+    """Extract the accumulations, alerts and lead times of a tile
+
+    :param measures: list
+        the measures of the longest serie, found once by the parent
+        process, so that the workers neither list the data folder
+        nor open the WRF files or the run archives for each tile
+    :param duration_hours: list
+        the durations of the accumulations, in hours
+    :param window: tuple
+        the row and column slices of the tile
+    :return: dict
+        by duration, the accumulation array, the alerts packed into bits
+        and the lead times in the sparse (COO) representation,
+        which are far smaller to send back to the parent process
+    """
+    longest = PrecipTimeSerie(measures, window=window)
+    blocks = {}
+    for duration_hour in duration_hours:
+        tsobj = longest.head(datetime.timedelta(hours=duration_hour))
+        extractor = AlertExtractor.from_serie(tsobj)
+        blocks[duration_hour] = (tsobj.accumul, pack_alerts(extractor.get_alerts().masked_barray),
+                                 alerts_to_coo(extractor.get_lead_times().masked_barray))
+    return blocks
+
+
+def _create_tiff(out_abspath, tsobj, dtype, quantizer=None):
+    """Create an empty geotiff with the grid of a time serie
+
+    :param out_abspath: str
+        the absolute path of the output file
+    :param tsobj: PrecipTimeSerie
+        the serie defining the grid and the spatial reference
+    :param dtype: int
+        the GDAL data type of the band
+    :param quantizer: Quantizer
+        if provided, the quantization of the values written to the band
+    :return: gdal.Dataset
+    """
+    if not os.path.isabs(out_abspath):
+        raise ValueError("The path provided is not absolute: " + out_abspath)
+    driver = gdal.GetDriverByName('Gtiff')
+    outDataset_options = ['COMPRESS=LZW', 'TILED=YES']
+    outDataset = driver.Create(out_abspath, tsobj.shape[1], tsobj.shape[0], 1, dtype, outDataset_options)
+    outDataset.SetGeoTransform(tsobj.geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(tsobj.EPSG_CODE)
+    outDataset.SetProjection(srs.ExportToWkt())
+    if quantizer is not None:
+        outband = outDataset.GetRasterBand(1)
+        outband.SetNoDataValue(quantizer.nodata)
+        outband.SetScale(quantizer.scale)
+        outband.SetOffset(quantizer.offset)
+        outband.SetUnitType('mm')
+    return outDataset
+
+
+def process_tiled(model_run_dt, domain, out_dir, tile_size, workers=None):
+    """Extract the accumulations, alerts and lead times of a model run in tiles
+
+    The outputs are the same as the ones written by procedure.start.
+
+    :param model_run_dt: datetime.datetime
+        the date and time of the model run
+    :param domain: str
+        the WRF domain
+    :param out_dir: str
+        the folder where outputs are written
+    :param tile_size: int
+        the number of rows and columns of a tile
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :return: numpy.ndarray
+        the severity of the alerts, see alert_diff.severity_grid
+    """
+    settings = get_settings()
+    duration_hours = sorted(settings.grid_thresholds_for(domain))
+    # only the metadata of the whole serie is read here, its measures are shared by the tiles
+    tsobj = PrecipTimeSerie.earliest_from_dir(settings.DATADIR, model_run_dt,
+                                              datetime.timedelta(hours=max(duration_hours)), domain)
+    gdal.AllRegister()
+    datasets = {}
+    for duration_hour in duration_hours:
+        datasets[duration_hour] = (
+            _create_tiff(os.path.join(out_dir, settings.ACCUMUL_FNAME.format(hours=duration_hour)), tsobj,
+                         gdal.GetDataTypeByName(tsobj.quantizer.gdal_type_name), tsobj.quantizer),
+            _create_tiff(os.path.join(out_dir, settings.ALERT_FNAME.format(hours=duration_hour)), tsobj,
+                         gdal.GDT_Byte),
+            _create_tiff(os.path.join(out_dir, settings.LEAD_TIME_FNAME.format(hours=duration_hour)), tsobj,
+                         gdal.GDT_Byte))
+    severity = np.zeros(tsobj.shape, np.uint8)
+    tiles = iter_tiles(tsobj.shape, tile_size)
+    workers = workers or os.cpu_count()
+    print('Processing tiles of model run ', domain, model_run_dt.isoformat(), ' with ', workers, ' workers')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        while True:
+            # a bounded number of tiles in flight, and so of results waiting to be written
+            for window in itertools.islice(tiles, MAX_PENDING_PER_WORKER * workers - len(futures)):
+                futures[executor.submit(_process_tile, tsobj.measures, duration_hours, window)] = window
+            if not futures:
+                break
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                rows, cols = futures.pop(future)
+                shape = (rows.stop - rows.start, cols.stop - cols.start)
+                for duration_hour, (accumul, packed, lead_times) in future.result().items():
+                    alerts = unpack_alerts(packed, shape)
+                    blocks = (accumul, alerts, coo_to_alerts(*lead_times, shape))
+                    for outDataset, block in zip(datasets[duration_hour], blocks):
+                        outDataset.GetRasterBand(1).WriteArray(block, cols.start, rows.start)
+                    severity[rows, cols] += alerts
+    for outDatasets in datasets.values():
+        for outDataset in outDatasets:
+            outDataset.GetRasterBand(1).GetStatistics(0, 1)
+            outDataset.FlushCache()
+    print('\ttiled outputs written!')
+    return severity
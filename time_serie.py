@@ -1,4 +1,5 @@
 """Define a class for generating and managing time serie data"""
+import csv
 import datetime
 import glob
 import os
@@ -6,8 +7,74 @@ import os
 import numpy as np
 from osgeo import gdal, osr
 
+from filenames import parse_model_run_dt, wrf_glob
+from kernels import accumulate_alerts, threshold_alerts
+from quantize import Quantizer
+from run_archive import RunArchive
+from settings import get_settings
 from wrfita_aux import WrfItaAux
 
+
+def _model_runs_in_dir(datadir, domain):
+    """Get the model runs of a domain available in a folder
+
+    The model runs are identified by the filenames only.
+
+    :param datadir: str
+        a folder in the os.path flavour
+    :param domain: str
+        the WRF domain, e.g. d02
+    :return: set
+        of datetime.datetime objects
+    """
+    model_runs = set(RunArchive.from_dir(datadir, domain))
+    for absfname in glob.glob(os.path.join(datadir, wrf_glob(domain))):
+        model_runs.add(parse_model_run_dt(os.path.basename(absfname)))
+    model_runs.discard(None)
+    return model_runs
+
+
+def _measures_from_dir(datadir, domain, model_run_dt=None):
+    """Get the measures of a domain available in a folder
+
+    The model runs with a run archive (see run_archive.RunArchive)
+    are read from it, without opening their hourly files.
+
+    :param datadir: str
+        a folder in the os.path flavour
+    :param domain: str
+        the WRF domain, e.g. d02
+    :param model_run_dt: datetime.datetime
+        if provided, only the measures of this model run are returned,
+        selected by filename before opening the files
+    :return: list
+        of WrfItaAux objects
+    """
+    archives = RunArchive.from_dir(datadir, domain)
+    measures = [measure for run, archive in archives.items() for measure in archive.measures
+                if model_run_dt in (None, run)]
+    for absfname in glob.glob(os.path.join(datadir, wrf_glob(domain))):
+        run = parse_model_run_dt(os.path.basename(absfname))
+        if run is not None and run not in archives and model_run_dt in (None, run):
+            measures.append(WrfItaAux(absfname))
+    return measures
+
+
+def read_stations(csv_abspath):
+    """Read a list of stations from a CSV file
+
+    The file must have a header with the id, lat and lon columns,
+    the other columns are ignored.
+
+    :param csv_abspath: str
+        the absolute path of the CSV file on disk
+    :return: list
+        of (id, lat, lon) tuples
+    """
+    with open(csv_abspath, newline='') as csvfile:
+        return [(row['id'], float(row['lat']), float(row['lon'])) for row in csv.DictReader(csvfile)]
+
+
 class PrecipTimeSerie:
     """Generate and manage a time serie of precipitation data
 
@@ -23,13 +90,28 @@ class PrecipTimeSerie:
         geotransform: tuple
             Generate the affine geotransform coefficients according to
             https://gdal.org/user/raster_data_model.html#affine-geotransform
+        domain: str
+            the WRF domain of the measures
         EPSG_CODE: int
             the code of the spatial reference
+        quantizer: Quantizer
+            the compact representation of the precipitation values
+        archive: RunArchive
+            the run archive containing all the measures, or None
+        window: tuple
+            the row and column slices of the WRF grid covered by the
+            serie, or None for the whole grid (see tiling)
     """
 
-    def __init__(self, measures):
+    def __init__(self, measures, quantizer=None, window=None):
         """
         :param measures: iterable of WrfItaAux objects
+        :param quantizer: Quantizer
+            the compact representation of the precipitation values
+            (default is the one in the configuration file)
+        :param window: tuple
+            if provided, the row and column slices of the WRF grid
+            to which the serie is restricted, with explicit bounds
         """
         self.measures = list(measures)
         self.measures.sort()
@@ -43,11 +125,26 @@ class PrecipTimeSerie:
                 raise ValueError('Some measurements are missing in the serie, in particular covering the time period '
                                  'following ' + self.measures[i].end_dt.isoformat())
         # geometric parameters
+        self.window = window
         self.geotransform = self.measures[0].geotransform
+        if window is not None:
+            # move the origin to the first pixel of the window
+            rows, cols = window
+            gt = self.geotransform
+            self.geotransform = (gt[0] + cols.start * gt[1], gt[1], gt[2],
+                                 gt[3] + rows.start * gt[5], gt[4], gt[5])
         self.EPSG_CODE = self.measures[0].EPSG_CODE
+        self.domain = self.measures[0].domain
+        if any(measure.domain != self.domain for measure in self.measures):
+            raise ValueError('The measures in the serie belong to different domains')
+        if quantizer is None:
+            quantizer = Quantizer.from_settings(get_settings())
+        self.quantizer = quantizer
 
         self._serie = None
         self._accumul = None
+        self._valid = None
+        self.archive = self._shared_archive()
 
     def __len__(self):
         """Get the number of measures in the serie.
@@ -56,8 +153,38 @@ class PrecipTimeSerie:
         """
         return len(self.measures)
 
+    @property
+    def shape(self):
+        """Get the number of rows and columns of the grid.
+
+        :return: tuple
+        """
+        if self.window is not None:
+            rows, cols = self.window
+            return rows.stop - rows.start, cols.stop - cols.start
+        return len(self.measures[0].lats), len(self.measures[0].lons)
+
+    def _shared_archive(self):
+        """Get the run archive containing all the measures, if any.
+
+        The run archive is returned only if the measures are consecutive
+        hours in it, quantized as required by the serie, so that the
+        quantized values can be read from it with a single access.
+
+        :return: RunArchive
+            or None
+        """
+        archive = getattr(self.measures[0], 'archive', None)
+        if archive is None or archive.quantizer != self.quantizer:
+            return None
+        first = self.measures[0].index
+        for i, measure in enumerate(self.measures):
+            if getattr(measure, 'archive', None) is not archive or measure.index != first + i:
+                return None
+        return archive
+
     @classmethod
-    def from_dir(cls, datadir, start_dt, stop_dt):
+    def from_dir(cls, datadir, start_dt, stop_dt, domain=None):
         """An alternate constructor for the PrecipTimeSerie class.
 
         :param datadir: str
@@ -66,13 +193,16 @@ class PrecipTimeSerie:
             the ideal beginning of the serie
         :param stop_dt: datetime.datetime
             the ideal end of the serie
+        :param domain: str
+            the WRF domain of the serie (default is the first configured one)
         :return: PrecipTimeSerie
         :raise: Exception
             in no WRF data is available in the folder
         """
+        if domain is None:
+            domain = get_settings().DOMAINS[0]
         measures = []
-        for absfname in glob.glob(os.path.join(datadir, 'sft_rftm_rg_wrfita_aux_d02_*')):
-            ah = WrfItaAux(absfname)
+        for ah in _measures_from_dir(datadir, domain):
             if ah.start_dt < stop_dt and ah.end_dt > start_dt:
                 measures.append(ah)
         if measures:
@@ -81,7 +211,7 @@ class PrecipTimeSerie:
             raise Exception('There are no suitable data in the folder, for the timeframe provided!')
 
     @classmethod
-    def earliest_from_dir(cls, datadir, model_run_dt=None, duration=False):
+    def earliest_from_dir(cls, datadir, model_run_dt=None, duration=False, domain=None, window=None):
         """Another alternate constructor for the PrecipTimeSerie class.
 
         Generate a time serie object given a folder and optionally
@@ -91,26 +221,30 @@ class PrecipTimeSerie:
             a string representing a folder in the os.path flavour
         :param model_run_dt: datetime.datetime
             a datetime object representing the model run date and time
-            (default is the current day at midnight)
+            (default is the latest model run available in the folder)
         :param duration: datetime.timedelta
             the duration of the time serie (default is undefined)
+        :param domain: str
+            the WRF domain of the serie (default is the first configured one)
+        :param window: tuple
+            if provided, the row and column slices of the WRF grid
+            to which the serie is restricted
         :return: PrecipTimeSerie
         :raise: ValueError
             in case the model_run_dt or the duration params don't have
             an appropriate type
         """
-        measures = [WrfItaAux(absfname) for absfname in glob.glob(os.path.join(datadir,
-                                                                               'sft_rftm_rg_wrfita_aux_d02_*'))]
-
+        if domain is None:
+            domain = get_settings().DOMAINS[0]
         if model_run_dt is None:
-            model_run_dt = datetime.datetime.combine(datetime.date.today(), datetime.time())
+            model_runs = _model_runs_in_dir(datadir, domain)
+            if not model_runs:
+                raise Exception('There are no suitable data in the folder, for the timeframe provided!')
+            model_run_dt = max(model_runs)
         else:
             if not isinstance(model_run_dt, datetime.datetime):
                 raise ValueError
-        filtered_measures = []
-        for measure in measures:
-            if measure.model_run_dt == model_run_dt:
-                filtered_measures.append(measure)
+        filtered_measures = _measures_from_dir(datadir, domain, model_run_dt)
 
         if duration:
             if not isinstance(duration, datetime.timedelta):
@@ -123,42 +257,223 @@ class PrecipTimeSerie:
             refiltered_measures = filtered_measures
 
         if refiltered_measures:
-            tsobj = cls(refiltered_measures)
+            tsobj = cls(refiltered_measures, window=window)
             if duration and duration > tsobj.duration:
                 raise Exception('Missing measures in the serie, the period is not complete!')
             return tsobj
         else:
             raise Exception('There are no suitable data in the folder, for the timeframe provided!')
 
+    def head(self, duration):
+        """Get the serie restricted to its first hours.
+
+        The returned serie shares the quantized values already read by
+        this one, so that the accumulations of several durations are
+        extracted with a single read of the longest one. As for any
+        serie, the validity mask refers to its own last hour.
+
+        :param duration: datetime.timedelta
+            the duration of the returned serie
+        :return: PrecipTimeSerie
+        :raise: Exception
+            if the serie is shorter than the duration
+        """
+        measures = [measure for measure in self.measures if measure.start_dt < self.start_dt + duration]
+        if not measures or duration > measures[-1].end_dt - self.start_dt:
+            raise Exception('Missing measures in the serie, the period is not complete!')
+        tsobj = self.__class__(measures, self.quantizer, self.window)
+        tsobj._serie = self.serie[:len(measures)]
+        return tsobj
+
     @property
     def serie(self):
         """Get the precipitation time serie.
 
-        Generates and returns a 3d array with the precipitation data
-        for the entire time serie.
+        Generates and returns a 3d array with the quantized precipitation
+        data for the entire time serie (see the quantizer attribute).
+        Each hour keeps its own NoData pixels.
 
         :return: numpy.ndarray
         """
+        if self._serie is None and self.archive is not None:
+            first = self.measures[0].index
+            self._serie = self.archive.read(first, first + len(self.measures) - 1, self.window)
         if self._serie is None:
-            self._serie = np.array([measure.rain for measure in self.measures])
+            rain, valid = self.measures[0].read_rain(window=self.window)
+            serie = np.empty((len(self.measures),) + rain.shape, self.quantizer.dtype)
+            self.quantizer.encode(rain, valid, out=serie[0], work=rain)
+            for i, measure in enumerate(self.measures[1:], 1):
+                # the same buffers are reused for every measure
+                valid.fill(True)
+                measure.read_rain(rain, valid, self.window)
+                self.quantizer.encode(rain, valid, out=serie[i], work=rain)
+            self._serie = serie
         return self._serie
 
     @property
     def accumul(self):
         """Get the accumulated precipitation.
 
-        Generates and returns a 2d array with the accumulated
-        precipitation data for the entire time serie.
+        Generates and returns a 2d array with the quantized accumulated
+        precipitation data for the entire time serie
+        (see the quantizer attribute).
 
         :return: numpy.ndarray
         """
         if self._accumul is None:
-            self._accumul = self.measures[-1].rain.astype(np.int16)
+            if self._serie is not None:
+                self._accumul = self._serie[-1]
+            elif self.archive is not None:
+                self._accumul = self.measures[-1].read_quantized(self.window)
+            else:
+                rain, valid = self.measures[-1].read_rain(window=self.window)
+                self._accumul = self.quantizer.encode(rain, valid, work=rain)
         return self._accumul
 
+    def accumul_alerts(self, land, steps):
+        """Get the accumulated precipitation and the alerts of some pixels.
+
+        If the accumulation has not been read yet and the serie is read
+        from the WRF files, the RAINC and RAINNC values of the last hour
+        go through a fused kernel producing both the quantized accumulation
+        and the alerts in a single pass (see kernels.accumulate_alerts),
+        otherwise the alerts are computed from the accumulation.
+
+        :param land: numpy.ndarray
+            the sorted flat indices of the pixels to be compared
+            with the thresholds, e.g. the land pixels
+        :param steps: numpy.ndarray
+            the thresholds of those pixels, in quantization steps
+        :return: tuple
+            the quantized accumulation and the 2d uint8 alerts,
+            zero on the pixels not compared
+        """
+        last = self.measures[-1]
+        if self._accumul is None and self.archive is None and getattr(last, 'archive', None) is None:
+            rainc, rainnc, no_data = last.read_components(self.window)
+            self._accumul, alerts = accumulate_alerts(rainc, rainnc, no_data, self.quantizer, land, steps)
+            return self._accumul, alerts
+        return self.accumul, threshold_alerts(self.accumul, land, steps, self.quantizer.nodata)
+
+    @property
+    def valid(self):
+        """Get the validity mask of the serie.
+
+        Generates and returns a 2d boolean array which is False
+        where the last measure is NoData, the same pixels that are
+        NoData in the accumulation (as the WRF values are cumulated
+        since the model run, the last hour alone decides).
+
+        :return: numpy.ndarray
+        """
+        if self._valid is None:
+            self._valid = self.accumul != self.quantizer.nodata
+        return self._valid
+
+    def pixels(self, lats, lons):
+        """Get the pixels of the grid containing some points
+
+        :param lats: sequence
+            the latitudes of the points
+        :param lons: sequence
+            the longitudes of the points
+        :return: tuple
+            the rows and columns of the points and a boolean array
+            which is False for the points out of the grid
+        """
+        gt = self.geotransform
+        rows = np.floor((np.asarray(lats, np.float64) - gt[3]) / gt[5]).astype(np.intp)
+        cols = np.floor((np.asarray(lons, np.float64) - gt[0]) / gt[1]).astype(np.intp)
+        shape = self.shape
+        inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        return rows, cols, inside
+
+    def extract_stations(self, stations):
+        """Extract the hourly precipitation at some stations.
+
+        The pixels of the stations are computed once, then only the rows
+        and columns containing them are read: from the serie if already
+        read, from the run archive with a single access, otherwise from
+        each file by orthogonal indexing.
+
+        :param stations: list
+            of (id, lat, lon) tuples, see read_stations
+        :return: numpy.ndarray
+            a 2d float32 array of the hourly precipitation in millimetres,
+            with a row for each station and a column for each measure;
+            NaN for the stations out of the grid and for NoData.
+            The first column is NaN if the serie does not start
+            at the model run, as the WRF values are cumulated since then
+        """
+        rows, cols, inside = self.pixels([lat for _, lat, _ in stations], [lon for _, _, lon in stations])
+        hourly = np.full((len(stations), len(self.measures)), np.nan, np.float32)
+        if not inside.any():
+            return hourly
+        urows, row_inverse = np.unique(rows[inside], return_inverse=True)
+        ucols, col_inverse = np.unique(cols[inside], return_inverse=True)
+        if self._serie is not None:
+            cube = self._serie[:, urows][:, :, ucols]
+        elif self.archive is not None:
+            first = self.measures[0].index
+            cube = self.archive.read(first, first + len(self.measures) - 1, (urows, ucols))
+            cube[:, (cube == self.quantizer.nodata).any(axis=0)] = self.quantizer.nodata
+        else:
+            cube = np.empty((len(self.measures), len(urows), len(ucols)), self.quantizer.dtype)
+            rain = valid = None
+            for i, measure in enumerate(self.measures):
+                rain, valid = measure.read_rain(rain, valid, (urows, ucols))
+                self.quantizer.encode(rain, out=cube[i], work=rain)
+            cube[:, ~valid] = self.quantizer.nodata
+        qvalues = cube[:, row_inverse, col_inverse].T.astype(np.float64)
+        qvalues[qvalues == self.quantizer.nodata] = np.nan
+        # the increments are computed in quantization steps, the offset cancels out
+        hourly[inside, 1:] = np.diff(qvalues, axis=1) * self.quantizer.scale
+        if self.start_dt == self.measures[0].model_run_dt:
+            hourly[inside, 0] = qvalues[:, 0] * self.quantizer.scale + self.quantizer.offset
+        return hourly
+
+    def stations_to_file(self, stations, out_abspath):
+        """Write the hourly precipitation at some stations to disk.
+
+        The table is written as CSV, with a row for each station and a
+        column for the end of each measure, or as a numpy .npz archive
+        with the ids, lats, lons, times and rain arrays if the filename
+        has the .npz extension.
+
+        :param stations: list
+            of (id, lat, lon) tuples, see read_stations
+        :param out_abspath: str
+            the absolute path of the output file
+            in the os.path flavour
+        :return: int
+            0 if successful
+        """
+        if not os.path.isabs(out_abspath):
+            raise ValueError("The path provided is not absolute: " + out_abspath)
+        hourly = self.extract_stations(stations)
+        times = [measure.end_dt.isoformat() for measure in self.measures]
+        print('Writing station file --> ', out_abspath)
+        if out_abspath.endswith('.npz'):
+            np.savez_compressed(out_abspath, ids=np.array([station[0] for station in stations]),
+                                lats=np.array([station[1] for station in stations]),
+                                lons=np.array([station[2] for station in stations]),
+                                times=np.array(times, 'datetime64[s]'), rain=hourly)
+        else:
+            with open(out_abspath, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(['id', 'lat', 'lon'] + times)
+                for (station_id, lat, lon), values in zip(stations, hourly):
+                    writer.writerow([station_id, lat, lon] + ['' if np.isnan(value) else '%g' % value
+                                                              for value in values])
+        print('\tstation file written!')
+        return 0
+
     def accumul_to_tiff(self, out_abspath):
         """Write accumulated rain values to geotiff.
 
+        Values are written in the quantized form, together with the
+        scale and offset needed for getting millimetres back.
+
         :param: str
             the absolute path of the output file
             in the os.path flavour
@@ -172,7 +487,7 @@ class PrecipTimeSerie:
         gdal.AllRegister()
         driver = gdal.GetDriverByName('Gtiff')
         outDataset_options = ['COMPRESS=LZW']
-        dtype = gdal.GDT_Int16
+        dtype = gdal.GetDataTypeByName(self.quantizer.gdal_type_name)
         print('Writing accumulation file --> ', out_abspath)
         outDataset = driver.Create(out_abspath, self.accumul.shape[1], self.accumul.shape[0], 1,
                                    dtype, outDataset_options)
@@ -181,10 +496,11 @@ class PrecipTimeSerie:
         srs.ImportFromEPSG(self.EPSG_CODE)
         outDataset.SetProjection(srs.ExportToWkt())
         outband = outDataset.GetRasterBand(1)
-        nodata_value = np.iinfo(self.accumul.dtype).max
-        outband.SetNoDataValue(nodata_value)
-        self.accumul.fill_value = nodata_value
-        outband.WriteArray(self.accumul.filled())
+        outband.SetNoDataValue(self.quantizer.nodata)
+        outband.SetScale(self.quantizer.scale)
+        outband.SetOffset(self.quantizer.offset)
+        outband.SetUnitType('mm')
+        outband.WriteArray(self.accumul)
         outband.GetStatistics(0, 1)
         print('\taccumulation file written!')
         del outband
@@ -0,0 +1,303 @@
+"""Render the accumulations and the alerts as a pyramid of XYZ web-map tiles.
+
+The products of a model run are colour-mapped directly from the arrays
+in memory: the values are first reduced to a grid of colour classes
+(0 is transparent), then each 256x256 tile of the configured zoom levels
+(web mercator, as in the XYZ scheme of the usual web maps) samples the
+classes of its pixels through the geotransform and looks up their colours.
+The tiles are rendered by a pool of worker processes, each receiving the
+classes once, and the tiles without colours (most of the alert tiles)
+are not written.
+
+The tiles of a model run are written to a new version folder and the
+current symlink is then switched to it with a single rename, so that a
+static web server always serves the tiles of one model run:
+    <tiles dir>/current/<product>/<z>/<x>/<y>.png
+Only numpy and zlib are used, the PNG files are encoded here.
+"""
+import concurrent.futures
+import math
+import os
+import shutil
+import struct
+import time
+import zlib
+
+import numpy as np
+
+TILE_SIZE = 256
+# the maximum latitude of the web mercator projection
+MAX_LAT = 85.0511287798
+# the lower bounds in mm of the classes of the accumulations, and their RGBA colours
+ACCUMUL_BREAKS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+ACCUMUL_COLORS = ((198, 219, 239, 160), (158, 202, 225, 180), (107, 174, 214, 190), (66, 146, 198, 200),
+                  (33, 113, 181, 210), (65, 171, 93, 210), (254, 217, 118, 220), (253, 141, 60, 220),
+                  (227, 26, 28, 230), (128, 0, 38, 240))
+ALERT_COLOR = (220, 20, 60, 200)
+TRANSPARENT = (0, 0, 0, 0)
+VERSIONS_SUBDIR = 'versions'
+CURRENT_LINK = 'current'
+
+# the classes, palette and geotransform of the product rendered by a worker process
+_worker_state = None
+
+
+def accumul_classes(accumul, quantizer):
+    """Get the colour classes of a quantized accumulation
+
+    :param accumul: numpy.ndarray
+        the quantized accumulation
+    :param quantizer: quantize.Quantizer
+        the compact representation of the precipitation values
+    :return: tuple
+        containing the 2d uint8 classes, 0 below the first break and for
+        NoData, and the palette of the classes
+    """
+    rain = quantizer.decode(accumul)
+    classes = np.digitize(rain.filled(0), ACCUMUL_BREAKS).astype(np.uint8)
+    return classes, np.array((TRANSPARENT,) + ACCUMUL_COLORS, np.uint8)
+
+
+def alert_classes(barray):
+    """Get the colour classes of the alerts
+
+    :param barray: numpy.ndarray
+        non-zero where alerts are
+    :return: tuple
+        containing the 2d uint8 classes and the palette of the classes
+    """
+    return (barray != 0).astype(np.uint8), np.array((TRANSPARENT, ALERT_COLOR), np.uint8)
+
+
+def write_png(abspath, rgba):
+    """Write an RGBA image to a PNG file
+
+    :param abspath: str
+        the absolute path of the output file
+    :param rgba: numpy.ndarray
+        the 3d uint8 array of the image, with 4 channels
+    :return: None
+    """
+    height, width = rgba.shape[:2]
+    # each scanline starts with its filter type, 0 for none
+    scanlines = np.zeros((height, width * 4 + 1), np.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(abspath, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def tile_range(geotransform, shape, zoom):
+    """Get the tiles of a zoom level covering a grid
+
+    :param geotransform: tuple
+        the affine geotransform coefficients of the grid, in EPSG:4326
+    :param shape: tuple
+        the number of rows and columns of the grid
+    :param zoom: int
+        the zoom level
+    :return: tuple
+        containing the range of the tile columns (x) and the range of the tile rows (y)
+    """
+    count = 2 ** zoom
+    lons = (geotransform[0], geotransform[0] + shape[1] * geotransform[1])
+    lats = (geotransform[3], geotransform[3] + shape[0] * geotransform[5])
+    xs = [min(count - 1, max(0, int((lon + 180) / 360 * count))) for lon in sorted(lons)]
+    ys = []
+    for lat in sorted(lats, reverse=True):
+        lat = math.radians(min(MAX_LAT, max(-MAX_LAT, lat)))
+        ys.append(min(count - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * count))))
+    return range(xs[0], xs[1] + 1), range(ys[0], ys[1] + 1)
+
+
+def tile_pixels(geotransform, shape, zoom, x, y):
+    """Get the pixels of a grid sampled by the pixels of a tile
+
+    The web mercator rows and columns are separable, so that the rows
+    depend on the tile row only and the columns on the tile column only.
+
+    :param geotransform: tuple
+        the affine geotransform coefficients of the grid, in EPSG:4326
+    :param shape: tuple
+        the number of rows and columns of the grid
+    :param zoom: int
+        the zoom level
+    :param x: int
+        the column of the tile
+    :param y: int
+        the row of the tile
+    :return: tuple
+        containing the grid rows of the tile rows, the grid columns of the
+        tile columns and the two boolean arrays which are False out of the grid
+    """
+    size = TILE_SIZE * 2 ** zoom
+    offsets = np.arange(TILE_SIZE) + 0.5
+    lons = (x * TILE_SIZE + offsets) / size * 360 - 180
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y * TILE_SIZE + offsets) / size))))
+    cols = np.floor((lons - geotransform[0]) / geotransform[1]).astype(np.intp)
+    rows = np.floor((lats - geotransform[3]) / geotransform[5]).astype(np.intp)
+    return rows, cols, (rows >= 0) & (rows < shape[0]), (cols >= 0) & (cols < shape[1])
+
+
+def _init_worker(classes, palette, geotransform):
+    """Receive the product to be rendered by a worker process
+
+    :param classes: numpy.ndarray
+        the 2d colour classes of the product
+    :param palette: numpy.ndarray
+        the RGBA colour of each class
+    :param geotransform: tuple
+        the affine geotransform coefficients of the classes
+    :return: None
+    """
+    global _worker_state
+    _worker_state = (classes, palette, geotransform)
+
+
+def _render_column(out_dir, zoom, x, ys):
+    """Render a column of tiles of the product received by the worker process
+
+    :param out_dir: str
+        the folder of the tiles of the product
+    :param zoom: int
+        the zoom level
+    :param x: int
+        the column of the tiles
+    :param ys: range
+        the rows of the tiles
+    :return: int
+        the number of tiles written, the empty ones are skipped
+    """
+    classes, palette, geotransform = _worker_state
+    written = 0
+    for y in ys:
+        rows, cols, rows_inside, cols_inside = tile_pixels(geotransform, classes.shape, zoom, x, y)
+        if not rows_inside.any() or not cols_inside.any():
+            continue
+        tile = np.zeros((TILE_SIZE, TILE_SIZE), np.uint8)
+        tile[np.ix_(rows_inside, cols_inside)] = classes[np.ix_(rows[rows_inside], cols[cols_inside])]
+        if not tile.any():
+            continue
+        column_dir = os.path.join(out_dir, str(zoom), str(x))
+        os.makedirs(column_dir, exist_ok=True)
+        write_png(os.path.join(column_dir, '{}.png'.format(y)), palette[tile])
+        written += 1
+    return written
+
+
+def render_tiles(classes, palette, geotransform, out_dir, zooms, workers=None):
+    """Render the tiles of a product for a range of zoom levels
+
+    :param classes: numpy.ndarray
+        the 2d colour classes of the product
+    :param palette: numpy.ndarray
+        the RGBA colour of each class
+    :param geotransform: tuple
+        the affine geotransform coefficients of the classes, in EPSG:4326
+    :param out_dir: str
+        the folder of the tiles of the product
+    :param zooms: range
+        the zoom levels
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :return: int
+        the number of tiles written
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(classes, palette, geotransform)) as executor:
+        futures = []
+        for zoom in zooms:
+            xs, ys = tile_range(geotransform, classes.shape, zoom)
+            futures.extend(executor.submit(_render_column, out_dir, zoom, x, ys) for x in xs)
+        return sum(future.result() for future in futures)
+
+
+def switch_version(tiles_dir, version_dir, keep=2):
+    """Point the current symlink to a version of the tiles, at once
+
+    The older versions are removed, except for the last ones still being
+    fetched by the clients.
+
+    :param tiles_dir: str
+        the folder of the tiles
+    :param version_dir: str
+        the folder of the new version, in the versions subfolder
+    :param keep: int
+        the number of versions kept, including the new one
+    :return: None
+    """
+    link = os.path.join(tiles_dir, CURRENT_LINK)
+    tmp_link = link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(version_dir, tiles_dir), tmp_link)
+    os.replace(tmp_link, link)
+    versions_dir = os.path.join(tiles_dir, VERSIONS_SUBDIR)
+    versions = sorted(os.listdir(versions_dir), reverse=True)
+    for version in versions[keep:]:
+        if version != os.path.basename(version_dir):
+            shutil.rmtree(os.path.join(versions_dir, version), ignore_errors=True)
+
+
+def render_version(products, geotransform, tiles_dir, model_run_dt, zooms, workers=None):
+    """Render the tiles of the products of a model run to a new version folder
+
+    The version is not served until the current symlink is switched
+    to it, see switch_version.
+
+    :param products: dict
+        by product name, the colour classes and their palette,
+        see accumul_classes and alert_classes
+    :param geotransform: tuple
+        the affine geotransform coefficients of the products, in EPSG:4326
+    :param tiles_dir: str
+        the folder of the tiles
+    :param model_run_dt: datetime.datetime
+        the date and time of the model run
+    :param zooms: range
+        the zoom levels
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :return: str
+        the folder of the new version
+    """
+    # a new folder even when the model run is processed again, as the current one may be in use
+    version = '{}_{:d}'.format(model_run_dt.strftime('%Y%m%d%H'), time.time_ns())
+    version_dir = os.path.join(tiles_dir, VERSIONS_SUBDIR, version)
+    print('Rendering tiles of ', len(products), ' products --> ', version_dir)
+    for name, (classes, palette) in products.items():
+        written = render_tiles(classes, palette, geotransform, os.path.join(version_dir, name), zooms, workers)
+        print('\t', name, ': ', written, ' tiles written')
+    os.makedirs(version_dir, exist_ok=True)
+    return version_dir
+
+
+def publish_tiles(products, geotransform, tiles_dir, model_run_dt, zooms, workers=None):
+    """Render the tiles of the products of a model run and make them current
+
+    :param products: dict
+        by product name, the colour classes and their palette,
+        see accumul_classes and alert_classes
+    :param geotransform: tuple
+        the affine geotransform coefficients of the products, in EPSG:4326
+    :param tiles_dir: str
+        the folder of the tiles
+    :param model_run_dt: datetime.datetime
+        the date and time of the model run
+    :param zooms: range
+        the zoom levels
+    :param workers: int
+        the number of worker processes (default is the number of CPUs)
+    :return: str
+        the folder of the new version
+    """
+    version_dir = render_version(products, geotransform, tiles_dir, model_run_dt, zooms, workers)
+    switch_version(tiles_dir, version_dir)
+    print('\ttiles published!')
+    return version_dir
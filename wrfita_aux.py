@@ -2,10 +2,12 @@
 import os
 import datetime
 
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals
 import numpy as np
 from osgeo import gdal, osr
 
+from filenames import parse_wrf_fname
+
 
 class WrfItaAux:
     """A class used to read WRF data
@@ -30,22 +32,36 @@ class WrfItaAux:
         model_run_dt: datetime.datetime
             the instant in time corresponding to the run of the
             model
+        domain: str
+            the WRF domain of the file, e.g. d02
+        memory: bytes
+            the content of the file, read in place of the file on disk,
+            or None
     """
     EPSG_CODE = 4326
-    FILENAME_FORMAT = 'sft_rftm_rg_wrfita_aux_d02_%Y-%m-%d_00_*'
 
-    def __init__(self, abspath):
+    def __init__(self, abspath, memory=None):
         """
         :param abspath: str
             absolute path to the file on disk in the os.path style
+        :param memory: bytes
+            if provided, the content of the file, e.g. as downloaded from
+            the SFTP, so that nothing is read from disk
+        :raise: ValueError
+            if the filename does not follow the WRF format
         """
         self.abspath = abspath
         self.dirname, self.basename = os.path.split(abspath)
-        with Dataset(abspath) as ds:
+        self.memory = memory
+        fields = parse_wrf_fname(self.basename)
+        if fields is None:
+            raise ValueError('Not a WRF filename: ' + self.basename)
+        with self._open() as ds:
             self.period = datetime.timedelta(hours=ds.variables['time'][:][0])
         self.end_dt = datetime.datetime(2000, 1, 1) + self.period
         self.start_dt = self.end_dt - datetime.timedelta(hours=1)
-        self.model_run_dt = datetime.datetime.strptime(self.basename[:-2], self.FILENAME_FORMAT[:-1])
+        self.model_run_dt = fields.model_run_dt
+        self.domain = fields.domain
         if self.model_run_dt > self.start_dt:
             self.start_dt = self.model_run_dt
         # geometric characteristics below
@@ -61,6 +77,15 @@ class WrfItaAux:
         self._no_data_rainnc = None
         self._no_data = None
 
+    def _open(self):
+        """Open the netCDF4 file, from disk or from memory
+
+        :return: netCDF4.Dataset
+        """
+        if self.memory is not None:
+            return Dataset(self.basename, memory=self.memory)
+        return Dataset(self.abspath)
+
     def __gt__(self, other):
         """Compare the current WrfItaAux object with another.
 
@@ -184,7 +209,7 @@ class WrfItaAux:
             in case the variable cannot be read.
         """
         try:
-            with Dataset(self.abspath) as ds:
+            with self._open() as ds:
                 rainc = ds.variables['RAINC'][0]
                 self._no_data_rainc = ds.variables['RAINC'][:].fill_value
         except OSError as ose:
@@ -204,7 +229,7 @@ class WrfItaAux:
             in case the variable cannot be read.
         """
         try:
-            with Dataset(self.abspath) as ds:
+            with self._open() as ds:
                 rainnc = ds.variables['RAINNC'][0]
                 self._no_data_rainnc = ds.variables['RAINNC'][:].fill_value
         except OSError as ose:
@@ -223,6 +248,68 @@ class WrfItaAux:
         """
         return self.rainc + self.rainnc
 
+    def read_rain(self, out=None, valid=None, window=None):
+        """Read the total precipitation values into a plain array.
+
+        A faster alternative to the rain property: the file is opened
+        once, automatic masking is disabled and RAINC and RAINNC are
+        summed in place into the given float32 buffer. NoData pixels
+        are tracked by a boolean validity mask, that can be shared
+        across the measures of a time serie.
+
+        :param out: numpy.ndarray
+            if provided, the float32 buffer where the result is stored
+        :param valid: numpy.ndarray
+            if provided, a boolean array that is updated in place
+            setting to False the NoData pixels of this measure
+        :param window: tuple
+            if provided, the row and column slices of the grid to be read,
+            or sorted arrays of row and column indices (orthogonal indexing)
+        :return: tuple
+            containing the precipitation and the validity arrays
+        :raise: OSError
+            in case the variables cannot be read.
+        """
+        rainc, rainnc, _ = self.read_components(window)
+        if out is None:
+            out = np.empty(rainc.shape, np.float32)
+        if valid is None:
+            valid = np.ones(rainc.shape, bool)
+        valid &= rainc != self._no_data_rainc
+        valid &= rainnc != self._no_data_rainnc
+        np.add(rainc, rainnc, out=out)
+        return out, valid
+
+    def read_components(self, window=None):
+        """Read the RAINC and RAINNC values into plain arrays.
+
+        The file is opened once and automatic masking is disabled.
+
+        :param window: tuple
+            if provided, the row and column slices of the grid to be read,
+            or sorted arrays of row and column indices (orthogonal indexing)
+        :return: tuple
+            containing the RAINC and the RAINNC arrays
+            and a tuple with their NoData values
+        :raise: OSError
+            in case the variables cannot be read.
+        """
+        try:
+            with self._open() as ds:
+                ds.set_auto_mask(False)
+                rainc_var = ds.variables['RAINC']
+                rainnc_var = ds.variables['RAINNC']
+                self._no_data_rainc = _fill_value(rainc_var)
+                self._no_data_rainnc = _fill_value(rainnc_var)
+                if window is None:
+                    window = (slice(None), slice(None))
+                rainc = rainc_var[(0,) + tuple(window)]
+                rainnc = rainnc_var[(0,) + tuple(window)]
+        except OSError as ose:
+            print('Cannot read RAIN data from: ', self.basename)
+            raise ose
+        return rainc, rainnc, (self._no_data_rainc, self._no_data_rainnc)
+
     @property
     def lats(self):
         """Get the array of latitude values.
@@ -234,7 +321,7 @@ class WrfItaAux:
             in case the variable cannot be read.
         """
         try:
-            with Dataset(self.abspath) as ds:
+            with self._open() as ds:
                 xs = ds.variables['lat'][:]
         except OSError as ose:
             print('Cannot read latitude data from: ', self.basename)
@@ -252,7 +339,7 @@ class WrfItaAux:
             in case the variable cannot be read.
         """
         try:
-            with Dataset(self.abspath) as ds:
+            with self._open() as ds:
                 ys = ds.variables['lon'][:]
         except OSError as ose:
             print('Cannot read longitude data from: ', self.basename)
@@ -293,23 +380,36 @@ class WrfItaAux:
         """
         if not os.path.isabs(out_abspath):
             raise ValueError("The path provided is not absolute")
-        if not isinstance(self.rain, np.ndarray):
-            raise ValueError("The array provided is not a valid numpy array")
+        rain, valid = self.read_rain()
+        rain[~valid] = -1.0
         gdal.AllRegister()
         driver = gdal.GetDriverByName('Gtiff')
         outDataset_options = ['COMPRESS=LZW']
         dtype = gdal.GDT_Float32
-        outDataset = driver.Create(out_abspath, self.rain.shape[1], self.rain.shape[0], 1, dtype, outDataset_options)
+        outDataset = driver.Create(out_abspath, rain.shape[1], rain.shape[0], 1, dtype, outDataset_options)
         outDataset.SetGeoTransform(self.geotransform)
         srs = osr.SpatialReference()
         srs.ImportFromEPSG(self.EPSG_CODE)
         outDataset.SetProjection(srs.ExportToWkt())
         outband = outDataset.GetRasterBand(1)
         outband.SetNoDataValue(-1.0)
-        rain = self.rain
-        rain.fill_value = -1.0
-        outband.WriteArray(rain.filled())
+        outband.WriteArray(rain)
         outband.GetStatistics(0, 1)
         del outband
         del outDataset
         return 0
+
+
+def _fill_value(variable):
+    """Get the fill value of a netCDF variable
+
+    The same value used by netCDF4 for masking the variable,
+    i.e. the _FillValue attribute or the netCDF default one.
+
+    :param variable: netCDF4.Variable
+    :return: numpy scalar
+    """
+    try:
+        return variable.dtype.type(variable._FillValue)
+    except AttributeError:
+        return variable.dtype.type(default_fillvals[variable.dtype.str[1:]])